@@ -9,27 +9,101 @@ import io
 import pyodbc
 import oracledb
 import math
-
-# Función con caché para no conectar a la DB en cada click:
+import tracemalloc
+import time
+import threading
+from collections import Counter, OrderedDict, deque
+import gc
+import os
+import json
+from datetime import datetime
+from pathlib import Path
+from urllib.parse import quote, unquote
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import shutil
+import zipfile
+from contextlib import contextmanager
+from PIL import Image
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+try:
+    import fcntl # Lock entre procesos para la carga; en Windows no existe y cada proceso carga solo
+except ImportError:
+    fcntl = None
+
+# --- BASE DE DATOS ---
+POOL_MIN_CONEXIONES = 1
+POOL_MAX_CONEXIONES = 4 # Tope compartido entre todas las sesiones de Streamlit
+FETCH_ARRAYSIZE = 10000 # Filas por viaje a la base en cada fetch
+FETCH_PREFETCHROWS = 10000 # Filas que ya vienen en la respuesta del execute
+
+# Pool con caché para no conectar a la DB en cada click. Es thread-safe: cada sesión
+# (y cada consulta en paralelo) pide su conexión y la devuelve al terminar.
 @st.cache_resource
-def conectar_db():
+def pool_db():
     host = "10.1.192.11" 
     port = 1521           
     service_name = "PROD" # Nombre del servicio o SID
     
     dsn_tns = f"{host}:{port}/{service_name}"
     
-    return oracledb.connect(
+    return oracledb.create_pool(
         user="flibertun",
         password="FLIBERTUN",
-        dsn=dsn_tns
+        dsn=dsn_tns,
+        min=POOL_MIN_CONEXIONES,
+        max=POOL_MAX_CONEXIONES,
+        increment=1
     )
     
 # --- SEGURIDAD ---
 CLAVE_DESARROLLADOR = "admin123" # Cambia esto por tu clave
 
-# Configuración de la página
-st.set_page_config(page_title="Tablero de Cobertura Geográfica", layout="wide")
+# --- SNAPSHOT LOCAL ---
+# Copia en disco (Parquet + manifest.json) de lo último que se trajo de Oracle.
+# Al reiniciar el servidor se arranca desde acá y solo se piden a la base los cambios.
+SNAPSHOT_DIR = Path(__file__).parent / "snapshot"
+SNAPSHOT_TTL_SEG = 60 * 60 # Antigüedad máxima del snapshot antes de pedir el delta a Oracle
+# El delta no ve los cambios en tablas de referencia (localidades, provincias, especialidades,
+# dominios...) ni los domicilios borrados: pasado este tiempo desde la última completa, se trae todo
+RECARGA_COMPLETA_SEG = 24 * 60 * 60
+FORMATO_SNAPSHOT = 2 # Subirlo cuando cambie lo que se guarda: fuerza una recarga completa
+# Carga por provincia: en lugar del país entero, los afiliados se traen de a una provincia, recién
+# cuando el filtro la pide, y la vista "Todas" sale de totales ya agrupados en la base.
+# Cada provincia se guarda aparte en PARTICIONES_DIR y vence como el snapshot (SNAPSHOT_TTL_SEG)
+CARGA_POR_PROVINCIA = False
+# Almacén compartido entre procesos (varios servidores de Streamlit detrás de un balanceador): uno
+# solo trae de la base y procesa, y deja los cuatro DataFrames como Arrow sin comprimir; todos los
+# procesos los mapean en memoria de solo lectura y el sistema operativo comparte esas páginas.
+# Apagado por defecto, como la carga por provincia: se prende al correr varios procesos
+ALMACEN_COMPARTIDO = False
+ALMACEN_DIR = SNAPSHOT_DIR / "compartido"
+PARTICIONES_DIR = SNAPSHOT_DIR / "provincias"
+CACHE_PARTICIONES_MB = 1024 # Tope de memoria para las provincias ya procesadas (datos + cubo)
+
+# --- CACHÉS DEL PROCESO ---
+CACHE_KDTREE_MB = 256 # Tope de memoria para árboles y distancias por especialidad
+PRECALENTAR_ESPECIALIDADES = 5 # Especialidades más usadas que se precalculan al cargar (0 = no)
+# Matriz afiliados x especialidades con la distancia al consultorio más cercano de cada una:
+# "disco" (memmap junto al snapshot, sobrevive reinicios), "memoria", o None para no calcularla
+MATRIZ_DISTANCIAS = "disco"
+CACHE_PIRAMIDES_MB = 128 # Tope de memoria para las grillas del heatmap por filtro
+CACHE_RESULTADOS_MB = 64 # Tope de memoria para los resultados por filtro (localidades, métricas y tabla formateada)
+CACHE_SUPERFICIES_MB = 64 # Tope de memoria para las grillas de cobertura por especialidad
+HEATMAP_MAX_CELDAS = 20000 # Más celdas que esto en el zoom actual: se usa el nivel más grueso que entre
+# Teselas PNG de densidad (todo el país, sin filtros) generadas en segundo plano por carga de datos.
+# Se sirven como archivos estáticos de Streamlit (server.enableStaticServing en .streamlit/config.toml)
+TESELAS_DIR = Path(__file__).parent / "static" / "teselas"
+TESELAS_URL = "/app/static/teselas"
+TESELAS_ZOOM_MIN, TESELAS_ZOOM_MAX = 3, 11
+TESELAS_CAPAS = ("afiliados", "consultorios") # Sacar "consultorios" para generar solo afiliados
+
+# Los DataFrames cargados se comparten entre sesiones: con copy-on-write cualquier cambio
+# sobre un subconjunto copia en lugar de tocar los datos compartidos (en pandas 3 ya es así)
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
 
 # --- 1. FUNCIONES DE FORMATO ---
 def formato_es(valor):
@@ -43,6 +117,65 @@ def formato_porcentaje(parte, total):
 def formato_miles(valor):
     return f"{int(valor):,}".replace(",", ".")
 
+def numeros_es(serie, decimales=0, nulo="-"):
+    """Formato argentino (punto de miles, coma decimal) de una columna entera sin un format
+    por fila: los caracteres se arman con numpy, alineados a la derecha en una matriz de bytes,
+    y se entregan como strings de Arrow. NaN e infinitos quedan como 'nulo'.
+    Los enteros salen igual que f"{x:,}". Con decimales, el escalado da el mismo redondeo que
+    f"{x:,.Nf}" solo si el producto por 10**N es exacto en long double (x86 y Linux ARM, hasta
+    4 decimales); donde no lo es (Windows/MSVC o macOS ARM, que usan float64) va por el format
+    de Python, igual que los valores que escalados no entran en int64."""
+    if serie.empty:
+        return pd.Series([], index=serie.index, dtype="str")
+    tope = 2**63 / 10**decimales
+    if pd.api.types.is_integer_dtype(serie.dtype) and not serie.hasnans:
+        valores = serie.to_numpy().astype(np.int64)
+        validos = np.ones(len(valores), dtype=bool)
+        por_celda = np.abs(valores.astype(np.float64)) >= tope
+        negativos = valores < 0
+        escalados = np.abs(np.where(por_celda, 0, valores)) * 10**decimales
+    else:
+        valores = serie.to_numpy(dtype=np.float64, na_value=np.nan)
+        validos = np.isfinite(valores)
+        # Los 53 bits del float64 por 5**N (el 2**N no suma bits) tienen que entrar en la mantisa
+        exacto = 53 + (5**decimales).bit_length() <= np.finfo(np.longdouble).nmant + 1
+        por_celda = validos & (np.abs(valores) >= tope) if exacto else validos
+        negativos = np.signbit(valores) & validos
+        escalados = np.rint(np.abs(np.where(validos & ~por_celda, valores, 0)).astype(np.longdouble) * 10**decimales).astype(np.int64)
+    enteros, fraccion = np.divmod(escalados, 10**decimales)
+
+    # Largo de cada texto: dígitos de la parte entera con sus puntos, la coma y los decimales, el signo
+    digitos = 1 + np.searchsorted(10 ** np.arange(1, 19, dtype=np.int64), enteros, side='right')
+    largo_entero = digitos + (digitos - 1) // 3
+    cola = decimales + 1 if decimales else 0
+    largo = largo_entero + cola + negativos
+    ancho = int(largo.max())
+    caracteres = np.zeros((len(largo), ancho), dtype=np.uint8)
+    for d in range(decimales):
+        caracteres[:, ancho - 1 - d] = ord("0") + fraccion // 10**d % 10
+    if decimales:
+        caracteres[:, ancho - cola] = ord(",")
+    # Lo que pase del largo de cada fila queda fuera de la máscara de abajo
+    for k in range(int(largo_entero.max())):
+        columna = ancho - 1 - cola - k
+        if k % 4 == 3:
+            caracteres[:, columna] = ord(".")
+        else:
+            caracteres[:, columna] = ord("0") + enteros // 10**(k - k // 4) % 10
+    filas = np.flatnonzero(negativos)
+    caracteres[filas, ancho - largo[filas]] = ord("-")
+
+    en_texto = np.arange(ancho) >= (ancho - largo)[:, None]
+    offsets = np.concatenate([[0], np.cumsum(largo)]).astype(np.int32)
+    texto = pa.StringArray.from_buffers(len(largo), pa.py_buffer(offsets), pa.py_buffer(caracteres[en_texto]))
+    if not validos.all():
+        texto = pc.if_else(pa.array(validos), texto, nulo)
+    resultado = texto.to_pandas().set_axis(serie.index)
+    if por_celda.any():
+        resultado[por_celda] = [f"{x:,.{decimales}f}".replace(",", "X").replace(".", ",").replace("X", ".")
+                                for x in valores[por_celda].tolist()]
+    return resultado
+
 def rescatar_nombre_localidad(valor):
     if pd.isna(valor): return "SIN DATO"
     if isinstance(valor, (pd.Timestamp, np.datetime64)) or hasattr(valor, 'month'):
@@ -55,11 +188,9 @@ def rescatar_nombre_localidad(valor):
     return str(valor).upper().strip()
 
 
-# --- 2. PROCESAMIENTO DE DATOS ---
+# --- CONSULTAS ---
 
-@st.cache_data
-def cargar_y_procesar_datos():
-    query_afiliados = """
+QUERY_AFILIADOS = """
     SELECT  
         af.codigo        AS "Codigo",
         af.apellidos     AS "Apellidos",
@@ -155,7 +286,77 @@ def cargar_y_procesar_datos():
     WHERE af.estado = 'A'
     ORDER BY af.apellidos, af.nombres
     """
-    query_consultorios = """
+
+# Variante "por conjuntos" de QUERY_AFILIADOS: en lugar de 24 subconsultas escalares
+# correlacionadas por afiliado, resuelve los domicilios POST una sola vez con un GROUP BY,
+# y después toma el propio (o el del titular vía afi_afi_id) con NVL columna a columna,
+# igual que la consulta original. Devuelve exactamente las mismas columnas.
+# Las subconsultas de CODIGOPOST/LOCALIDAD hacen join interno con sa_localidades (y
+# PROVINCIA/PAIS además con sa_provincias/sa_paises), así que salen del primer domicilio POST
+# que tenga esos datos, que puede no ser el de la calle: acá se ordena igual con el NVL2 del
+# KEEP. Donde la original usa ROWNUM < 2 sin orden, acá se desempata por domiafi_id; si un
+# afiliado tiene varios POST y Oracle devolvía otro, comparar_consultas_afiliados lo muestra.
+QUERY_AFILIADOS_CONJUNTO = """
+    WITH dom_post AS (
+        SELECT dafi.afi_afi_id
+        ,MIN(dafi.domiafi_id) domiafi_id
+        ,MIN(dafi.calle) KEEP (DENSE_RANK FIRST ORDER BY dafi.domiafi_id) calle
+        ,MIN(dafi.numero) KEEP (DENSE_RANK FIRST ORDER BY dafi.domiafi_id) numero
+        ,MIN(dafi.piso) KEEP (DENSE_RANK FIRST ORDER BY dafi.domiafi_id) piso
+        ,MIN(dafi.dpto) KEEP (DENSE_RANK FIRST ORDER BY dafi.domiafi_id) dpto
+        ,MIN(dafi.latitud) KEEP (DENSE_RANK FIRST ORDER BY dafi.domiafi_id) latitud
+        ,MIN(dafi.longitud) KEEP (DENSE_RANK FIRST ORDER BY dafi.domiafi_id) longitud
+        ,MIN(loc.codigo_postal) KEEP (DENSE_RANK FIRST ORDER BY NVL2(loc.loc_id, 0, 1), dafi.domiafi_id) codigo_postal
+        ,MIN(loc.localidad) KEEP (DENSE_RANK FIRST ORDER BY NVL2(loc.loc_id, 0, 1), dafi.domiafi_id) localidad
+        ,MIN(pr.NOMBRE) KEEP (DENSE_RANK FIRST ORDER BY NVL2(pr.codigo, 0, 1), dafi.domiafi_id) provincia
+        ,MIN(pa.NOMBRE) KEEP (DENSE_RANK FIRST ORDER BY NVL2(pa.codigo, 0, 1), dafi.domiafi_id) pais
+        FROM sa_domicilios_afiliado dafi
+        ,sa_domiafi_td datd
+        ,sa_localidades loc
+        ,sa_provincias pr
+        ,sa_paises pa
+        WHERE dafi.domiafi_id = datd.domiafi_domiafi_id
+        and datd.td_codigo = 'POST'
+        and dafi.loc_loc_id = loc.loc_id (+)
+        and loc.PCIA_CODIGO = pr.codigo (+)
+        and pr.PAIS_CODIGO = pa.CODIGO (+)
+        GROUP BY dafi.afi_afi_id
+    )
+    SELECT
+        af.codigo        AS "Codigo",
+        af.apellidos     AS "Apellidos",
+        af.nombres       AS "Nombres",
+        af.afi_id        AS "AFI_ID",
+        NVL(propio.domiafi_id, tit.domiafi_id)         AS "DOMIAFI_ID",
+        NVL(propio.calle, tit.calle)                   AS "CALLE",
+        NVL(propio.numero, tit.numero)                 AS "Numero",
+        NVL(propio.piso, tit.piso)                     AS "Piso",
+        NVL(propio.dpto, tit.dpto)                     AS "Departamento",
+        NVL(propio.codigo_postal, tit.codigo_postal)   AS CODIGOPOST,
+        NVL(propio.localidad, tit.localidad)           AS LOCALIDAD,
+        NVL(propio.provincia, tit.provincia)           AS PROVINCIA,
+        NVL(propio.pais, tit.pais)                     AS PAIS,
+        NVL(propio.latitud, tit.latitud)               AS "Latitud",
+        NVL(propio.longitud, tit.longitud)             AS "Longitud"
+    FROM sa_afiliados af
+    ,dom_post propio
+    ,dom_post tit
+    WHERE af.estado = 'A'
+    and propio.afi_afi_id (+) = af.afi_id
+    and tit.afi_afi_id (+) = af.afi_afi_id
+    ORDER BY af.apellidos, af.nombres
+    """
+
+QUERIES_AFILIADOS = {
+    "correlacionada": QUERY_AFILIADOS,
+    "conjunto": QUERY_AFILIADOS_CONJUNTO,
+}
+
+# Qué variante usa la carga de datos. Queda en "correlacionada" hasta que la comparación del
+# panel de staff corra contra PROD sin diferencias; cambiarla fuerza una recarga completa.
+MODO_EXTRACCION_AFILIADOS = "correlacionada"
+
+QUERY_CONSULTORIOS = """
     SELECT c.PRES_EFE_CODIGO
     ,c.SECUENCIA
     ,c.USERNAME
@@ -229,330 +430,2417 @@ def cargar_y_procesar_datos():
     --and c.PRES_EFE_CODIGO in ('888888','10010') --10010 no tiene especialidad
     order by 1,2
     """
-        
-    # 2. CARGA DE CONSULTORIOS
-    try:
-        conn = conectar_db()
-        df_afi_raw = pd.read_sql(query_afiliados, conn)
-        df_cons_raw = pd.read_sql(query_consultorios, conn)
-        conn.close()
-        
-        # Normalización
-        for df in [df_afi_raw, df_cons_raw]:
-            df.columns = df.columns.str.upper()
-            if 'LOCALIDAD' in df.columns:
-                df['LOCALIDAD'] = df['LOCALIDAD'].astype(str).str.strip().str.upper()
-            if 'PROVINCIA' in df.columns:
-                df['PROVINCIA'] = df['PROVINCIA'].astype(str).str.strip().str.upper().fillna("SIN DATO")
-            
-        # Filtro de País en Consultorios
-        if 'PAIS' in df_cons_raw.columns:
-            df_cons_raw = df_cons_raw[df_cons_raw['PAIS'].astype(str).str.upper() == 'ARGENTINA']
-
-        # Deduplicación y Filtro Geográfico
-        df_afi_clean = df_afi_raw.drop_duplicates(subset=['AFI_ID', 'CALLE', 'NUMERO'])
-        
-        LAT_MIN, LAT_MAX = -56.0, -21.0
-        LON_MIN, LON_MAX = -74.0, -53.0
-
-        def filtrar_geo(df):
-            df['LATITUD'] = pd.to_numeric(df['LATITUD'], errors='coerce')
-            df['LONGITUD'] = pd.to_numeric(df['LONGITUD'], errors='coerce')
-            # 2. Eliminar filas donde falte alguna de las dos
-            df = df.dropna(subset=['LATITUD', 'LONGITUD'])
-            mask = (df['LATITUD'].between(LAT_MIN, LAT_MAX)) & (df['LONGITUD'].between(LON_MIN, LON_MAX))
-            return df[mask].copy()
-    
-        df_mapa_afi = filtrar_geo(df_afi_clean)
-        df_mapa_cons = filtrar_geo(df_cons_raw)
-    
-        # SEPARACIÓN LÓGICA (Dentro de cargar_y_procesar_datos)
-        # Filtramos solo lo que NO es farmacia para cálculos médicos
-        cons_geo_only = df_mapa_cons[df_mapa_cons['DESC_TIPO_EFECTOR'] != 'FARMACIA'].copy()
-        
-        # B. Cálculo de Distancias
-        # Usamos 'cons_geo_only' para el árbol de distancias
-        tree = cKDTree(cons_geo_only[['LATITUD', 'LONGITUD']].values)
-        dist, _ = tree.query(df_mapa_afi[['LATITUD', 'LONGITUD']].values, k=1)
-        df_mapa_afi['distancia_km'] = dist * 111.13
-        
-        return df_afi_clean, df_cons_raw, df_mapa_afi, df_mapa_cons
 
-    except Exception as e:
-            st.error(f"Error en la base de datos: {e}")
-            return pd.DataFrame(), pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
 
-# --- 3. INTERFAZ Y FILTROS ---
+def comparar_consultas_afiliados():
+    """Corre las dos variantes de la consulta de afiliados, mide cuánto tarda cada una y
+    compara el resultado columna a columna por AFI_ID. Pensado para el panel de staff."""
+    tiempos = {}
+    resultados = {}
+    # Una después de la otra y en la misma conexión, para que los tiempos sean comparables
+    with pool_db().acquire() as conn:
+        for modo, query in QUERIES_AFILIADOS.items():
+            inicio = time.perf_counter()
+            df = leer_consulta(conn, query)
+            tiempos[modo] = round(time.perf_counter() - inicio, 2)
+            resultados[modo] = df.set_index('AFI_ID').sort_index()
+
+    viejo, nuevo = resultados["correlacionada"], resultados["conjunto"]
+    comunes = viejo.index.intersection(nuevo.index)
+    columnas = [c for c in viejo.columns if c in nuevo.columns]
+    a = viejo.loc[comunes, columnas].astype(str)
+    b = nuevo.loc[comunes, columnas].astype(str)
+
+    # Cantidad de afiliados con valor distinto por columna ('nan' == 'nan' cuenta como igual)
+    distintos = (a != b)
+    return {
+        "segundos": tiempos,
+        "filas": {modo: len(df) for modo, df in resultados.items()},
+        "columnas_iguales": list(viejo.columns) == list(nuevo.columns),
+        "solo_en_correlacionada": len(viejo.index.difference(nuevo.index)),
+        "solo_en_conjunto": len(nuevo.index.difference(viejo.index)),
+        "diferencias_por_columna": {c: int(n) for c, n in distintos.sum().items() if n > 0},
+        "ejemplo_afi_id_distintos": [str(i) for i in distintos.any(axis=1).loc[lambda x: x].index[:20]],
+    }
+
+# Claves que cambiaron desde un SCN dado. ORA_ROWSCN es a nivel bloque, así que puede traer
+# algunas claves de más (no pasa nada, se vuelven a leer); nunca trae de menos.
+# Incluye a los afiliados cuyo titular cambió de domicilio, porque heredan su domicilio POST.
+QUERY_AFILIADOS_CAMBIADOS = """
+    WITH cambiados AS (
+        SELECT af.afi_id FROM sa_afiliados af WHERE af.ORA_ROWSCN > :scn
+        UNION
+        SELECT dafi.afi_afi_id FROM sa_domicilios_afiliado dafi WHERE dafi.ORA_ROWSCN > :scn
+        UNION
+        SELECT dafi.afi_afi_id FROM sa_domicilios_afiliado dafi, sa_domiafi_td datd
+        WHERE dafi.domiafi_id = datd.domiafi_domiafi_id AND datd.ORA_ROWSCN > :scn
+    )
+    SELECT c.afi_id AS AFI_ID FROM cambiados c
+    UNION
+    SELECT af.afi_id FROM sa_afiliados af, cambiados c WHERE af.afi_afi_id = c.afi_id
+    """
 
-def reiniciar_filtros():
-    st.session_state['provincia'] = "Todas"
-    st.session_state['especialidad'] = "Todas"
-    st.session_state['localidad'] = "Todas"
-    if 'distancia' in st.session_state:
-        # Esto resetea el slider si le pones key='distancia'
-        del st.session_state['distancia']
+QUERY_CONSULTORIOS_CAMBIADOS = """
+    WITH efectores AS (
+        SELECT e.codigo FROM sa_efectores e WHERE e.ORA_ROWSCN > :scn
+        UNION
+        SELECT p.efe_codigo FROM sa_prestadores p WHERE p.ORA_ROWSCN > :scn
+        UNION
+        SELECT epf.efe_codigo FROM sa_esp_prof epf WHERE epf.ORA_ROWSCN > :scn
+    )
+    SELECT c.PRES_EFE_CODIGO, c.SECUENCIA FROM sa_consultorios c WHERE c.ORA_ROWSCN > :scn
+    UNION
+    SELECT d.CONS_PRES_EFE_CODIGO, d.CONS_SECUENCIA FROM sa_domicilios_consultorio d WHERE d.ORA_ROWSCN > :scn
+    UNION
+    SELECT c.PRES_EFE_CODIGO, c.SECUENCIA FROM sa_consultorios c, efectores ef WHERE c.PRES_EFE_CODIGO = ef.codigo
+    """
+
+# Todas las claves que siguen existiendo. Un DELETE no deja fila que ORA_ROWSCN pueda marcar:
+# en cada delta se quitan del snapshot las claves que ya no están en la base
+QUERY_AFILIADOS_VIGENTES = "SELECT af.afi_id AS AFI_ID FROM sa_afiliados af"
+QUERY_CONSULTORIOS_VIGENTES = "SELECT c.PRES_EFE_CODIGO, c.SECUENCIA FROM sa_consultorios c"
+
+
+def leer_consulta(conn, query, params=None):
+    with conn.cursor() as cur:
+        cur.arraysize = FETCH_ARRAYSIZE
+        cur.prefetchrows = FETCH_PREFETCHROWS
+        cur.execute(query, params or {})
+        columnas = [col[0].upper() for col in cur.description]
+        return pd.DataFrame.from_records(cur.fetchall(), columns=columnas, coerce_float=True)
+
+
+LAT_MIN, LAT_MAX = -56.0, -21.0
+LON_MIN, LON_MAX = -74.0, -53.0
+
+
+def normalizar_lote(df):
+    """Normalización de texto y coordenadas sobre un lote del cursor (antes se hacía sobre el
+    dataset entero, después de traerlo completo). GEO_VALIDA marca las filas mapeables;
+    las coordenadas fuera de Argentina se conservan tal cual para la auditoría."""
+    if 'LOCALIDAD' in df.columns:
+        df['LOCALIDAD'] = df['LOCALIDAD'].astype(str).str.strip().str.upper()
+    if 'PROVINCIA' in df.columns:
+        df['PROVINCIA'] = df['PROVINCIA'].astype(str).str.strip().str.upper().fillna("SIN DATO")
+    if 'LATITUD' in df.columns and 'LONGITUD' in df.columns:
+        df['LATITUD'] = pd.to_numeric(df['LATITUD'], errors='coerce').astype('float64')
+        df['LONGITUD'] = pd.to_numeric(df['LONGITUD'], errors='coerce').astype('float64')
+        # between() da False con NaN, así que esto también descarta las que faltan
+        df['GEO_VALIDA'] = df['LATITUD'].between(LAT_MIN, LAT_MAX) & df['LONGITUD'].between(LON_MIN, LON_MAX)
+    return df
+
+
+class BuffersColumnares:
+    """Un array numpy preasignado por columna que se va llenando lote a lote.
+    Si la estimación de filas queda corta, cada columna duplica su capacidad."""
+
+    def __init__(self, tipos, capacidad):
+        self.n = 0
+        self.capacidad = max(int(capacidad), 1)
+        self.arrays = {col: np.empty(self.capacidad, dtype=tipo) for col, tipo in tipos.items()}
+
+    def agregar(self, lote):
+        fin = self.n + len(lote)
+        if fin > self.capacidad:
+            self.capacidad = max(fin, self.capacidad * 2)
+            for col, arr in self.arrays.items():
+                nuevo = np.empty(self.capacidad, dtype=arr.dtype)
+                nuevo[:self.n] = arr[:self.n]
+                self.arrays[col] = nuevo
+        for col, arr in self.arrays.items():
+            arr[self.n:fin] = lote[col].to_numpy(dtype=arr.dtype)
+        self.n = fin
+
+    def a_dataframe(self):
+        datos = {}
+        for col, arr in self.arrays.items():
+            valores = arr[:self.n]
+            # Los NUMBER enteros y sin nulos vuelven a int64, como los dejaba pd.read_sql
+            if valores.dtype == np.float64 and col not in ('LATITUD', 'LONGITUD') \
+                    and not np.isnan(valores).any() and np.array_equal(valores, np.trunc(valores)):
+                valores = valores.astype(np.int64)
+            elif self.n < self.capacidad:
+                valores = valores.copy()
+            datos[col] = valores
+            self.arrays[col] = None # Soltamos el buffer grande apenas tenemos la columna final
+        return pd.DataFrame(datos, copy=False)
+
+
+def leer_consulta_en_lotes(conn, query, params=None, filas_estimadas=0):
+    """Como leer_consulta, pero sin armar nunca la lista completa de filas en memoria:
+    trae el cursor de a FETCH_ARRAYSIZE filas, normaliza cada lote y lo vuelca en buffers
+    columnares (float64 para los NUMBER y las coordenadas, object para el texto)."""
+    with conn.cursor() as cur:
+        cur.arraysize = FETCH_ARRAYSIZE
+        cur.prefetchrows = FETCH_PREFETCHROWS
+        cur.execute(query, params or {})
+        columnas = [col[0].upper() for col in cur.description]
+        tipos = {col[0].upper(): (np.float64 if col[1] == oracledb.DB_TYPE_NUMBER else object) for col in cur.description}
+        if 'LATITUD' in tipos and 'LONGITUD' in tipos:
+            tipos.update({'LATITUD': np.float64, 'LONGITUD': np.float64, 'GEO_VALIDA': np.bool_})
+
+        buffers = BuffersColumnares(tipos, filas_estimadas or FETCH_ARRAYSIZE)
+        while True:
+            filas = cur.fetchmany()
+            if not filas:
+                break
+            lote = pd.DataFrame.from_records(filas, columns=columnas, coerce_float=True)
+            buffers.agregar(normalizar_lote(lote))
+        return buffers.a_dataframe()
+
+
+def leer_consultas_en_paralelo(consultas, filas_estimadas=None):
+    """Corre varias consultas a la vez, cada una con su propia conexión del pool.
+    'consultas' es {nombre: (query, params)}; devuelve {nombre: DataFrame}.
+    El tiempo total pasa a ser el de la consulta más lenta en lugar de la suma."""
+    pool = pool_db()
+    filas_estimadas = filas_estimadas or {}
+
+    def leer(query, params, filas):
+        with pool.acquire() as conn:
+            return leer_consulta_en_lotes(conn, query, params, filas)
+
+    with ThreadPoolExecutor(max_workers=min(len(consultas), POOL_MAX_CONEXIONES)) as ejecutor:
+        futuros = {
+            nombre: ejecutor.submit(leer, query, params, filas_estimadas.get(nombre, 0))
+            for nombre, (query, params) in consultas.items()
+        }
+        return {nombre: futuro.result() for nombre, futuro in futuros.items()}
+
+
+def scn_actual(conn):
+    # Restamos un minuto: TIMESTAMP_TO_SCN es aproximado y preferimos releer algo de más
+    with conn.cursor() as cur:
+        cur.execute("SELECT TIMESTAMP_TO_SCN(SYSTIMESTAMP - INTERVAL '1' MINUTE) FROM dual")
+        return int(cur.fetchone()[0])
+
+
+def mezclar_por_clave(base, nuevos, cambiados, claves, orden):
+    """Quita de 'base' todas las filas cuyas claves aparecen en 'cambiados' y agrega 'nuevos'.
+    Las bajas quedan resueltas solas: cambiaron, pero ya no vuelven en 'nuevos'."""
+    en_base = pd.MultiIndex.from_frame(base[claves])
+    a_quitar = pd.MultiIndex.from_frame(cambiados[claves])
+    mezcla = pd.concat([base[~en_base.isin(a_quitar)], nuevos], ignore_index=True)
+    return mezcla.sort_values(orden, kind='stable', ignore_index=True)
+
+
+def quitar_bajas(df, vigentes, claves):
+    """Filas de 'df' cuyas claves siguen en 'vigentes' (las borradas en la base no cambian,
+    desaparecen) y cuántas se quitaron."""
+    sigue = pd.MultiIndex.from_frame(df[claves]).isin(pd.MultiIndex.from_frame(vigentes[claves]))
+    return df[sigue].reset_index(drop=True), int((~sigue).sum())
+
+
+def completa_vencida(manifiesto):
+    ultima = manifiesto.get('ultima_completa')
+    return ultima is None or (datetime.now() - datetime.fromisoformat(ultima)).total_seconds() > RECARGA_COMPLETA_SEG
+
+
+def leer_manifiesto():
+    ruta = SNAPSHOT_DIR / "manifest.json"
+    if not ruta.exists():
+        return None
+    return json.loads(ruta.read_text(encoding="utf-8"))
+
+
+def antiguedad_snapshot(manifiesto):
+    return (datetime.now() - datetime.fromisoformat(manifiesto['cargado_en'])).total_seconds()
+
+
+def leer_snapshot(perfil=None):
+    perfil = perfil or Perfil("carga")
+    df_afi = pd.read_parquet(SNAPSHOT_DIR / "afiliados.parquet")
+    df_cons = pd.read_parquet(SNAPSHOT_DIR / "consultorios.parquet")
+    perfil.marcar("leer_snapshot", len(df_afi) + len(df_cons))
+    return df_afi, df_cons
+
+
+def guardar_snapshot(df_afi, df_cons, manifiesto):
+    # Escribimos a temporales y renombramos, así un corte a mitad de camino no deja archivos rotos.
+    # El manifiesto va último: si no llegó a escribirse, la próxima carga vuelve a pedir el delta.
+    SNAPSHOT_DIR.mkdir(exist_ok=True)
+    for nombre, df in [("afiliados", df_afi), ("consultorios", df_cons)]:
+        tmp = SNAPSHOT_DIR / f"{nombre}.parquet.tmp"
+        df.to_parquet(tmp, index=False)
+        os.replace(tmp, SNAPSHOT_DIR / f"{nombre}.parquet")
+    tmp = SNAPSHOT_DIR / "manifest.json.tmp"
+    tmp.write_text(json.dumps(manifiesto, indent=2), encoding="utf-8")
+    os.replace(tmp, SNAPSHOT_DIR / "manifest.json")
+
+
+def actualizar_snapshot(completa=False, perfil=None):
+    """Trae de Oracle solo lo que cambió desde la última carga y lo mezcla con el snapshot,
+    quitando lo que se borró. Si no hay snapshot, cambió la variante de la consulta, pasó
+    RECARGA_COMPLETA_SEG desde la última completa o se pide 'completa', trae todo."""
+    perfil = perfil or Perfil("carga")
+    manifiesto = leer_manifiesto()
+    query_afi = QUERIES_AFILIADOS[MODO_EXTRACCION_AFILIADOS]
+    completa = completa or manifiesto is None or manifiesto.get('modo_extraccion') != MODO_EXTRACCION_AFILIADOS \
+        or manifiesto.get('formato') != FORMATO_SNAPSHOT or completa_vencida(manifiesto)
+
+    inicio = time.perf_counter()
+    with pool_db().acquire() as conn:
+        scn = scn_actual(conn)
+    perfil.marcar("oracle_scn")
+
+    if completa:
+        # Con la cantidad de filas de la carga anterior los buffers casi nunca tienen que crecer
+        previas = manifiesto or {}
+        datos = leer_consultas_en_paralelo({
+            "afiliados": (query_afi, None),
+            "consultorios": (QUERY_CONSULTORIOS, None),
+        }, filas_estimadas={
+            "afiliados": int(previas.get('filas_afiliados', 0) * 1.05),
+            "consultorios": int(previas.get('filas_consultorios', 0) * 1.05),
+        })
+        df_afi, df_cons = datos["afiliados"], datos["consultorios"]
+        cambios_afi, cambios_cons = len(df_afi), len(df_cons)
+        bajas_afi = bajas_cons = 0
+        perfil.marcar("oracle_completa", len(df_afi) + len(df_cons))
+    else:
+        params = {"scn": manifiesto['scn']}
+        df_afi, df_cons = leer_snapshot(perfil)
+        datos = leer_consultas_en_paralelo({
+            "ids_afi": (QUERY_AFILIADOS_CAMBIADOS, params),
+            "nuevos_afi": (f"SELECT * FROM ({query_afi}) q WHERE q.AFI_ID IN ({QUERY_AFILIADOS_CAMBIADOS})", params),
+            "claves_cons": (QUERY_CONSULTORIOS_CAMBIADOS, params),
+            "nuevos_cons": (f"SELECT * FROM ({QUERY_CONSULTORIOS}) q WHERE (q.PRES_EFE_CODIGO, q.SECUENCIA) IN ({QUERY_CONSULTORIOS_CAMBIADOS})", params),
+            "vigentes_afi": (QUERY_AFILIADOS_VIGENTES, None),
+            "vigentes_cons": (QUERY_CONSULTORIOS_VIGENTES, None),
+        }, filas_estimadas={
+            "vigentes_afi": manifiesto.get('filas_afiliados', 0),
+            "vigentes_cons": manifiesto.get('filas_consultorios', 0),
+        })
+        perfil.marcar("oracle_delta", sum(len(df) for df in datos.values()))
+        df_afi = mezclar_por_clave(df_afi, datos["nuevos_afi"], datos["ids_afi"], ['AFI_ID'], ['APELLIDOS', 'NOMBRES'])
+        df_cons = mezclar_por_clave(df_cons, datos["nuevos_cons"], datos["claves_cons"], ['PRES_EFE_CODIGO', 'SECUENCIA'], ['PRES_EFE_CODIGO', 'SECUENCIA'])
+        # Un alta posterior a la lectura de vigentes se quitaría acá, pero su ORA_ROWSCN es mayor que
+        # el SCN de esta carga y vuelve en el próximo delta
+        df_afi, bajas_afi = quitar_bajas(df_afi, datos["vigentes_afi"], ['AFI_ID'])
+        df_cons, bajas_cons = quitar_bajas(df_cons, datos["vigentes_cons"], ['PRES_EFE_CODIGO', 'SECUENCIA'])
+        cambios_afi, cambios_cons = len(datos["ids_afi"]), len(datos["claves_cons"])
+        perfil.marcar("mezcla", cambios_afi + cambios_cons + bajas_afi + bajas_cons)
+
+    ahora = datetime.now().isoformat(timespec='seconds')
+    guardar_snapshot(df_afi, df_cons, {
+        "cargado_en": ahora,
+        "formato": FORMATO_SNAPSHOT,
+        "scn": scn,
+        "tipo": "completa" if completa else "delta",
+        "ultima_completa": ahora if completa else manifiesto.get('ultima_completa'),
+        "modo_extraccion": MODO_EXTRACCION_AFILIADOS,
+        "filas_afiliados": len(df_afi),
+        "filas_consultorios": len(df_cons),
+        "cambios_afiliados": cambios_afi,
+        "cambios_consultorios": cambios_cons,
+        "bajas_afiliados": bajas_afi,
+        "bajas_consultorios": bajas_cons,
+        "segundos_base": round(time.perf_counter() - inicio, 1),
+    })
+    perfil.marcar("guardar_snapshot", len(df_afi) + len(df_cons))
+
+
+def snapshot_vigente(manifiesto):
+    # Existe y es del formato actual (puede estar vencido)
+    return manifiesto is not None and manifiesto.get('formato') == FORMATO_SNAPSHOT
+
+
+def snapshot_vencido(manifiesto):
+    return not snapshot_vigente(manifiesto) or antiguedad_snapshot(manifiesto) > SNAPSHOT_TTL_SEG
+
+
+# --- DISTANCIAS GEODÉSICAS ---
+# Antes se medía la distancia euclídea en grados y se multiplicaba por 111,13. Eso exagera las
+# distancias este-oeste (un grado de longitud a 35° S son ~91 km, no 111) y el "más cercano"
+# podía ser otro consultorio. Ahora los puntos se indexan como vectores unitarios 3D: el vecino
+# más cercano por cuerda es el más cercano sobre la esfera, y la cuerda se pasa a km de arco.
+
+RADIO_TIERRA_KM = 6371.0088
+COBERTURA_RADIO_KM = 10 # Radio para contar consultorios "cercanos" a cada afiliado
+KDTREE_HILOS = -1 # Hilos por consulta al árbol (-1 = todos los núcleos; el reporte en paralelo usa 1 por proceso)
+
+
+def a_vectores_unitarios(lat, lon):
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)))
+
+
+def cuerda_a_km(cuerda):
+    # cKDTree devuelve inf cuando pedimos más vecinos de los que hay: lo respetamos
+    cuerda = np.asarray(cuerda, dtype=np.float64)
+    km = 2 * RADIO_TIERRA_KM * np.arcsin(np.clip(cuerda / 2, 0, 1))
+    return np.where(np.isinf(cuerda), np.inf, km)
+
+
+def km_a_cuerda(km):
+    return 2 * np.sin(np.asarray(km, dtype=np.float64) / (2 * RADIO_TIERRA_KM))
+
+
+def puntos_unicos(lat, lon):
+    """Coordenadas distintas y, para cada fila original, cuál le corresponde. Muchos afiliados
+    comparten punto (mismo domicilio o centroide de la localidad): se consulta cada uno una vez."""
+    puntos, inversa = np.unique(np.column_stack((lat, lon)).astype(np.float64), axis=0, return_inverse=True)
+    return puntos[:, 0], puntos[:, 1], inversa.ravel()
+
+
+class IndiceGeodesico:
+    """KD-tree sobre vectores unitarios. Las consultas usan KDTREE_HILOS hilos (todos los núcleos)."""
+
+    def __init__(self, lat, lon):
+        self.tree = cKDTree(a_vectores_unitarios(lat, lon))
+
+    def mas_cercanos(self, lat, lon, k=1):
+        """Distancia en km de arco e índice de los k puntos más cercanos a cada consulta."""
+        cuerda, indices = self.tree.query(a_vectores_unitarios(lat, lon), k=k, workers=KDTREE_HILOS)
+        return cuerda_a_km(cuerda), indices
+
+    def contar_en_radio(self, lat, lon, radio_km):
+        """Cuántos puntos del índice quedan a <= radio_km de cada consulta."""
+        return self.tree.query_ball_point(a_vectores_unitarios(lat, lon), r=km_a_cuerda(radio_km),
+                                          workers=KDTREE_HILOS, return_length=True)
+
+    @property
+    def nbytes(self):
+        # Copia de los puntos más índices y nodos del árbol: ~3 veces los vectores
+        return self.tree.data.nbytes * 3
+
+
+def distancia_mas_cercano(lat, lon, indice):
+    """Distancia en km (float32) de cada punto al más cercano del índice, consultando una sola
+    vez cada coordenada repetida."""
+    lat_u, lon_u, inversa = puntos_unicos(lat, lon)
+    dist, _ = indice.mas_cercanos(lat_u, lon_u, k=1)
+    return dist.astype(np.float32)[inversa]
 
-st.title("📍 Tablero de Gestión de Cobertura Sanitaria", anchor=False)
 
-# --- SECCIÓN DE AYUDA / MANUAL ---
-with st.expander("❓ ¿Cómo usar este tablero y qué significan las métricas?"):
-    st.subheader("📖 Guía de Usuario", anchor=False)
+def cobertura_puntos(lat_afi, lon_afi, lat_cons, lon_cons, radio_km=COBERTURA_RADIO_KM):
+    """Para cada afiliado, la distancia en km al consultorio más cercano y cuántos hay a
+    <= radio_km, con un solo árbol y sin cachés ni DataFrames (es lo que corre en cada proceso
+    del reporte nocturno). Sin consultorios, las distancias son None y los conteos 0."""
+    if len(lat_cons) == 0:
+        return None, np.zeros(len(lat_afi), dtype=np.int32)
+    indice = IndiceGeodesico(lat_cons, lon_cons)
+    lat_u, lon_u, inversa = puntos_unicos(lat_afi, lon_afi)
+    dist, _ = indice.mas_cercanos(lat_u, lon_u, k=1)
+    conteos = indice.contar_en_radio(lat_u, lon_u, radio_km)
+    return dist.astype(np.float32)[inversa], conteos.astype(np.int32)[inversa]
 
-    st.markdown("""
-    Este tablero permite analizar la relación geográfica entre nuestros **afiliados** y los **consultorios** disponibles.
-    
-    * **Filtros:** Utilice el panel izquierdo para segmentar por provincia o ajustar el rango de distancia. 
-    * **Tipos de Vista:** 
-        * **Marcadores:** Muestra puntos exactos. El tamaño del círculo depende de la cantidad de afiliados. Los puntos rojos indican localidades que tienen afiliados pero **0 consultorios** localizados y los puntos grises
-        representan localidades que tienen consultorios pero ningún afiliado encontrado.
-        * **Heatmap:** Muestra la densidad poblacional. Las zonas rojas son las de mayor concentración.
-    """)
-    
-    st.subheader("📊 Glosario de Métricas", anchor=False)
 
-    st.markdown("""
-    * **Éxito Geo:** Porcentaje de registros que tenían coordenadas válidas dentro de Argentina y pudieron ser mapeados.
-    * **Distancia Media:** Es el promedio de kilómetros que deben recorrer los afiliados para llegar al consultorio más cercano.
-    * **Cons./Afiliados:** Indica cuántos consultorios hay disponibles por cada afiliado en esa localidad.
-    """)
+# --- 2. PROCESAMIENTO DE DATOS ---
 
-try:
+# Texto muy repetido que pasa a categoría (diccionario de valores + códigos enteros)
+COLUMNAS_CATEGORICAS = [
+    'APELLIDOS', 'NOMBRES', 'NOMBRE', 'CODIGOPOST', 'CODIGO_POSTAL', 'BARRIO', 'PAIS',
+    'COD_ESP', 'ESPECIALIDAD', 'AGRUPACION_PRESTADOR', 'DESC_AGRUP_PRESTADOR',
+    'CLASE_EFECTOR', 'DESC_CLASE_EFECTOR', 'AGRUPACION_EFECTOR', 'DESC_AGRUPACION_EFECTOR',
+    'TIPO_EFECTOR', 'DESC_TIPO_EFECTOR', 'CATEGORIA_EFECTOR', 'DESC_CATEGORIA_EFECTOR',
+    'ESTADOPREST', 'ESTADOCONS', 'ESTADOEFECTOR',
+]
+# Estas comparten categorías entre afiliados y consultorios: el mismo código significa
+# la misma localidad en ambos y los merge por LOCALIDAD/PROVINCIA no pierden el tipo
+COLUMNAS_GEO_COMPARTIDAS = ['LOCALIDAD', 'PROVINCIA']
+COLUMNAS_ID = ['AFI_ID', 'SECUENCIA', 'DOMIAFI_ID', 'DOMICONS_ID']
+
+
+def filtrar_geo(df):
+    return df[df['GEO_VALIDA']].copy()
+
+
+def compactar_datos(df_afi, df_cons, otros_geo=None):
+    """Esquema compacto para lo que queda en memoria: texto como categoría, coordenadas
+    float32, IDs enteros del menor tamaño posible y la marca es_farmacia calculada una vez.
+    Las localidades y provincias de 'otros_geo' (si se pasa) también entran en las categorías."""
+    cambios = {"afi": {}, "cons": {}}
+    for col in COLUMNAS_GEO_COMPARTIDAS:
+        valores = set(df_afi[col].dropna()) | set(df_cons[col].dropna())
+        if otros_geo is not None:
+            valores |= set(otros_geo[col].dropna())
+        categorias = pd.CategoricalDtype(sorted(valores))
+        cambios["afi"][col] = df_afi[col].astype(categorias)
+        cambios["cons"][col] = df_cons[col].astype(categorias)
+
+    for clave, df in [("afi", df_afi), ("cons", df_cons)]:
+        for col in COLUMNAS_CATEGORICAS:
+            if col in df.columns and not pd.api.types.is_numeric_dtype(df[col]):
+                cambios[clave][col] = df[col].astype('category')
+        for col in COLUMNAS_ID:
+            if col in df.columns and pd.api.types.is_integer_dtype(df[col]):
+                cambios[clave][col] = pd.to_numeric(df[col], downcast='integer')
+        cambios[clave]['LATITUD'] = df['LATITUD'].astype(np.float32)
+        cambios[clave]['LONGITUD'] = df['LONGITUD'].astype(np.float32)
+
+    df_afi = df_afi.assign(**cambios["afi"])
+    df_cons = df_cons.assign(**cambios["cons"])
+    df_cons['es_farmacia'] = mascara_igual(df_cons['DESC_TIPO_EFECTOR'], 'FARMACIA')
+    return df_afi, df_cons
+
+
+def mascara_igual(serie, valor):
+    """Equivalente a serie == valor para columnas categóricas, pero comparando el código
+    entero de la categoría en lugar de strings fila por fila."""
+    categorias = serie.cat.categories
+    if valor not in categorias:
+        return np.zeros(len(serie), dtype=bool)
+    return serie.cat.codes.to_numpy() == categorias.get_loc(valor)
+
+
+def descompactar(df):
+    """Devuelve un frame compacto con los tipos de antes (object y 64 bits), para comparar."""
+    tipos = {}
+    for col, tipo in df.dtypes.items():
+        if isinstance(tipo, pd.CategoricalDtype):
+            tipos[col] = object
+        elif pd.api.types.is_float_dtype(tipo):
+            tipos[col] = np.float64
+        elif pd.api.types.is_integer_dtype(tipo):
+            tipos[col] = np.int64
+    return df.astype(tipos)
+
+
+# Columnas que agrega la carga y no vienen de la base
+COLUMNAS_AUXILIARES = ['GEO_VALIDA', 'es_farmacia']
+
+
+def registros_originales(df):
+    """Filas de un frame compacto como vinieron de la base, para las descargas de auditoría:
+    tipos de antes, sin las columnas auxiliares, y cada coordenada float32 con su decimal más
+    corto (-34.60372 y no -34.60372161865234 al pasarla a float64)."""
+    coordenadas = {col: df[col].astype(str).astype(np.float64) for col in ['LATITUD', 'LONGITUD'] if col in df.columns}
+    df = df.drop(columns=[col for col in COLUMNAS_AUXILIARES if col in df.columns])
+    return descompactar(df).assign(**coordenadas)
+
+
+def comparar_representacion(frames, prov, esp, repeticiones=20):
+    """Memoria de los cuatro frames y tiempo de los filtros de igualdad de la cadena de
+    filtros, con el esquema compacto contra el de antes (strings object y float64)."""
+    anteriores = {nombre: descompactar(df) for nombre, df in frames.items()}
+
+    def filtros_strings():
+        afi, cons = anteriores['afi_geo_all'], anteriores['cons_geo_all']
+        medicos = cons[cons['DESC_TIPO_EFECTOR'] != 'FARMACIA']
+        medicos = medicos[medicos['ESPECIALIDAD'] == esp]
+        return afi[afi['PROVINCIA'] == prov], medicos[medicos['PROVINCIA'] == prov]
+
+    def filtros_codigos():
+        afi, cons = frames['afi_geo_all'], frames['cons_geo_all']
+        medicos = cons[~cons['es_farmacia']]
+        medicos = medicos[mascara_igual(medicos['ESPECIALIDAD'], esp)]
+        return afi[mascara_igual(afi['PROVINCIA'], prov)], medicos[mascara_igual(medicos['PROVINCIA'], prov)]
+
+    def ms_promedio(funcion):
+        inicio = time.perf_counter()
+        for _ in range(repeticiones):
+            funcion()
+        return round((time.perf_counter() - inicio) / repeticiones * 1000, 2)
+
+    def mb(dfs):
+        return round(sum(df.memory_usage(deep=True).sum() for df in dfs) / 2**20, 1)
+
+    return {
+        "memoria_mb": {"anterior": mb(anteriores.values()), "compacta": mb(frames.values())},
+        "filtros_ms": {"anterior": ms_promedio(filtros_strings), "compacta": ms_promedio(filtros_codigos)},
+        "filtro_usado": {"provincia": prov, "especialidad": esp},
+    }
+
+
+def _leer_status_kb(campo):
+    try:
+        with open("/proc/self/status") as f:
+            for linea in f:
+                if linea.startswith(campo + ":"):
+                    return int(linea.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def medir_pico_rss(funcion):
+    """Ejecuta 'funcion' y devuelve (segundos, MB de pico de RSS por encima del RSS inicial).
+    Solo en Linux: el pico (VmHWM) se reinicia escribiendo 5 en /proc/self/clear_refs."""
+    gc.collect()
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return None, None
+    base = _leer_status_kb("VmRSS")
+    inicio = time.perf_counter()
+    resultado = funcion()
+    segundos = time.perf_counter() - inicio
+    pico = _leer_status_kb("VmHWM")
+    del resultado
+    gc.collect()
+    return segundos, (pico - base) / 1024
+
+
+def comparar_memoria_carga():
+    """Pico de memoria y tiempo de traer y limpiar los afiliados con el camino anterior
+    (todo el resultado en memoria y después normalizar) contra la carga en lotes."""
+    query = QUERIES_AFILIADOS[MODO_EXTRACCION_AFILIADOS]
+    manifiesto = leer_manifiesto() or {}
+
+    def camino_anterior():
+        with pool_db().acquire() as conn:
+            df = leer_consulta(conn, query)
+        df['LOCALIDAD'] = df['LOCALIDAD'].astype(str).str.strip().str.upper()
+        df['PROVINCIA'] = df['PROVINCIA'].astype(str).str.strip().str.upper().fillna("SIN DATO")
+        df['LATITUD'] = pd.to_numeric(df['LATITUD'], errors='coerce')
+        df['LONGITUD'] = pd.to_numeric(df['LONGITUD'], errors='coerce')
+        df = df.dropna(subset=['LATITUD', 'LONGITUD'])
+        mask = (df['LATITUD'].between(LAT_MIN, LAT_MAX)) & (df['LONGITUD'].between(LON_MIN, LON_MAX))
+        return df[mask].copy()
+
+    def camino_en_lotes():
+        with pool_db().acquire() as conn:
+            df = leer_consulta_en_lotes(conn, query, filas_estimadas=manifiesto.get('filas_afiliados', 0))
+        return filtrar_geo(df)
+
+    resultados = {}
+    for nombre, funcion in [("anterior", camino_anterior), ("en_lotes", camino_en_lotes)]:
+        segundos, pico_mb = medir_pico_rss(funcion)
+        resultados[nombre] = {
+            "segundos": None if segundos is None else round(segundos, 1),
+            "pico_rss_mb": None if pico_mb is None else round(pico_mb, 1),
+        }
+    return resultados
+
+
+# --- PERFILADO POR ETAPA ---
+# Tiempo, filas y memoria de cada etapa de la carga de datos y de cada rerun. Cuesta un
+# perf_counter y una lectura de /proc por etapa, así que está siempre activo.
+
+PERFILES_RERUN_GUARDADOS = 200 # Reruns recientes (de todas las sesiones) para el resumen del panel
+PERFILES_PROMETHEUS_ARCHIVO = None # Ruta .prom para el textfile collector de node_exporter (None = no se escribe)
+
+
+class Perfil:
+    """Etapas de una carga, un rerun o un rerun de un fragmento, como un cronómetro de vueltas:
+    cada marcar() cierra la etapa que venía corriendo desde la marca anterior (o desde que se
+    creó el perfil). 'interaccion' es el widget que disparó el rerun, si se sabe.
+    La memoria es la diferencia de RSS del proceso: con varias sesiones a la vez es orientativa."""
+
+    def __init__(self, tipo, interaccion=None):
+        self.tipo = tipo
+        self.interaccion = interaccion
+        self.fecha = datetime.now().isoformat(timespec='seconds')
+        self.etapas = []
+        self.registrado = False
+        self._inicio, self._rss = time.perf_counter(), _leer_status_kb("VmRSS")
+
+    def marcar(self, etapa, filas=None):
+        ahora, rss = time.perf_counter(), _leer_status_kb("VmRSS")
+        self.etapas.append({
+            "etapa": etapa,
+            "segundos": round(ahora - self._inicio, 4),
+            "filas": None if filas is None else int(filas),
+            "rss_delta_mb": None if rss is None or self._rss is None else round((rss - self._rss) / 1024, 1),
+        })
+        self._inicio, self._rss = ahora, rss
+
+    def a_dict(self):
+        return {
+            "tipo": self.tipo,
+            "interaccion": self.interaccion,
+            "fecha": self.fecha,
+            "segundos": round(sum(e["segundos"] for e in self.etapas), 4),
+            "rss_mb": None if self._rss is None else round(self._rss / 1024, 1),
+            "etapas": self.etapas,
+        }
 
-    afi_base, df_cons_raw, afi_geo_all, cons_geo_all = cargar_y_procesar_datos()
 
+@st.cache_resource
+def perfiles():
+    # Compartido por todas las sesiones: la última carga, los últimos reruns y acumulados por etapa
+    return {"carga": None, "reruns": deque(maxlen=PERFILES_RERUN_GUARDADOS), "totales": {}, "interacciones": {}, "lock": threading.Lock()}
+
+
+def registrar_perfil(perfil):
+    registro = perfiles()
+    perfil.registrado = True
+    datos = perfil.a_dict()
+    with registro["lock"]:
+        if perfil.tipo == "carga":
+            registro["carga"] = datos
+        else:
+            registro["reruns"].append(datos)
+            total = registro["interacciones"].setdefault((perfil.tipo, perfil.interaccion), {"ejecuciones": 0, "segundos": 0.0})
+            total["ejecuciones"] += 1
+            total["segundos"] += datos["segundos"]
+        for etapa in perfil.etapas:
+            total = registro["totales"].setdefault((perfil.tipo, etapa["etapa"]), {"ejecuciones": 0, "segundos": 0.0})
+            total["ejecuciones"] += 1
+            total["segundos"] += etapa["segundos"]
+    if PERFILES_PROMETHEUS_ARCHIVO:
+        ruta = Path(PERFILES_PROMETHEUS_ARCHIVO)
+        tmp = ruta.with_name(ruta.name + ".tmp") # El collector no tiene que ver nunca un archivo a medias
+        tmp.write_text(perfiles_prometheus(), encoding="utf-8")
+        os.replace(tmp, ruta)
+    return datos
+
+
+def perfiles_json():
+    registro = perfiles()
+    with registro["lock"]:
+        return json.dumps({
+            "carga": registro["carga"],
+            "reruns": list(registro["reruns"]),
+            "totales": [{"tipo": tipo, "etapa": etapa, **total} for (tipo, etapa), total in registro["totales"].items()],
+            "interacciones": [{"tipo": tipo, "interaccion": interaccion, **total} for (tipo, interaccion), total in registro["interacciones"].items()],
+        }, indent=2, ensure_ascii=False)
+
+
+def perfiles_prometheus():
+    """Formato de texto de Prometheus: acumulados por etapa desde que arrancó el proceso
+    (contadores), la última carga de datos etapa por etapa y el RSS actual (gauges)."""
+    registro = perfiles()
+    with registro["lock"]:
+        totales = dict(registro["totales"])
+        interacciones = dict(registro["interacciones"])
+        carga = registro["carga"]
+    lineas = [
+        "# HELP cobertura_etapa_segundos_total Tiempo acumulado en cada etapa desde que arranco el proceso.",
+        "# TYPE cobertura_etapa_segundos_total counter",
+        *[f'cobertura_etapa_segundos_total{{tipo="{tipo}",etapa="{etapa}"}} {total["segundos"]:.4f}' for (tipo, etapa), total in totales.items()],
+        "# HELP cobertura_etapa_ejecuciones_total Veces que corrio cada etapa desde que arranco el proceso.",
+        "# TYPE cobertura_etapa_ejecuciones_total counter",
+        *[f'cobertura_etapa_ejecuciones_total{{tipo="{tipo}",etapa="{etapa}"}} {total["ejecuciones"]}' for (tipo, etapa), total in totales.items()],
+        "# HELP cobertura_interaccion_segundos_total Tiempo acumulado de los reruns (completos o de un fragmento) por interaccion.",
+        "# TYPE cobertura_interaccion_segundos_total counter",
+        *[f'cobertura_interaccion_segundos_total{{tipo="{tipo}",interaccion="{interaccion}"}} {total["segundos"]:.4f}' for (tipo, interaccion), total in interacciones.items()],
+        "# HELP cobertura_interaccion_reruns_total Reruns (completos o de un fragmento) por interaccion.",
+        "# TYPE cobertura_interaccion_reruns_total counter",
+        *[f'cobertura_interaccion_reruns_total{{tipo="{tipo}",interaccion="{interaccion}"}} {total["ejecuciones"]}' for (tipo, interaccion), total in interacciones.items()],
+    ]
+    if carga:
+        lineas += ["# HELP cobertura_ultima_carga_segundos Duracion de cada etapa en la ultima carga de datos.",
+                   "# TYPE cobertura_ultima_carga_segundos gauge"]
+        lineas += [f'cobertura_ultima_carga_segundos{{etapa="{e["etapa"]}"}} {e["segundos"]}' for e in carga["etapas"]]
+        lineas += ["# HELP cobertura_ultima_carga_filas Filas procesadas en cada etapa de la ultima carga de datos.",
+                   "# TYPE cobertura_ultima_carga_filas gauge"]
+        lineas += [f'cobertura_ultima_carga_filas{{etapa="{e["etapa"]}"}} {e["filas"]}' for e in carga["etapas"] if e["filas"] is not None]
+    rss = _leer_status_kb("VmRSS")
+    if rss is not None:
+        lineas += ["# HELP cobertura_proceso_rss_bytes Memoria residente del proceso.",
+                   "# TYPE cobertura_proceso_rss_bytes gauge",
+                   f"cobertura_proceso_rss_bytes {rss * 1024}"]
+    return "\n".join(lineas) + "\n"
+
+
+def _latencias_ms(grupos):
+    resumen = grupos.agg(reruns='count', media_ms='mean', p95_ms=lambda s: s.quantile(0.95), max_ms='max')
+    resumen[['media_ms', 'p95_ms', 'max_ms']] = (resumen[['media_ms', 'p95_ms', 'max_ms']] * 1000).round(1)
+    return resumen
+
+
+def resumen_reruns():
+    """Sobre los reruns recientes de todas las sesiones: latencia por interacción (rerun
+    completo o solo de un fragmento) y por etapa, en el orden en que corren."""
+    registro = perfiles()
+    with registro["lock"]:
+        reruns = list(registro["reruns"])
+    if not reruns:
+        return None, None
+    por_rerun = pd.DataFrame([{"interaccion": r["interaccion"], "tipo": r["tipo"], "segundos": r["segundos"]} for r in reruns])
+    por_interaccion = _latencias_ms(por_rerun.groupby(['interaccion', 'tipo'], dropna=False)['segundos'])
+    etapas = pd.DataFrame([e for r in reruns for e in r["etapas"]])
+    por_etapa = _latencias_ms(etapas.groupby('etapa', sort=False)['segundos'])
+    return por_interaccion.sort_values('media_ms', ascending=False), por_etapa
+
+
+def perfil_fragmento(perfil, nombre):
+    """Perfil donde mide un fragmento. Dentro de un rerun completo es el de ese rerun; si corre
+    solo (se tocó algo adentro del fragmento), aquel ya se registró y arma uno propio."""
+    if perfil.registrado:
+        return Perfil("fragmento", interaccion=st.session_state.pop('interaccion', nombre))
+    return perfil
+
+
+def cerrar_perfil_fragmento(perfil):
+    if perfil.tipo == "fragmento":
+        st.session_state.perfil_rerun = registrar_perfil(perfil)
+
+
+def procesar_datos(df_afi_raw, df_cons_raw, version, perfil=None, otros_geo=None):
+    """De afiliados y consultorios tal como vienen de la base (ya normalizados: texto en
+    mayúsculas, coordenadas numéricas y GEO_VALIDA) a los cuatro DataFrames del tablero:
+    base de afiliados, base de consultorios, y los mapeados de cada uno.
+    'otros_geo' se pasa a compactar_datos (totales por localidad de la carga por provincia)."""
+    perfil = perfil or Perfil("carga")
+
+    # Filtro de País en Consultorios
+    if 'PAIS' in df_cons_raw.columns:
+        df_cons_raw = df_cons_raw[df_cons_raw['PAIS'].astype(str).str.upper() == 'ARGENTINA']
+    perfil.marcar("filtro_pais", len(df_cons_raw))
+
+    # Esquema compacto: todo lo que sigue (y los filtros de la interfaz) trabaja sobre esto
+    df_afi_raw, df_cons_raw = compactar_datos(df_afi_raw, df_cons_raw, otros_geo)
+    perfil.marcar("compactar", len(df_afi_raw) + len(df_cons_raw))
+
+    # Deduplicación y Filtro Geográfico
+    df_afi_clean = df_afi_raw.drop_duplicates(subset=['AFI_ID', 'CALLE', 'NUMERO'])
+    perfil.marcar("deduplicar", len(df_afi_clean))
+
+    df_mapa_afi = filtrar_geo(df_afi_clean)
+    df_mapa_cons = filtrar_geo(df_cons_raw)
+    perfil.marcar("filtrar_geo", len(df_mapa_afi) + len(df_mapa_cons))
+
+    # SEPARACIÓN LÓGICA
+    # Filtramos solo lo que NO es farmacia para cálculos médicos
+    cons_geo_only = df_mapa_cons[~df_mapa_cons['es_farmacia']]
+
+    # B. Cálculo de Distancias
+    # Usamos 'cons_geo_only' para el árbol de distancias
+    indice = IndiceGeodesico(cons_geo_only['LATITUD'], cons_geo_only['LONGITUD'])
+    perfil.marcar("kdtree", len(cons_geo_only))
+    df_mapa_afi['distancia_km'] = distancia_mas_cercano(df_mapa_afi['LATITUD'], df_mapa_afi['LONGITUD'], indice)
+    perfil.marcar("distancias", len(df_mapa_afi))
+
+    # Identifica esta carga: las cachés del proceso la usan para no mezclar datos viejos y nuevos
+    for df in (df_afi_clean, df_cons_raw, df_mapa_afi, df_mapa_cons):
+        df.attrs['version_datos'] = version
+
+    return df_afi_clean, df_cons_raw, df_mapa_afi, df_mapa_cons
+
+
+# --- ALMACÉN COMPARTIDO ---
+# Una carpeta por versión de los datos con un .arrow (IPC sin comprimir) por DataFrame, y un
+# puntero actual.json que se cambia de una vez al terminar de escribir. Mapear un .arrow no copia
+# nada: números, texto y códigos de las categorías quedan como vistas sobre el archivo (las
+# columnas bool sí se copian, Arrow las guarda de a bit). Se conservan la versión actual y la
+# anterior; borrar una que otro proceso todavía tiene mapeada no le afecta (Linux).
+
+NOMBRES_ALMACEN = ("afi_base", "cons_base", "afi_geo", "cons_geo")
+
+
+@contextmanager
+def lock_carga(esperar=False, nombre="carga"):
+    """Lock entre procesos (flock) para traer de la base, procesar y publicar. Da True si se
+    tomó; sin 'esperar', False si lo tiene otro proceso. Si el proceso muere se suelta solo.
+    Con otro 'nombre' es otro lock (otro archivo), para trabajos que no tienen que esperar a la carga."""
+    ALMACEN_DIR.mkdir(parents=True, exist_ok=True)
+    with open(ALMACEN_DIR / f"{nombre}.lock", "a") as archivo:
+        if fcntl is None:
+            yield True
+            return
+        try:
+            fcntl.flock(archivo, fcntl.LOCK_EX if esperar else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(archivo, fcntl.LOCK_UN)
+
+
+def leer_puntero_almacen():
+    ruta = ALMACEN_DIR / "actual.json"
+    if not ALMACEN_COMPARTIDO or not ruta.exists():
+        return None
+    return json.loads(ruta.read_text(encoding="utf-8"))
+
+
+def publicar_almacen(datos, version):
+    """Escribe los cuatro DataFrames de procesar_datos en una carpeta nueva y recién al final
+    cambia el puntero: ningún proceso ve una versión a medias."""
+    anterior = leer_puntero_almacen()
+    carpeta = ALMACEN_DIR / version.replace(":", "-")
+    tmp = carpeta.with_name(f"{carpeta.name}.{os.getpid()}.tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    for nombre, df in zip(NOMBRES_ALMACEN, datos):
+        tabla = pa.Table.from_pandas(df, preserve_index=True)
+        # Como large_string pandas lee el texto sin copiarlo; como string lo convertiría
+        esquema = pa.schema([campo.with_type(pa.large_string()) if campo.type == pa.string() else campo
+                             for campo in tabla.schema], metadata=tabla.schema.metadata)
+        with pa.ipc.new_file(tmp / f"{nombre}.arrow", esquema) as escritor:
+            escritor.write_table(tabla.cast(esquema))
+    shutil.rmtree(carpeta, ignore_errors=True)
+    os.replace(tmp, carpeta)
+
+    puntero = {"version": version, "carpeta": carpeta.name, "publicado_en": datetime.now().isoformat(timespec='seconds'),
+               "mb": round(sum(f.stat().st_size for f in carpeta.iterdir()) / 2**20, 1)}
+    ruta_tmp = ALMACEN_DIR / "actual.json.tmp"
+    ruta_tmp.write_text(json.dumps(puntero, indent=2), encoding="utf-8")
+    os.replace(ruta_tmp, ALMACEN_DIR / "actual.json")
+
+    conservar = {carpeta.name, anterior and anterior['carpeta']}
+    for vieja in ALMACEN_DIR.iterdir():
+        if vieja.is_dir() and vieja.name not in conservar and not vieja.name.endswith(".tmp"):
+            shutil.rmtree(vieja, ignore_errors=True)
+    return puntero
+
+
+def abrir_almacen(puntero):
+    """Los cuatro DataFrames de la versión del puntero, mapeados en memoria y de solo lectura."""
+    datos = []
+    for nombre in NOMBRES_ALMACEN:
+        tabla = pa.ipc.open_file(pa.memory_map(str(ALMACEN_DIR / puntero['carpeta'] / f"{nombre}.arrow"))).read_all()
+        # split_blocks: cada columna queda como vista sobre el archivo, sin juntarlas en un bloque nuevo
+        df = tabla.to_pandas(split_blocks=True)
+        df.attrs['version_datos'] = puntero['version']
+        df.attrs['almacen'] = True
+        datos.append(df)
+    return tuple(datos)
+
+
+def compartir(datos, version):
+    """Con el almacén activado publica 'datos' y devuelve la versión mapeada, para que este
+    proceso tampoco se quede con una copia propia. Sin almacén devuelve 'datos' tal cual."""
+    if not ALMACEN_COMPARTIDO:
+        return datos
+    return abrir_almacen(publicar_almacen(datos, version))
+
+
+# --- CARGA EN SEGUNDO PLANO ---
+# El tablero siempre se dibuja con el último dataset bueno. Traer de Oracle y procesar corre en
+# un hilo aparte (uno solo para todo el proceso); al terminar, el dataset nuevo reemplaza al
+# anterior de una vez y las sesiones lo toman en su próximo rerun.
+
+REINTENTO_ACTUALIZACION_SEG = 300 # Si una actualización falló, no se reintenta antes de esto
+
+
+# cache_resource y no cache_data: cache_data le entrega a cada rerun una copia deserializada
+# de los cuatro DataFrames; así todas las sesiones leen los mismos objetos, que nadie modifica.
+@st.cache_resource
+def datos_compartidos():
+    return {
+        "datos": None,          # (afi_base, df_cons_raw, afi_geo_all, cons_geo_all) del último dataset bueno
+        "actualizando": False,
+        "error": None,
+        "ultimo_intento": 0.0,
+        "lock": threading.Lock(),
+        "carga_inicial": threading.Lock(),
+    }
+
+
+def actualizar_en_segundo_plano(completa=False, forzar=False):
+    """Trae el delta de la base (si el snapshot venció o con 'forzar'), procesa y reemplaza el
+    dataset compartido, en un hilo. Devuelve False si ya había una actualización en curso:
+    nunca corren dos a la vez, las pida quien las pida."""
+    compartidos = datos_compartidos()
+    with compartidos["lock"]:
+        if compartidos["actualizando"]:
+            return False
+        compartidos["actualizando"] = True
+        compartidos["ultimo_intento"] = time.time()
+
+    def actualizar():
+        perfil = Perfil("carga")
+        try:
+            with lock_carga() as tomado:
+                # Si otro proceso ya está trayendo de la base, su versión llega por el almacén
+                if tomado:
+                    if forzar or snapshot_vencido(leer_manifiesto()):
+                        actualizar_snapshot(completa=completa, perfil=perfil)
+                    version = leer_manifiesto()['cargado_en']
+                    actual = compartidos["datos"]
+                    if actual is None or actual[0].attrs.get('version_datos') != version:
+                        datos = procesar_datos(*leer_snapshot(perfil), version, perfil)
+                        compartidos["datos"] = compartir(datos, version) # Reemplazo de una sola vez
+                        perfil.marcar("almacen")
+            compartidos["error"] = None
+        except Exception as e:
+            compartidos["error"] = str(e)
+        finally:
+            compartidos["actualizando"] = False
+            if perfil.etapas: # Con lo que haya llegado a correr, aunque haya fallado
+                registrar_perfil(perfil)
+
+    threading.Thread(target=actualizar, name="actualizar-datos", daemon=True).start()
+    return True
+
+
+def conviene_almacen(puntero, actual):
+    """Si hay que mapear lo publicado en el almacén: no hay datos, lo publicado es de una carga
+    más nueva, o es la misma pero este proceso tiene una copia propia (la procesó mientras otro
+    tenía el lock). Se comparan fechas de carga, no strings; sin versión, lo cargado cuenta como viejo."""
+    if actual is None:
+        return True
+    publicada = cargado_en_version(puntero['version'])
+    cargada = cargado_en_version(actual[0].attrs.get('version_datos'))
+    if cargada is None or publicada > cargada:
+        return True
+    return publicada == cargada and not actual[0].attrs.get('almacen')
+
+
+def datos_actuales():
+    """Los cuatro DataFrames del último dataset bueno, sin esperar a la base. Si otro proceso
+    ya publicó la versión en el almacén compartido, se mapea; si no, la primera vez se arman
+    desde el snapshot local (una sola sesión; las demás esperan ese resultado). Si el snapshot
+    venció, dispara la actualización en segundo plano. None si todavía no hay ningún dataset
+    (primer arranque sin snapshot: la carga desde la base ya está en curso)."""
+    compartidos = datos_compartidos()
+    puntero = leer_puntero_almacen()
+    if puntero and conviene_almacen(puntero, compartidos["datos"]):
+        try:
+            compartidos["datos"] = abrir_almacen(puntero)
+        except OSError:
+            pass # Se borró entre leer el puntero y abrirla: ya hay una más nueva, se toma en el próximo rerun
+
+    if compartidos["datos"] is None:
+        with compartidos["carga_inicial"]:
+            manifiesto = leer_manifiesto()
+            if compartidos["datos"] is None and snapshot_vigente(manifiesto):
+                perfil = Perfil("carga")
+                try:
+                    datos = procesar_datos(*leer_snapshot(perfil), manifiesto['cargado_en'], perfil)
+                    # Publica solo quien tiene el lock; si lo tiene otro, este proceso usa su copia
+                    # hasta que aparezca la publicada
+                    with lock_carga() as tomado:
+                        compartidos["datos"] = compartir(datos, manifiesto['cargado_en']) if tomado else datos
+                except Exception as e:
+                    compartidos["error"] = str(e)
+                registrar_perfil(perfil)
+
+    # También si el snapshot en disco es más nuevo que lo cargado (lo actualizó otro proceso).
+    # En los dos casos con la misma espera entre intentos: si falla o el lock lo tiene otro
+    # proceso, no se arranca un hilo (y una lectura del snapshot) en cada interacción
+    manifiesto = leer_manifiesto()
+    otra_version = compartidos["datos"] is not None and snapshot_vigente(manifiesto) \
+        and compartidos["datos"][0].attrs.get('version_datos') != manifiesto['cargado_en']
+    if (otra_version or snapshot_vencido(manifiesto)) and time.time() - compartidos["ultimo_intento"] > REINTENTO_ACTUALIZACION_SEG:
+        actualizar_en_segundo_plano()
+    return compartidos["datos"]
+
+
+def cargar_datos(actualizar=False, completa=False, perfil=None):
+    """Los cuatro DataFrames de procesar_datos sin Streamlit (scripts, reporte nocturno): desde
+    el snapshot local, trayendo antes lo nuevo de la base si se pide 'actualizar' o si todavía
+    no hay snapshot."""
+    perfil = perfil or Perfil("carga")
+    if actualizar or not snapshot_vigente(leer_manifiesto()):
+        actualizar_snapshot(completa=completa, perfil=perfil)
+    return procesar_datos(*leer_snapshot(perfil), leer_manifiesto()['cargado_en'], perfil)
+
+
+def cargado_en_version(version):
+    """Fecha de carga de una versión de los datos (None si no hay versión). Con carga por
+    provincia la versión es "fecha|provincia|versión nacional": cuenta la fecha de la provincia."""
+    if version is None:
+        return None
+    return datetime.fromisoformat(str(version).split("|")[0])
+
+
+def texto_frescura(version):
+    # "hace 5 min" / "hace 2 h" desde la carga que se está mostrando
+    cargado_en = cargado_en_version(version)
+    minutos = int((datetime.now() - cargado_en).total_seconds() // 60)
+    hace = f"hace {minutos} min" if minutos < 120 else f"hace {minutos // 60} h"
+    return f"{cargado_en:%d/%m %H:%M} ({hace})"
+
+# --- CACHÉS DEL PROCESO ---
+
+class CacheLRU:
+    """Caché compartida por todas las sesiones, con tope de memoria y desalojo del menos
+    usado recientemente. El tamaño de cada entrada lo estima quien la guarda."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.entradas = OrderedDict()
+        self.lock = threading.Lock()
+        self.aciertos = self.fallos = self.desalojos = 0
+
+    def obtener(self, clave):
+        with self.lock:
+            if clave not in self.entradas:
+                self.fallos += 1
+                return None
+            self.entradas.move_to_end(clave)
+            self.aciertos += 1
+            return self.entradas[clave][0]
+
+    def guardar(self, clave, valor, nbytes):
+        with self.lock:
+            if clave in self.entradas:
+                self.bytes -= self.entradas.pop(clave)[1]
+            self.entradas[clave] = (valor, nbytes)
+            self.bytes += nbytes
+            # Siempre queda al menos la entrada recién guardada, aunque sola pase el tope
+            while self.bytes > self.max_bytes and len(self.entradas) > 1:
+                _, (_, liberados) = self.entradas.popitem(last=False)
+                self.bytes -= liberados
+                self.desalojos += 1
+
+    def obtener_o_calcular(self, clave, calcular):
+        """'calcular' devuelve (valor, nbytes). Si dos sesiones piden a la vez la misma clave
+        se puede calcular dos veces; preferimos eso a bloquear toda la caché mientras tanto."""
+        valor = self.obtener(clave)
+        if valor is None:
+            valor, nbytes = calcular()
+            self.guardar(clave, valor, nbytes)
+        return valor
+
+    def estado(self):
+        with self.lock:
+            return {
+                "entradas": len(self.entradas),
+                "mb": round(self.bytes / 2**20, 1),
+                "tope_mb": round(self.max_bytes / 2**20, 1),
+                "aciertos": self.aciertos,
+                "fallos": self.fallos,
+                "desalojos": self.desalojos,
+                "claves": [str(clave) for clave in reversed(self.entradas)], # La más reciente primero
+            }
 
 
-    # --- SIDEBAR: FILTROS ---
+@st.cache_resource
+def cache_kdtree():
+    return CacheLRU(CACHE_KDTREE_MB * 2**20)
+
+
+def distancias_especialidad(afi_geo_all, cons_geo_all, esp):
+    """Árbol de los consultorios (no farmacias) de una especialidad y distancia en km de cada
+    afiliado mapeado al más cercano. Se calcula una vez por carga de datos y especialidad;
+    cambiar el slider, la vista o volver a una especialidad reciente no lo recalcula.
+    'distancias' es None si la especialidad no tiene consultorios en el mapa.
+    Si la matriz de distancias ya está lista, es solo leer una columna (sin árbol)."""
+    version = afi_geo_all.attrs.get('version_datos')
+    matriz = matriz_distancias(version, afi_geo_all, cons_geo_all)
+    if matriz["matriz"] is not None:
+        j = matriz["columnas"].get(esp)
+        return {"tree": None, "distancias": None if j is None else matriz["matriz"][:, j]}
+
+    def calcular():
+        medicos = ~cons_geo_all['es_farmacia'].to_numpy() & mascara_igual(cons_geo_all['ESPECIALIDAD'], esp)
+        if not medicos.any() or len(afi_geo_all) == 0:
+            return {"tree": None, "distancias": None}, 0
+        indice = IndiceGeodesico(cons_geo_all.loc[medicos, 'LATITUD'], cons_geo_all.loc[medicos, 'LONGITUD'])
+        distancias = distancia_mas_cercano(afi_geo_all['LATITUD'], afi_geo_all['LONGITUD'], indice)
+        distancias.flags.writeable = False # Se comparte entre sesiones
+        return {"tree": indice, "distancias": distancias}, distancias.nbytes + indice.nbytes
+
+    return cache_kdtree().obtener_o_calcular((version, esp), calcular)
+
+
+def conteos_en_radio(afi_geo_all, cons_geo_all, esp, radio_km):
+    """Cuántos consultorios (no farmacias; solo de 'esp' si no es "Todas") hay a <= radio_km de
+    cada afiliado mapeado. Una consulta por lote para todos, cacheada por carga y especialidad."""
+    def calcular():
+        medicos = ~cons_geo_all['es_farmacia'].to_numpy()
+        if esp != "Todas":
+            medicos &= mascara_igual(cons_geo_all['ESPECIALIDAD'], esp)
+        if not medicos.any() or len(afi_geo_all) == 0:
+            conteos = np.zeros(len(afi_geo_all), dtype=np.int32)
+        else:
+            indice = IndiceGeodesico(cons_geo_all.loc[medicos, 'LATITUD'], cons_geo_all.loc[medicos, 'LONGITUD'])
+            lat_u, lon_u, inversa = puntos_unicos(afi_geo_all['LATITUD'], afi_geo_all['LONGITUD'])
+            conteos = indice.contar_en_radio(lat_u, lon_u, radio_km).astype(np.int32)[inversa]
+        conteos.flags.writeable = False
+        return conteos, conteos.nbytes
+
+    clave = (afi_geo_all.attrs.get('version_datos'), esp, "en_radio", radio_km)
+    return cache_kdtree().obtener_o_calcular(clave, calcular)
+
+
+def calcular_matriz_distancias(afi_geo_all, cons_geo_all, ruta=None):
+    """Para cada afiliado mapeado (filas, en el orden de afi_geo_all) y cada especialidad
+    (columnas), la distancia en km al consultorio no farmacia más cercano de esa especialidad.
+    float32 y por columnas (orden Fortran), así cada especialidad es un bloque contiguo.
+    Con 'ruta' se escribe como .npy y se devuelve abierto como memmap de solo lectura."""
+    medicos = cons_geo_all.loc[~cons_geo_all['es_farmacia'], ['ESPECIALIDAD', 'LATITUD', 'LONGITUD']]
+    especialidades = sorted(medicos['ESPECIALIDAD'].dropna().unique().tolist())
+
+    lat_u, lon_u, inversa = puntos_unicos(afi_geo_all['LATITUD'], afi_geo_all['LONGITUD'])
+    forma = (len(afi_geo_all), len(especialidades))
+
+    if ruta is not None:
+        tmp = ruta.with_name(f"{ruta.stem}.{os.getpid()}.tmp.npy")
+        matriz = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32, shape=forma, fortran_order=True)
+    else:
+        matriz = np.empty(forma, dtype=np.float32, order='F')
+
+    for j, esp in enumerate(especialidades):
+        de_esp = mascara_igual(medicos['ESPECIALIDAD'], esp)
+        dist, _ = IndiceGeodesico(medicos.loc[de_esp, 'LATITUD'], medicos.loc[de_esp, 'LONGITUD']).mas_cercanos(lat_u, lon_u, k=1)
+        matriz[:, j] = dist.astype(np.float32)[inversa]
+
+    if ruta is not None:
+        matriz.flush()
+        del matriz
+        os.replace(tmp, ruta)
+        matriz = np.load(ruta, mmap_mode='r')
+    else:
+        matriz.flags.writeable = False
+    return matriz, especialidades
 
 
-    # Inyectamos el CSS específico para el contenedor 'boton-reset'
-    st.markdown("""
-        <style>
-        div[data-testid="stVerticalBlock"] > div:has(div#boton-reset) button {
-            padding: 0px !important;
-            height: 32px !important;
-            width: 32px !important;
-            min-width: 32px !important;
-            border-radius: 5px;
-            line-height: 32px;
-        }
-        </style>
-    """, unsafe_allow_html=True)
-    
-    # Creamos dos columnas en el sidebar: 
-    # La primera (col_titulo) para el texto, la segunda (col_btn) muy estrecha para el botón.
-    col_titulo, col_btn = st.sidebar.columns([0.8, 0.2], vertical_alignment="center")
+def matriz_activa():
+    # Con carga por provincia cada provincia es chica y va por la caché de árboles (la matriz en
+    # disco es una sola y se pisaría al cambiar de provincia)
+    return MATRIZ_DISTANCIAS is not None and not CARGA_POR_PROVINCIA
 
-    with col_titulo:
-        st.header("🔍 Filtros")
 
-    with col_btn:
-        # Agregamos un margen superior pequeño para alinear el botón con el texto del header 
-        st.markdown('<div id="boton-reset">', unsafe_allow_html=True)
-        st.button("🔄", on_click=reiniciar_filtros, help="Reiniciar todos los filtros")
-        st.markdown('</div>', unsafe_allow_html=True)
+# Por versión de los datos: tras un reemplazo en segundo plano alcanza con la actual y la anterior
+@st.cache_resource(max_entries=2)
+def matriz_distancias(version, _afi_geo_all, _cons_geo_all):
+    """Calcula la matriz de distancias en segundo plano, una vez por versión de los datos.
+    Mientras no esté lista ("matriz" en None) distancias_especialidad usa la caché de árboles.
+    En modo "disco", si ya hay una matriz de esta misma versión (p. ej. tras reiniciar) se reusa."""
+    estado = {"matriz": None, "columnas": {}, "version": version, "segundos": None, "error": None}
+    if not matriz_activa() or len(_afi_geo_all) == 0:
+        return estado
 
-    
-    # --- SISTEMA DE ACCESO ---
-    st.sidebar.markdown("---")
-    # Inicializamos el estado si no existe
-    if 'es_dev' not in st.session_state:
-        st.session_state.es_dev = False
-
-    if not st.session_state.es_dev:
-        with st.sidebar.expander("🔑 Acceso Staff"):
-            password = st.text_input("Contraseña", type="password", autocomplete="one-time-code")
-            if st.button("Iniciar sesión"):
-                if password == CLAVE_DESARROLLADOR:
-                    st.session_state.es_dev = True
-                    st.rerun()
-                else:
-                    st.error("Clave incorrecta")
-    else:
-        st.sidebar.success("🔓 Modo Desarrollador Activo")
-        if st.sidebar.button("Cerrar Sesión"):
-            st.session_state.es_dev = False
-            st.rerun()
+    ruta = SNAPSHOT_DIR / "distancias.npy" if MATRIZ_DISTANCIAS == "disco" else None
+    ruta_meta = SNAPSHOT_DIR / "distancias.json"
 
-    
-    # Filtro de Provincia
-    list_prov = ["Todas"] + sorted(afi_base['PROVINCIA'].unique().tolist())
+    def calcular():
+        try:
+            inicio = time.perf_counter()
+            if ruta is not None and ruta.exists() and ruta_meta.exists():
+                meta = json.loads(ruta_meta.read_text(encoding="utf-8"))
+                if meta["version"] == version and meta["filas"] == len(_afi_geo_all) and meta.get("metodo") == "geodesica":
+                    matriz, especialidades = np.load(ruta, mmap_mode='r'), meta["especialidades"]
+                    estado.update(columnas={esp: j for j, esp in enumerate(especialidades)}, segundos=0.0)
+                    estado["matriz"] = matriz
+                    return
+            matriz, especialidades = calcular_matriz_distancias(_afi_geo_all, _cons_geo_all, ruta)
+            if ruta is not None:
+                ruta_meta.write_text(json.dumps({"version": version, "filas": len(_afi_geo_all), "metodo": "geodesica", "especialidades": especialidades}), encoding="utf-8")
+            estado.update(columnas={esp: j for j, esp in enumerate(especialidades)}, segundos=round(time.perf_counter() - inicio, 1))
+            estado["matriz"] = matriz # Último: recién ahí la ven las sesiones
+        except Exception as e:
+            estado["error"] = str(e)
+
+    threading.Thread(target=calcular, name="matriz-distancias", daemon=True).start()
+    return estado
 
-    prov_sel = st.sidebar.selectbox("Seleccionar Provincia", list_prov, key='provincia')
 
-    # Filtro de Localidad (en cascada)
-    loc_sel = "Todas"
-    if prov_sel != "Todas":
-        # Solo mostramos localidades que pertenecen a la provincia elegida
-        list_loc = ["Todas"] + sorted(afi_geo_all[afi_geo_all['PROVINCIA'] == prov_sel]['LOCALIDAD'].unique().tolist())
-        loc_sel = st.sidebar.selectbox("Seleccionar Localidad", list_loc, key='localidad')
-    else:
-        st.sidebar.warning("Seleccione una provincia para filtrar por localidad.")
+@st.cache_resource
+def uso_especialidades():
+    # Cuántas veces se eligió cada especialidad; se guarda junto al snapshot para el precalentado
+    ruta = SNAPSHOT_DIR / "uso_especialidades.json"
+    conteo = Counter(json.loads(ruta.read_text(encoding="utf-8"))) if ruta.exists() else Counter()
+    return {"conteo": conteo, "lock": threading.Lock()}
+
+
+def registrar_uso_especialidad(esp):
+    uso = uso_especialidades()
+    with uso["lock"]:
+        uso["conteo"][esp] += 1
+        SNAPSHOT_DIR.mkdir(exist_ok=True)
+        (SNAPSHOT_DIR / "uso_especialidades.json").write_text(json.dumps(uso["conteo"]), encoding="utf-8")
+
+
+@st.cache_resource(max_entries=2)
+def precalentar_kdtree(version, _afi_geo_all, _cons_geo_all):
+    """Arma en segundo plano los árboles de las especialidades más usadas (o, sin historial,
+    las que tienen más consultorios). Corre una sola vez por versión de los datos."""
+    # Con la matriz de distancias activada no hace falta: cada especialidad es una columna
+    if PRECALENTAR_ESPECIALIDADES <= 0 or matriz_activa():
+        return None
+    with uso_especialidades()["lock"]:
+        mas_usadas = [esp for esp, _ in uso_especialidades()["conteo"].most_common()]
+    por_cantidad = _cons_geo_all.loc[~_cons_geo_all['es_farmacia'], 'ESPECIALIDAD'].value_counts().index.tolist()
+    disponibles = set(por_cantidad)
+    elegidas = [esp for esp in dict.fromkeys(mas_usadas + por_cantidad) if esp in disponibles][:PRECALENTAR_ESPECIALIDADES]
+
+    def precalentar():
+        for esp in elegidas:
+            distancias_especialidad(_afi_geo_all, _cons_geo_all, esp)
+
+    hilo = threading.Thread(target=precalentar, name="precalentar-kdtree", daemon=True)
+    hilo.start()
+    return hilo
+
+
+# --- CUBO DE COBERTURA ---
+
+def _mediana_por_grupo(grupos, valores, n):
+    medianas = pd.Series(np.asarray(valores, dtype=np.float64)).groupby(grupos).median()
+    resultado = np.full(n, np.nan, dtype=np.float32)
+    resultado[medianas.index.to_numpy()] = medianas.to_numpy()
+    return resultado
+
+
+def agregar_por_localidad(fila_afi, n, distancias, en_radio):
+    # Sumas por fila del cubo de lo que se calculó por afiliado para una especialidad
+    finitas = np.isfinite(distancias)
+    return {
+        "dist_suma": np.bincount(fila_afi[finitas], weights=distancias[finitas], minlength=n),
+        "dist_n": np.bincount(fila_afi[finitas], minlength=n),
+        "radio_suma": np.bincount(fila_afi, weights=en_radio, minlength=n),
+        "radio_cero": np.bincount(fila_afi[en_radio == 0], minlength=n),
+    }
+
+
+class CuboCobertura:
+    """Resumen precalculado una vez por carga: una fila por provincia/localidad y, para lo que
+    depende de la especialidad, una columna por especialidad (la 0 es "Todas"). Los filtros de
+    la interfaz pasan a ser elegir filas y una columna y sumar, sin groupby ni merge por rerun.
+
+    Las sumas de distancia y de consultorios en radio dependen de las distancias de cada
+    especialidad (matriz o árboles); se agregan la primera vez que se pide cada una.
+
+    Con 'totales' (carga por provincia, vista nacional) los afiliados llegan ya sumados por
+    localidad desde la base: cuentan en las métricas y en el mapa, pero sin distancias."""
+
+    def __init__(self, afi_base, df_cons_raw, afi_geo_all, cons_geo_all, totales=None):
+        tipo_loc, tipo_prov = afi_geo_all['LOCALIDAD'].dtype, afi_geo_all['PROVINCIA'].dtype
+        n_prov = len(tipo_prov.categories)
+
+        def clave(df):
+            # Ordenando por esta clave las filas quedan como las dejaba el merge: localidad y provincia
+            return df['LOCALIDAD'].cat.codes.to_numpy().astype(np.int64) * n_prov + df['PROVINCIA'].cat.codes.to_numpy()
+
+        frames = [("afi_base", afi_base), ("cons_base", df_cons_raw), ("afi_geo", afi_geo_all), ("cons_geo", cons_geo_all)]
+        if totales is not None:
+            frames.append(("totales", totales))
+        claves = {nombre: clave(df) for nombre, df in frames}
+        unicas = np.unique(np.concatenate(list(claves.values())))
+        fila = {nombre: np.searchsorted(unicas, c).astype(np.int32) for nombre, c in claves.items()}
+        self.n = n = len(unicas)
+        self._claves, self._n_prov = unicas, n_prov
+        self.localidades = pd.DataFrame({
+            'LOCALIDAD': pd.Categorical.from_codes(unicas // n_prov, dtype=tipo_loc),
+            'PROVINCIA': pd.Categorical.from_codes(unicas % n_prov, dtype=tipo_prov),
+        })
+
+        # Lo que no depende de la especialidad
+        self._fila_afi = fila["afi_geo"]
+        self.filas_afi = np.bincount(fila["afi_geo"], minlength=n)
+        unicos = pd.DataFrame({'f': fila["afi_geo"], 'id': afi_geo_all['AFI_ID'].to_numpy()}).drop_duplicates()
+        self.afiliados = np.bincount(unicos['f'].to_numpy(), minlength=n)
+        self.lat_afi = _mediana_por_grupo(fila["afi_geo"], afi_geo_all['LATITUD'], n)
+        self.lon_afi = _mediana_por_grupo(fila["afi_geo"], afi_geo_all['LONGITUD'], n)
+        self.base_afiliados = np.bincount(fila["afi_base"], minlength=n)
+        # Sin afiliados uno por uno no hay distancias, conteos en radio ni heatmap
+        self.con_afiliados = totales is None
+        if totales is not None:
+            en_mapa = totales['AFILIADOS_EN_MAPA'].to_numpy()
+            en_mapa_por_fila = np.bincount(fila["totales"], weights=en_mapa, minlength=n).astype(np.int64)
+            self.base_afiliados += np.bincount(fila["totales"], weights=totales['BASE_AFILIADOS'], minlength=n).astype(np.int64)
+            self.filas_afi += en_mapa_por_fila
+            self.afiliados += en_mapa_por_fila # Cada fila de la consulta es un afiliado distinto
+            self.lat_afi[fila["totales"][en_mapa > 0]] = totales['LAT_MEDIANA'].to_numpy()[en_mapa > 0]
+            self.lon_afi[fila["totales"][en_mapa > 0]] = totales['LON_MEDIANA'].to_numpy()[en_mapa > 0]
+        farm_geo = cons_geo_all['es_farmacia'].to_numpy()
+        farm_base = df_cons_raw['es_farmacia'].to_numpy()
+        self.farmacias = np.bincount(fila["cons_geo"][farm_geo], minlength=n)
+        self.base_farmacias = np.bincount(fila["cons_base"][farm_base], minlength=n)
+
+        # Lo que depende de la especialidad (solo consultorios que no son farmacia)
+        categorias = df_cons_raw['ESPECIALIDAD'].cat.categories
+        self.especialidades = {"Todas": 0, **{esp: j + 1 for j, esp in enumerate(categorias)}}
+        m = len(self.especialidades)
+        f_med, f_base = fila["cons_geo"][~farm_geo], fila["cons_base"][~farm_base]
+        e_med = cons_geo_all['ESPECIALIDAD'].cat.codes.to_numpy()[~farm_geo].astype(np.int64) + 1
+        e_base = df_cons_raw['ESPECIALIDAD'].cat.codes.to_numpy()[~farm_base].astype(np.int64) + 1
+        self.consultorios = self._conteo_por_especialidad(f_med, e_med, m)
+        self.base_consultorios = self._conteo_por_especialidad(f_base, e_base, m)
+
+        lat_med = cons_geo_all['LATITUD'].to_numpy()[~farm_geo]
+        lon_med = cons_geo_all['LONGITUD'].to_numpy()[~farm_geo]
+        con_esp = e_med > 0 # Código -1 (sin especialidad) solo cuenta en "Todas"
+        celda = f_med[con_esp].astype(np.int64) * m + e_med[con_esp]
+        self.lat_cons = _mediana_por_grupo(celda, lat_med[con_esp], n * m).reshape(n, m)
+        self.lon_cons = _mediana_por_grupo(celda, lon_med[con_esp], n * m).reshape(n, m)
+        self.lat_cons[:, 0] = _mediana_por_grupo(f_med, lat_med, n)
+        self.lon_cons[:, 0] = _mediana_por_grupo(f_med, lon_med, n)
+
+        self._por_especialidad = {}
+        self._lock = threading.Lock()
+
+    def _conteo_por_especialidad(self, filas, esp, m):
+        con_esp = esp > 0
+        conteo = np.bincount(filas[con_esp].astype(np.int64) * m + esp[con_esp], minlength=self.n * m).reshape(self.n, m)
+        conteo[:, 0] = np.bincount(filas, minlength=self.n)
+        return conteo.astype(np.int32)
+
+    @property
+    def especialidades_preparadas(self):
+        return len(self._por_especialidad)
+
+    @property
+    def nbytes(self):
+        arrays = [v for v in vars(self).values() if isinstance(v, np.ndarray)]
+        return sum(a.nbytes for a in arrays) + int(self.localidades.memory_usage(deep=True).sum())
+
+    @property
+    def fila_afiliados(self):
+        # Fila del cubo (localidad) de cada afiliado mapeado, en el orden de afi_geo_all
+        return self._fila_afi
+
+    def preparar_especialidad(self, esp, obtener_distancias):
+        """Suma distancias y consultorios en radio por localidad para una especialidad.
+        'obtener_distancias' devuelve (distancias, conteos_en_radio) por afiliado mapeado y solo
+        se llama la primera vez que se pide la especialidad en esta carga."""
+        j = self.especialidades.get(esp, 0)
+        with self._lock:
+            if j in self._por_especialidad:
+                return self._por_especialidad[j]
+        distancias, en_radio = obtener_distancias()
+        return self.agregar_especialidad(esp, agregar_por_localidad(self._fila_afi, self.n, distancias, en_radio))
+
+    def agregar_especialidad(self, esp, datos):
+        """Guarda sumas ya calculadas con agregar_por_localidad (p. ej. en otro proceso)."""
+        with self._lock:
+            self._por_especialidad[self.especialidades.get(esp, 0)] = datos
+        return datos
+
+    def mascara_afiliados(self, data_filtrada):
+        """Afiliados mapeados (filas de afi_geo_all) de las localidades que quedaron en data_filtrada."""
+        claves = data_filtrada['LOCALIDAD'].cat.codes.to_numpy().astype(np.int64) * self._n_prov + data_filtrada['PROVINCIA'].cat.codes.to_numpy()
+        elegidas = np.zeros(self.n, dtype=bool)
+        elegidas[np.searchsorted(self._claves, claves)] = True
+        return elegidas[self._fila_afi]
+
+    def _seleccion(self, prov, loc):
+        sel = np.ones(self.n, dtype=bool)
+        if prov != "Todas":
+            sel &= mascara_igual(self.localidades['PROVINCIA'], prov)
+        if loc != "Todas":
+            sel &= mascara_igual(self.localidades['LOCALIDAD'], loc)
+        return sel
+
+    def provincias(self):
+        return sorted(self.localidades['PROVINCIA'][self.base_afiliados > 0].unique().tolist())
+
+    def localidades_de(self, prov):
+        con_mapa = self._seleccion(prov, "Todas") & (self.filas_afi > 0)
+        return sorted(self.localidades['LOCALIDAD'][con_mapa].unique().tolist())
+
+    def distancia_media_maxima(self):
+        todas = self._por_especialidad[0]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            medias = todas["dist_suma"] / todas["dist_n"]
+        return np.nanmax(medias) if np.isfinite(medias).any() else np.nan
+
+    def consultar(self, prov, loc, esp, dist_range):
+        """data_filtrada y las métricas del sidebar para un filtro. La especialidad tiene que
+        estar preparada con preparar_especialidad."""
+        j = self.especialidades.get(esp, 0)
+        por_esp = self._por_especialidad[j]
+        sel = self._seleccion(prov, loc)
+
+        metricas = {
+            "base_afiliados": int(self.base_afiliados[sel].sum()),
+            "afiliados_en_mapa": int(self.filas_afi[sel].sum()),
+            "base_medicos": int(self.base_consultorios[sel, j].sum()),
+            "medicos_en_mapa": int(self.consultorios[sel, j].sum()),
+            "base_farmacias": int(self.base_farmacias[sel].sum()),
+            "farmacias_en_mapa": int(self.farmacias[sel].sum()),
+            "radio_suma": float(por_esp["radio_suma"][sel].sum()),
+            "radio_cero": int(por_esp["radio_cero"][sel].sum()),
+        }
 
+        # Las mismas filas que dejaba el merge outer: localidades con afiliados, consultorios o farmacias
+        idx = np.flatnonzero(sel & ((self.filas_afi > 0) | (self.consultorios[:, j] > 0) | (self.farmacias > 0)))
+        cant_afiliados = self.afiliados[idx]
+        cant_consultorios = self.consultorios[idx, j]
+        dist_n = por_esp["dist_n"][idx]
+        con_afiliados = self.filas_afi[idx] > 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            dist_media = np.where(dist_n > 0, por_esp["dist_suma"][idx] / dist_n, np.nan)
+            # Sin consultorios (o sin afiliados) el ratio queda vacío, como antes de rellenar con 0
+            cons_por_afi = np.where((cant_consultorios > 0) & (cant_afiliados > 0), cant_consultorios / cant_afiliados, np.nan)
+
+        data_filtrada = self.localidades.iloc[idx].reset_index(drop=True)
+        data_filtrada['cant_afiliados'] = cant_afiliados
+        data_filtrada['dist_media'] = dist_media
+        # Coordenadas: prioridad afiliados, luego consultorios
+        data_filtrada['lat_ref'] = np.where(con_afiliados, self.lat_afi[idx], self.lat_cons[idx, j]).astype(np.float64)
+        data_filtrada['lon_ref'] = np.where(con_afiliados, self.lon_afi[idx], self.lon_cons[idx, j]).astype(np.float64)
+        data_filtrada['cant_consultorios'] = cant_consultorios
+        data_filtrada['cant_farmacias'] = self.farmacias[idx]
+        data_filtrada['cons_por_afi'] = cons_por_afi
+
+        # Limpieza para el mapa (sin ubicación) y filtro de distancia sobre el resumen final
+        data_filtrada = data_filtrada.dropna(subset=['lat_ref', 'lon_ref'])
+        mask_distancia = (data_filtrada['dist_media'].between(dist_range[0], dist_range[1])) | (data_filtrada['dist_media'].isna())
+        return data_filtrada[mask_distancia], metricas
+
+
+def armar_cubo(afi_base, df_cons_raw, afi_geo_all, cons_geo_all, totales=None):
+    cubo = CuboCobertura(afi_base, df_cons_raw, afi_geo_all, cons_geo_all, totales)
+    cubo.preparar_especialidad("Todas", lambda: (
+        afi_geo_all['distancia_km'].to_numpy(),
+        conteos_en_radio(afi_geo_all, cons_geo_all, "Todas", COBERTURA_RADIO_KM),
+    ))
+    return cubo
+
+
+@st.cache_resource(max_entries=2)
+def cubo_cobertura(version, _afi_base, _df_cons_raw, _afi_geo_all, _cons_geo_all):
+    return armar_cubo(_afi_base, _df_cons_raw, _afi_geo_all, _cons_geo_all)
+
+
+def distancias_para_cubo(afi_geo_all, cons_geo_all, esp):
+    # Si la especialidad no tiene consultorios en el mapa se mantiene la distancia general
+    por_especialidad = distancias_especialidad(afi_geo_all, cons_geo_all, esp)
+    distancias = por_especialidad["distancias"]
+    if distancias is None:
+        distancias = afi_geo_all['distancia_km'].to_numpy()
+    return np.asarray(distancias), conteos_en_radio(afi_geo_all, cons_geo_all, esp, COBERTURA_RADIO_KM)
 
-    # Filtro de Especialidad
-    list_esp = ["Todas"] + sorted(df_cons_raw['ESPECIALIDAD'].unique().tolist())
-    esp_sel = st.sidebar.selectbox("Seleccionar Especialidad", list_esp, key='especialidad')
 
-    tipo_mapa = st.sidebar.radio("Tipo de Vista", ["Marcadores (Localidades)", "Heatmap (Distribución de Afiliados)"])
+@st.cache_resource
+def cache_resultados():
+    return CacheLRU(CACHE_RESULTADOS_MB * 2**20)
+
+
+def resultado_filtro(cubo, version, filtros):
+    """(data_filtrada, metricas, df_styled) de un filtro. Se calcula una vez por carga de datos
+    y filtro: ir y volver entre los mismos filtros no repite la consulta ni el formato de la
+    tabla. Los DataFrames son compartidos entre sesiones, así que no se modifican."""
+    prov_sel, loc_sel, esp_sel, dist_range = filtros
+
+    def calcular():
+        data_filtrada, metricas = cubo.consultar(prov_sel, loc_sel, esp_sel, dist_range)
+        metricas["dist_promedio"] = data_filtrada['dist_media'].mean() if not data_filtrada.empty else np.nan
+        df_styled = tabla_formateada(data_filtrada)
+        nbytes = data_filtrada.memory_usage().sum() + df_styled.memory_usage().sum()
+        return (data_filtrada, metricas, df_styled), int(nbytes)
+
+    return cache_resultados().obtener_o_calcular((version, prov_sel, loc_sel, esp_sel, tuple(dist_range)), calcular)
+
+
+# --- CARGA POR PROVINCIA ---
+# Con CARGA_POR_PROVINCIA la vista "Todas" se arma con los consultorios de todo el país y los
+# afiliados ya sumados por localidad en la base; al elegir una provincia se traen sus afiliados
+# con la misma consulta de siempre y la provincia como bind variable. Los consultorios van
+# enteros (son pocos al lado de los afiliados): el consultorio más cercano puede estar del otro
+# lado del límite provincial, como pasa entre el conurbano y CABA.
+
+PARTICION_NACIONAL = "_nacional"
+
+# Columnas de las dos variantes de la consulta de afiliados, ya leídas (en mayúsculas)
+COLUMNAS_AFILIADOS = ['CODIGO', 'APELLIDOS', 'NOMBRES', 'AFI_ID', 'DOMIAFI_ID', 'CALLE', 'NUMERO', 'PISO',
+                      'DEPARTAMENTO', 'CODIGOPOST', 'LOCALIDAD', 'PROVINCIA', 'PAIS', 'LATITUD', 'LONGITUD']
+
+
+def query_afiliados_provincia():
+    # El filtro compara con la provincia como la deja normalizar_lote (los nulos quedan "NONE")
+    return f"""SELECT * FROM ({QUERIES_AFILIADOS[MODO_EXTRACCION_AFILIADOS]}) q
+    WHERE NVL(UPPER(TRIM(q.PROVINCIA)), 'NONE') = :provincia"""
+
+
+def query_totales_afiliados():
+    """Afiliados por provincia y localidad, agrupados en la base: cuántos hay, cuántos tienen
+    coordenadas válidas (mismo rango que GEO_VALIDA) y la mediana de esas coordenadas."""
+    geo_valida = 'q."Latitud" BETWEEN :lat_min AND :lat_max AND q."Longitud" BETWEEN :lon_min AND :lon_max'
+    return f"""
+    SELECT q.PROVINCIA, q.LOCALIDAD
+    ,COUNT(*) BASE_AFILIADOS
+    ,COUNT(CASE WHEN {geo_valida} THEN 1 END) AFILIADOS_EN_MAPA
+    ,MEDIAN(CASE WHEN {geo_valida} THEN q."Latitud" END) LAT_MEDIANA
+    ,MEDIAN(CASE WHEN {geo_valida} THEN q."Longitud" END) LON_MEDIANA
+    FROM ({QUERIES_AFILIADOS[MODO_EXTRACCION_AFILIADOS]}) q
+    GROUP BY q.PROVINCIA, q.LOCALIDAD
+    """
 
-    # --- Usamos el máximo de la distancia media por localidad para que el slider sea coherente y redondeamos al entero superior ---
-    max_val = afi_geo_all.groupby(['LOCALIDAD', 'PROVINCIA'])['distancia_km'].mean().dropna().max()
 
-    if pd.isna(max_val): 
-        max_dist_data = 100 
-    else:
-        max_dist_data = int(math.ceil(max_val)) # Ejemplo: 268.14 -> 269
-
-    dist_range = st.sidebar.slider(
-        "Rango de Distancia Promedio (Km)",
-        0,                  # Mínimo entero
-        max_dist_data,      # Máximo entero redondeado
-        (0, max_dist_data), # Selección inicial
-        step=1,             # Saltos de 1 en 1 km
-        key='distancia'     # MANTENER ESTO para que funcione el botón reset
+def afiliados_vacios():
+    # Lo que devolvería la consulta de afiliados sin filas, para la vista nacional
+    numericas = ('AFI_ID', 'DOMIAFI_ID', 'LATITUD', 'LONGITUD')
+    return normalizar_lote(pd.DataFrame({
+        col: pd.Series(dtype=np.float64 if col in numericas else object) for col in COLUMNAS_AFILIADOS
+    }))
+
+
+def archivo_particion(nombre, sufijo):
+    # Los nombres de provincia llevan espacios y tildes: van codificados, como en las particiones Hive
+    return PARTICIONES_DIR / f"{quote(nombre, safe='')}{sufijo}"
+
+
+def leer_manifiesto_particion(nombre):
+    ruta = archivo_particion(nombre, ".json")
+    if not ruta.exists():
+        return None
+    manifiesto = json.loads(ruta.read_text(encoding="utf-8"))
+    # Como con el snapshot: de otro formato o de otra variante de la consulta no sirve
+    if manifiesto.get('formato') != FORMATO_SNAPSHOT or manifiesto.get('modo_extraccion') != MODO_EXTRACCION_AFILIADOS:
+        return None
+    return manifiesto
+
+
+def leer_particion(nombre, manifiesto):
+    return {clave: pd.read_parquet(archivo_particion(nombre, f".{clave}.parquet")) for clave in manifiesto['filas']}
+
+
+def guardar_particion(nombre, frames, segundos_base):
+    # Igual que guardar_snapshot: temporales y renombre, y el manifiesto al final
+    PARTICIONES_DIR.mkdir(parents=True, exist_ok=True)
+    for clave, df in frames.items():
+        ruta = archivo_particion(nombre, f".{clave}.parquet")
+        tmp = ruta.with_name(f"{ruta.name}.tmp")
+        df.to_parquet(tmp, index=False)
+        os.replace(tmp, ruta)
+    manifiesto = {
+        "cargado_en": datetime.now().isoformat(timespec='seconds'),
+        "formato": FORMATO_SNAPSHOT,
+        "modo_extraccion": MODO_EXTRACCION_AFILIADOS,
+        "filas": {clave: len(df) for clave, df in frames.items()},
+        "segundos_base": round(segundos_base, 1),
+    }
+    ruta = archivo_particion(nombre, ".json")
+    tmp = ruta.with_name(f"{ruta.name}.tmp")
+    tmp.write_text(json.dumps(manifiesto, indent=2), encoding="utf-8")
+    os.replace(tmp, ruta)
+    return manifiesto
+
+
+def traer_nacional(perfil):
+    """Totales de afiliados por localidad y consultorios de todo el país, en paralelo."""
+    inicio = time.perf_counter()
+    datos = leer_consultas_en_paralelo({
+        "totales": (query_totales_afiliados(), {"lat_min": LAT_MIN, "lat_max": LAT_MAX, "lon_min": LON_MIN, "lon_max": LON_MAX}),
+        "consultorios": (QUERY_CONSULTORIOS, None),
+    })
+    perfil.marcar("oracle_nacional", sum(len(df) for df in datos.values()))
+    # normalizar_lote puede juntar localidades que en la base solo difieren en mayúsculas o
+    # espacios: se suman de nuevo (las medianas de esas pocas se promedian)
+    totales = datos["totales"].groupby(['PROVINCIA', 'LOCALIDAD'], as_index=False).agg(
+        BASE_AFILIADOS=('BASE_AFILIADOS', 'sum'),
+        AFILIADOS_EN_MAPA=('AFILIADOS_EN_MAPA', 'sum'),
+        LAT_MEDIANA=('LAT_MEDIANA', 'mean'),
+        LON_MEDIANA=('LON_MEDIANA', 'mean'),
     )
+    manifiesto = guardar_particion(PARTICION_NACIONAL, {"totales": totales, "consultorios": datos["consultorios"]},
+                                   time.perf_counter() - inicio)
+    perfil.marcar("guardar_particion", len(totales) + len(datos["consultorios"]))
+    return manifiesto
 
-    
-    # --- APLICAR FILTROS EN CADENA ---
-    # 1. Creamos copias de trabajo para no romper las bases originales
-    afi_filtrados = afi_geo_all.copy()       # Afiliados con mapa
-    cons_filtrados_all = cons_geo_all.copy() # Prestadores + Farmacias con mapa
-    afi_base_f = afi_base.copy()             # Total Afiliados (para Éxito Geo)
-    cons_base_f = df_cons_raw.copy()           # Total Consultorios (para Éxito Geo)
-
-    # Separamos antes de filtrar especialidad. Esto nos permite que las farmacias no desaparezcan si filtras una especialidad médica
-    cons_médicos = cons_filtrados_all[cons_filtrados_all['DESC_TIPO_EFECTOR'] != 'FARMACIA']
-    farmacias_f = cons_filtrados_all[cons_filtrados_all['DESC_TIPO_EFECTOR'] == 'FARMACIA']
-
-    # 2. FILTRO ESPECIALIDAD: Solo afecta a consultorios (Primero, porque afecta el cálculo de distancias)
-    if esp_sel != "Todas":
-        cons_médicos = cons_médicos[cons_médicos['ESPECIALIDAD'] == esp_sel]
-        # Filtramos también la base original de médicos para que el Éxito Geo sea real
-        cons_base_f = cons_base_f[
-            (cons_base_f['ESPECIALIDAD'] == esp_sel) | 
-            (cons_base_f['DESC_TIPO_EFECTOR'] == 'FARMACIA')
-        ]
-        # Recalcular distancia al especialista más cercano (ignora farmacias)
-        if not cons_médicos.empty and not afi_filtrados.empty:
-            tree = cKDTree(cons_médicos[['LATITUD', 'LONGITUD']].values)
-            dist, _ = tree.query(afi_filtrados[['LATITUD', 'LONGITUD']].values, k=1)
-            afi_filtrados['distancia_km'] = dist * 111.13
-
-    # 3. FILTRO PROVINCIA
-    if prov_sel != "Todas":
-        afi_filtrados = afi_filtrados[afi_filtrados['PROVINCIA'] == prov_sel]
-        cons_médicos = cons_médicos[cons_médicos['PROVINCIA'] == prov_sel]
-        farmacias_f = farmacias_f[farmacias_f['PROVINCIA'] == prov_sel]
-        # Filtrar bases originales (para que se actualice el Sidebar)
-        afi_base_f = afi_base_f[afi_base_f['PROVINCIA'] == prov_sel]
-        cons_base_f = cons_base_f[cons_base_f['PROVINCIA'] == prov_sel]
-
-    # 4. FILTRO LOCALIDAD
-    if loc_sel != "Todas":
-        # Filtrar mapa
-        afi_filtrados = afi_filtrados[afi_filtrados['LOCALIDAD'] == loc_sel]
-        cons_médicos = cons_médicos[cons_médicos['LOCALIDAD'] == loc_sel]
-        farmacias_f = farmacias_f[farmacias_f['LOCALIDAD'] == loc_sel]
-        # Filtrar bases originales
-        afi_base_f = afi_base_f[afi_base_f['LOCALIDAD'] == loc_sel]
-        cons_base_f = cons_base_f[cons_base_f['LOCALIDAD'] == loc_sel]
-
-    # 5. CONSTRUCCIÓN DE LA TABLA "data_filtrada" (Resumen por Localidad/Provincia)
-    # Agrupamos los datos YA FILTRADOS por Provincia, Localidad y Especialidad
-    res_afi = afi_filtrados.groupby(['LOCALIDAD', 'PROVINCIA']).agg(
-        cant_afiliados=('AFI_ID', 'nunique'),
-        dist_media=('distancia_km', 'mean'),
-        lat_ref=('LATITUD', 'median'),
-        lon_ref=('LONGITUD', 'median')
-    ).reset_index()
-
-    res_cons = cons_médicos.groupby(['LOCALIDAD', 'PROVINCIA']).agg(
-        cant_consultorios=('LOCALIDAD', 'size'),
-        lat_cons=('LATITUD', 'median'),
-        lon_cons=('LONGITUD', 'median')
-    ).reset_index()
-
-    res_far = farmacias_f.groupby(['LOCALIDAD', 'PROVINCIA']).size().reset_index(name='cant_farmacias')
-
-    # Unimos para tener la vista final
-    data_filtrada = pd.merge(res_afi, res_cons, on=['LOCALIDAD', 'PROVINCIA'], how='outer')
-    data_filtrada = pd.merge(data_filtrada, res_far, on=['LOCALIDAD', 'PROVINCIA'], how='outer')
-
-    # 2. Consolidamos coordenadas (Prioridad Afiliados, luego Consultorios)
-    data_filtrada['lat_ref'] = data_filtrada['lat_ref'].combine_first(data_filtrada['lat_cons'])
-    data_filtrada['lon_ref'] = data_filtrada['lon_ref'].combine_first(data_filtrada['lon_cons'])
-
-    # 3. Calculamos métricas (antes de rellenar con 0 para no arruinar promedios)
-    data_filtrada['cons_por_afi'] = data_filtrada['cant_consultorios'] / data_filtrada['cant_afiliados'].replace(0, np.nan)
-    
-    # 4. AHORA SÍ: Rellenamos con 0 solo lo que es conteo
-    cols_conteo = ['cant_afiliados', 'cant_farmacias', 'cant_consultorios']
-    data_filtrada[cols_conteo] = data_filtrada[cols_conteo].fillna(0)
-    
-    # 5. Limpieza para el mapa: quitamos lo que no tenga ubicación
-    data_filtrada = data_filtrada.dropna(subset=['lat_ref', 'lon_ref'])
 
-    # 6. FILTRO DE DISTANCIA (Sobre el resumen final)
-    mask_distancia = (data_filtrada['dist_media'].between(dist_range[0], dist_range[1])) | (data_filtrada['dist_media'].isna())
-    data_filtrada = data_filtrada[mask_distancia]
+def traer_provincia(prov, perfil, filas_estimadas=0):
+    """Afiliados de una provincia: la consulta de siempre con la provincia como bind variable."""
+    inicio = time.perf_counter()
+    with pool_db().acquire() as conn:
+        df_afi = leer_consulta_en_lotes(conn, query_afiliados_provincia(), {"provincia": prov}, filas_estimadas)
+    perfil.marcar("oracle_provincia", len(df_afi))
+    manifiesto = guardar_particion(prov, {"afiliados": df_afi}, time.perf_counter() - inicio)
+    perfil.marcar("guardar_particion", len(df_afi))
+    return manifiesto
+
 
+@st.cache_resource
+def particiones():
+    return {
+        "actualizando": set(),  # Particiones que se están trayendo en segundo plano
+        "intentos": {},         # Último intento de actualización de cada una
+        "errores": {},
+        "cargas": {},           # Un lock por partición para la primera carga
+        "lock": threading.Lock(),
+    }
 
-    # --- SIDEBAR: MÉTRICAS RECALCULADAS ---
 
-    st.sidebar.markdown("---")
+@st.cache_resource
+def cache_particiones():
+    return CacheLRU(CACHE_PARTICIONES_MB * 2**20)
+
+
+def actualizar_particion_en_segundo_plano(nombre, traer, forzar=False):
+    """Como actualizar_en_segundo_plano, para una partición: 'traer(perfil)' la vuelve a pedir
+    a la base y la guarda; las sesiones la toman en su próximo rerun. Devuelve False si ya se
+    estaba trayendo (o si falló hace poco y no se pide 'forzar')."""
+    estado = particiones()
+    with estado["lock"]:
+        reciente = time.time() - estado["intentos"].get(nombre, 0) < REINTENTO_ACTUALIZACION_SEG
+        if nombre in estado["actualizando"] or (reciente and not forzar):
+            return False
+        estado["actualizando"].add(nombre)
+        estado["intentos"][nombre] = time.time()
+
+    def actualizar():
+        perfil = Perfil("carga")
+        try:
+            traer(perfil)
+            estado["errores"].pop(nombre, None)
+        except Exception as e:
+            estado["errores"][nombre] = str(e)
+        finally:
+            estado["actualizando"].discard(nombre)
+            if perfil.etapas:
+                registrar_perfil(perfil)
+
+    threading.Thread(target=actualizar, name=f"actualizar-{nombre}", daemon=True).start()
+    return True
+
+
+def particion_al_dia(nombre, traer):
+    """Manifiesto de una partición. Si no hay ninguna guardada la trae de la base en este rerun
+    (una sola sesión; las demás esperan ese resultado); si venció, se usa la guardada y se
+    actualiza en segundo plano."""
+    manifiesto = leer_manifiesto_particion(nombre)
+    if manifiesto is None:
+        estado = particiones()
+        with estado["lock"]:
+            carga = estado["cargas"].setdefault(nombre, threading.Lock())
+        with carga:
+            manifiesto = leer_manifiesto_particion(nombre)
+            if manifiesto is None:
+                perfil = Perfil("carga")
+                try:
+                    manifiesto = traer(perfil)
+                finally:
+                    registrar_perfil(perfil)
+    elif antiguedad_snapshot(manifiesto) > SNAPSHOT_TTL_SEG:
+        actualizar_particion_en_segundo_plano(nombre, traer)
+    return manifiesto
+
+
+@st.cache_resource(max_entries=2)
+def datos_nacionales(version):
+    """Vista "Todas" de la carga por provincia. 'datos' son los cuatro DataFrames de
+    procesar_datos con los consultorios del país y sin afiliados; el cubo toma los afiliados de
+    los totales. 'consultorios' queda crudo para procesar cada provincia."""
+    perfil = Perfil("carga")
+    frames = leer_particion(PARTICION_NACIONAL, leer_manifiesto_particion(PARTICION_NACIONAL))
+    perfil.marcar("leer_particion", sum(len(df) for df in frames.values()))
+    datos = procesar_datos(afiliados_vacios(), frames["consultorios"], version, perfil, otros_geo=frames["totales"])
+    totales = frames["totales"].astype({col: datos[2][col].dtype for col in COLUMNAS_GEO_COMPARTIDAS})
+    cubo = armar_cubo(*datos, totales=totales)
+    perfil.marcar("cubo", cubo.n)
+    registrar_perfil(perfil)
+    return {"version": version, "totales": totales, "consultorios": frames["consultorios"], "datos": datos, "cubo": cubo}
+
+
+def particion_provincia(prov, nacional):
+    """(datos, cubo) de una provincia, con los consultorios de todo el país. La primera vez que
+    se elige se trae de la base; después sale del disco o de memoria (CacheLRU)."""
+    filas_estimadas = int(nacional["totales"]['BASE_AFILIADOS'][mascara_igual(nacional["totales"]['PROVINCIA'], prov)].sum())
+    manifiesto = particion_al_dia(prov, lambda perfil: traer_provincia(prov, perfil, filas_estimadas))
+    # La versión cambia si cambian los afiliados de la provincia o los consultorios del país.
+    # Va primero la fecha de la carga de la provincia, que es la que muestra texto_frescura
+    version = f"{manifiesto['cargado_en']}|{prov}|{nacional['version']}"
+
+    def calcular():
+        perfil = Perfil("carga")
+        df_afi = leer_particion(prov, manifiesto)["afiliados"]
+        perfil.marcar("leer_particion", len(df_afi))
+        datos = procesar_datos(df_afi, nacional["consultorios"], version, perfil)
+        cubo = armar_cubo(*datos)
+        perfil.marcar("cubo", cubo.n)
+        registrar_perfil(perfil)
+        return (datos, cubo), sum(int(df.memory_usage(deep=True).sum()) for df in datos) + cubo.nbytes
+
+    return cache_particiones().obtener_o_calcular(version, calcular)
+
+
+def actualizar_particiones(provincias):
+    """Vuelve a traer ya, en segundo plano, la vista nacional y las provincias pedidas (panel de
+    staff). Devuelve cuántas actualizaciones arrancaron."""
+    arrancadas = int(actualizar_particion_en_segundo_plano(PARTICION_NACIONAL, traer_nacional, forzar=True))
+    for prov in provincias:
+        arrancadas += actualizar_particion_en_segundo_plano(prov, lambda perfil, prov=prov: traer_provincia(prov, perfil), forzar=True)
+    return arrancadas
+
+
+# --- CAPAS DEL MAPA ---
+
+COLOR_SOLO_CONSULTORIOS = "#95a5a6" # GRIS: Solo consultorios (capacidad ociosa)
+COLOR_SIN_CONSULTORIO = "#d62728"   # ROJO: Afiliados sin consultorio local
+COLOR_AMBOS = "#1f77b4"             # AZUL: Localidad con ambos servicios
+
+# Una sola función JS para todos los puntos: color, radio y tooltip salen de las propiedades
+# de cada feature, así el HTML del tooltip no se repite por localidad en la página
+JS_MARCADOR_LOCALIDAD = folium.JsCode("""
+function(feature, layer) {
+    const p = feature.properties;
+    layer.setStyle({color: p.color, fillColor: p.color});
+    layer.setRadius(p.radio);
+    layer.bindTooltip(`
+        <div style="font-family: Arial; width: 220px;">
+            <h4 style="margin-bottom:5px; color:#1f77b4;">${p.localidad}</h4>
+            <p style="font-size:12px; color:gray; margin-top:0;">${p.provincia}</p>
+            <hr style="margin:5px 0;">
+            <b>Afiliados:</b> ${p.afiliados}<br>
+            <b>Farmacias:</b> ${p.farmacias}<br>
+            <b>Consultorios:</b> ${p.consultorios}<br>
+            <b>Cons./Afiliados:</b> ${p.cons_por_afi}<br>
+            <b>Dist. Media:</b> ${p.distancia}
+        </div>`, {sticky: true});
+}
+""")
+
+
+def formato_miles_serie(serie):
+    return numeros_es(serie.astype(np.int64))
+
+
+def formato_es_serie(serie):
+    # Igual que formato_es: vacío o 0 se muestra "0,00"
+    return numeros_es(serie, 1).where(serie.notna() & (serie != 0), "0,00")
+
+
+def coleccion_puntos(lat, lon, propiedades):
+    coordenadas = zip(np.round(lon, 5).tolist(), np.round(lat, 5).tolist())
+    return {
+        "type": "FeatureCollection",
+        "features": [
+            {"type": "Feature", "geometry": {"type": "Point", "coordinates": [lon, lat]}, "properties": props}
+            for (lon, lat), props in zip(coordenadas, propiedades.to_dict('records'))
+        ],
+    }
+
+
+def capa_marcadores(data_filtrada):
+    """Todas las localidades como un único GeoJson de puntos. Las propiedades (textos del
+    tooltip, color y radio) se calculan por columnas sobre data_filtrada."""
+    sin_afiliados = data_filtrada['cant_afiliados'].to_numpy() == 0
+    sin_consultorios = data_filtrada['cant_consultorios'].to_numpy() == 0
+    propiedades = pd.DataFrame({
+        'localidad': data_filtrada['LOCALIDAD'].astype(str).to_numpy(),
+        'provincia': data_filtrada['PROVINCIA'].astype(str).to_numpy(),
+        'afiliados': formato_miles_serie(data_filtrada['cant_afiliados']).to_numpy(),
+        'farmacias': formato_miles_serie(data_filtrada['cant_farmacias']).to_numpy(),
+        'consultorios': formato_miles_serie(data_filtrada['cant_consultorios']).to_numpy(),
+        'cons_por_afi': formato_es_serie(data_filtrada['cons_por_afi']).where(data_filtrada['cons_por_afi'].notna(), "-").to_numpy(),
+        'distancia': np.where(sin_afiliados, "-", formato_es_serie(data_filtrada['dist_media']) + " km"),
+        'color': np.select([sin_afiliados, sin_consultorios], [COLOR_SOLO_CONSULTORIOS, COLOR_SIN_CONSULTORIO], COLOR_AMBOS),
+        'radio': np.minimum(25, 5 + data_filtrada['cant_afiliados'].to_numpy() / 100).round(2),
+    })
+    return folium.GeoJson(
+        coleccion_puntos(data_filtrada['lat_ref'], data_filtrada['lon_ref'], propiedades),
+        name="Localidades",
+        marker=folium.CircleMarker(fill=True, fill_opacity=0.6),
+        on_each_feature=JS_MARCADOR_LOCALIDAD,
+    )
 
-    # Título dinámico según el nivel de filtro
-    titulo_stats = prov_sel if loc_sel == "Todas" else f"{loc_sel}, {prov_sel}"
-    st.sidebar.subheader(f"📊 Estadísticas: {titulo_stats}")
 
-    
+# Vista "Detalle según zoom": qué se dibuja en cada rango de zoom
+ZOOM_LOCALIDADES = 6   # Por debajo, una marca por provincia
+ZOOM_CONSULTORIOS = 11 # Desde acá, además, cada consultorio y farmacia del área visible
+MARGEN_VIEWPORT = 0.5  # Se manda también lo que está a media pantalla de cada borde
+
+COLOR_CONSULTORIO = "#9467bd"
+COLOR_FARMACIA = "#2ca02c"
+
+JS_MARCADOR_CONSULTORIO = folium.JsCode("""
+function(feature, layer) {
+    const p = feature.properties;
+    layer.setStyle({color: p.color, fillColor: p.color});
+    layer.bindTooltip(`<b>${p.nombre}</b><br>${p.tipo}<br><span style="color:gray;">${p.direccion}</span>`);
+}
+""")
+
+
+def resumen_provincias(data_filtrada):
+    """data_filtrada agrupada por provincia, con las mismas columnas para dibujarla con
+    capa_marcadores. Distancia y ubicación son promedios ponderados por afiliados."""
+    cant_afiliados = data_filtrada['cant_afiliados']
+    peso = cant_afiliados + 1 # Las localidades sin afiliados también cuentan para ubicar la marca
+    por_prov = data_filtrada.assign(
+        dist_pond=data_filtrada['dist_media'] * cant_afiliados,
+        afi_con_dist=cant_afiliados.where(data_filtrada['dist_media'].notna(), 0),
+        lat_pond=data_filtrada['lat_ref'] * peso,
+        lon_pond=data_filtrada['lon_ref'] * peso,
+        peso=peso,
+    ).groupby('PROVINCIA', observed=True).agg(
+        localidades=('LOCALIDAD', 'size'),
+        cant_afiliados=('cant_afiliados', 'sum'),
+        cant_consultorios=('cant_consultorios', 'sum'),
+        cant_farmacias=('cant_farmacias', 'sum'),
+        dist_pond=('dist_pond', 'sum'),
+        afi_con_dist=('afi_con_dist', 'sum'),
+        lat_pond=('lat_pond', 'sum'),
+        lon_pond=('lon_pond', 'sum'),
+        peso=('peso', 'sum'),
+    )
+    con_ambos = (por_prov['cant_consultorios'] > 0) & (por_prov['cant_afiliados'] > 0)
+    return pd.DataFrame({
+        'LOCALIDAD': por_prov.index.astype(str),
+        'PROVINCIA': por_prov['localidades'].map("{} localidades".format).to_numpy(),
+        'cant_afiliados': por_prov['cant_afiliados'].to_numpy(),
+        'dist_media': (por_prov['dist_pond'] / por_prov['afi_con_dist'].replace(0, np.nan)).to_numpy(),
+        'lat_ref': (por_prov['lat_pond'] / por_prov['peso']).to_numpy(),
+        'lon_ref': (por_prov['lon_pond'] / por_prov['peso']).to_numpy(),
+        'cant_consultorios': por_prov['cant_consultorios'].to_numpy(),
+        'cant_farmacias': por_prov['cant_farmacias'].to_numpy(),
+        'cons_por_afi': (por_prov['cant_consultorios'] / por_prov['cant_afiliados']).where(con_ambos).to_numpy(),
+    })
+
+
+def caja_con_margen(bounds, margen=MARGEN_VIEWPORT):
+    """(sur, oeste, norte, este) del área visible que devolvió st_folium, agrandada 'margen'
+    veces su alto y ancho de cada lado. None si todavía no hay área."""
+    try:
+        sur, oeste = bounds['_southWest']['lat'], bounds['_southWest']['lng']
+        norte, este = bounds['_northEast']['lat'], bounds['_northEast']['lng']
+        alto, ancho = norte - sur, este - oeste
+    except (KeyError, TypeError):
+        return None
+    return sur - alto * margen, oeste - ancho * margen, norte + alto * margen, este + ancho * margen
+
+
+def en_viewport(df, caja):
+    if caja is None:
+        return df
+    sur, oeste, norte, este = caja
+    return df[df['lat_ref'].between(sur, norte) & df['lon_ref'].between(oeste, este)]
+
+
+class IndiceCaja:
+    """Puntos ordenados por longitud: la búsqueda por rectángulo es un searchsorted para la
+    franja de longitudes y una comparación de latitud solo sobre esa franja."""
+
+    def __init__(self, lat, lon):
+        lon = np.asarray(lon, dtype=np.float64)
+        self.orden = np.argsort(lon, kind='stable')
+        self.lon = lon[self.orden]
+        self.lat = np.asarray(lat, dtype=np.float64)[self.orden]
+
+    @property
+    def nbytes(self):
+        return self.orden.nbytes + self.lon.nbytes + self.lat.nbytes
+
+    def en_caja(self, sur, oeste, norte, este):
+        """Posiciones (en el orden original) de los puntos dentro del rectángulo."""
+        i = np.searchsorted(self.lon, oeste, side='left')
+        j = np.searchsorted(self.lon, este, side='right')
+        dentro = (self.lat[i:j] >= sur) & (self.lat[i:j] <= norte)
+        return np.sort(self.orden[i:j][dentro])
+
+
+@st.cache_resource(max_entries=2)
+def indice_consultorios(version, _cons_geo_all):
+    return IndiceCaja(_cons_geo_all['LATITUD'], _cons_geo_all['LONGITUD'])
+
+
+def consultorios_en_caja(cons_geo_all, caja, prov, loc, esp):
+    """Filas de cons_geo_all dentro de 'caja' que pasan los filtros (las farmacias no se
+    filtran por especialidad, como en el resto del tablero)."""
+    filas = indice_consultorios(cons_geo_all.attrs.get('version_datos'), cons_geo_all).en_caja(*caja)
+    en_caja = cons_geo_all.iloc[filas]
+    elegidas = np.ones(len(filas), dtype=bool)
+    if prov != "Todas":
+        elegidas &= mascara_igual(en_caja['PROVINCIA'], prov)
+    if loc != "Todas":
+        elegidas &= mascara_igual(en_caja['LOCALIDAD'], loc)
+    if esp != "Todas":
+        elegidas &= en_caja['es_farmacia'].to_numpy() | mascara_igual(en_caja['ESPECIALIDAD'], esp)
+    return filas[elegidas]
+
+
+def capa_consultorios(cons_geo_all, filas):
+    puntos = cons_geo_all.iloc[filas]
+    farmacia = puntos['es_farmacia'].to_numpy()
+
+    def texto(col):
+        return puntos[col].astype(object).fillna("").astype(str)
+
+    propiedades = pd.DataFrame({
+        'nombre': texto('NOMBRE').to_numpy(),
+        'tipo': np.where(farmacia, "Farmacia", texto('ESPECIALIDAD')),
+        'direccion': (texto('CALLE') + " " + texto('NUMERO')).str.strip().to_numpy(),
+        'color': np.where(farmacia, COLOR_FARMACIA, COLOR_CONSULTORIO),
+    })
+    return folium.GeoJson(
+        coleccion_puntos(puntos['LATITUD'].to_numpy(), puntos['LONGITUD'].to_numpy(), propiedades),
+        name="Consultorios",
+        marker=folium.CircleMarker(radius=4, weight=1, fill=True, fill_opacity=0.9),
+        on_each_feature=JS_MARCADOR_CONSULTORIO,
+    )
 
-    # Métricas de Afiliados
-    st.sidebar.write("**Afiliados**")
-    st.sidebar.write(f"Total Base Filtrada: {formato_miles(len(afi_base_f))}")
-    st.sidebar.write(f"En Mapa: {formato_miles(len(afi_filtrados))}")
-    st.sidebar.info(f"Éxito Geo: {formato_porcentaje(len(afi_filtrados), len(afi_base_f))}")
 
-    
+PIRAMIDE_ZOOM_MIN, PIRAMIDE_ZOOM_MAX = 3, 15
+PIRAMIDE_CELDA_PX = 8 # Lado de la celda en píxeles de pantalla, en cualquier zoom
+
+
+def celdas_mercator(lat, lon, zoom, celda_px=PIRAMIDE_CELDA_PX):
+    # Índices de celda en la grilla Web Mercator del zoom (la misma proyección que las teselas)
+    n = 256 * 2**zoom // celda_px
+    lat_r = np.radians(np.clip(np.asarray(lat, dtype=np.float64), -85.05, 85.05))
+    x = (np.asarray(lon, dtype=np.float64) + 180) / 360
+    y = (1 - np.log(np.tan(lat_r) + 1 / np.cos(lat_r)) / np.pi) / 2
+    return np.clip(np.floor(x * n), 0, n - 1).astype(np.int64), np.clip(np.floor(y * n), 0, n - 1).astype(np.int64)
+
+
+def centro_celdas(gx, gy, zoom):
+    n = 256 * 2**zoom // PIRAMIDE_CELDA_PX
+    lon = (gx + 0.5) / n * 360 - 180
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (gy + 0.5) / n))))
+    return lat.astype(np.float32), lon.astype(np.float32)
+
+
+class PiramideCalor:
+    """Afiliados contados por celda de grilla para cada zoom del heatmap. Se arma el nivel más
+    fino una vez y cada nivel más grueso sale de agrupar las celdas del anterior de a 2x2.
+    Cada nivel guarda el código de celda (x << 32 | y) ordenado y el conteo."""
+
+    def __init__(self, lat, lon):
+        gx, gy = celdas_mercator(lat, lon, PIRAMIDE_ZOOM_MAX)
+        celdas, conteo = np.unique((gx << 32) | gy, return_counts=True)
+        self.niveles = {}
+        for zoom in range(PIRAMIDE_ZOOM_MAX, PIRAMIDE_ZOOM_MIN - 1, -1):
+            if zoom < PIRAMIDE_ZOOM_MAX:
+                padres = ((celdas >> 33) << 32) | ((celdas & 0xFFFFFFFF) >> 1)
+                celdas, inversa = np.unique(padres, return_inverse=True)
+                conteo = np.bincount(inversa, weights=conteo).astype(np.int64)
+            self.niveles[zoom] = (celdas, conteo.astype(np.int32))
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for nivel in self.niveles.values() for a in nivel)
+
+    def _en_caja(self, zoom, caja):
+        # Las celdas están ordenadas por (x, y): la franja de x es un searchsorted
+        celdas, conteo = self.niveles[zoom]
+        if caja is None:
+            return celdas, conteo
+        sur, oeste, norte, este = caja
+        x0, y0 = celdas_mercator(norte, oeste, zoom) # La y crece hacia el sur
+        x1, y1 = celdas_mercator(sur, este, zoom)
+        i, j = np.searchsorted(celdas, [int(x0) << 32, (int(x1) + 1) << 32])
+        y = celdas[i:j] & 0xFFFFFFFF
+        dentro = (y >= y0) & (y <= y1)
+        return celdas[i:j][dentro], conteo[i:j][dentro]
+
+    def puntos(self, zoom, caja=None):
+        """(zoom usado, [[lat, lon, peso], ...]) para HeatMap, solo las celdas dentro de 'caja'
+        (sur, oeste, norte, este) si se pasa. El peso va de 0 a 1, relativo al percentil 99 de
+        esas celdas, para que una ciudad grande no apague el resto."""
+        zoom = int(np.clip(zoom, PIRAMIDE_ZOOM_MIN, PIRAMIDE_ZOOM_MAX))
+        celdas, conteo = self._en_caja(zoom, caja)
+        while zoom > PIRAMIDE_ZOOM_MIN and len(conteo) > HEATMAP_MAX_CELDAS:
+            zoom -= 1
+            celdas, conteo = self._en_caja(zoom, caja)
+        if len(conteo) == 0:
+            return zoom, []
+        lat, lon = centro_celdas(celdas >> 32, celdas & 0xFFFFFFFF, zoom)
+        peso = np.minimum(1, conteo / max(np.percentile(conteo, 99), 1)).round(3)
+        return zoom, np.column_stack([lat, lon, peso]).tolist()
 
-    st.sidebar.markdown("---")
 
-    
+@st.cache_resource
+def cache_piramides():
+    return CacheLRU(CACHE_PIRAMIDES_MB * 2**20)
+
+
+def piramide_calor(cubo, afi_geo_all, data_filtrada, clave_filtro):
+    """Grilla del heatmap de los afiliados del filtro. Una vez por carga de datos y filtro."""
+    def calcular():
+        en_filtro = cubo.mascara_afiliados(data_filtrada)
+        piramide = PiramideCalor(afi_geo_all['LATITUD'].to_numpy()[en_filtro], afi_geo_all['LONGITUD'].to_numpy()[en_filtro])
+        return piramide, piramide.nbytes
+
+    return cache_piramides().obtener_o_calcular((afi_geo_all.attrs.get('version_datos'),) + clave_filtro, calcular)
+
+
+# --- SUPERFICIE DE COBERTURA ---
+# Por localidad, los afiliados rurales lejos de todo quedan promediados con los del centro.
+# La superficie cubre el país con una grilla de celdas de SUPERFICIE_CELDA_KM de lado, cuenta
+# los afiliados de cada celda y mide desde su centro al consultorio más cercano.
+
+SUPERFICIE_CELDA_KM = 10
+SUPERFICIE_UMBRAL_KM = 30 # Umbral inicial del control: celdas más lejos que esto son zona desatendida
+SUPERFICIE_MAX_CELDAS_MAPA = 5000 # En el mapa, las de más afiliados; la descarga las tiene todas
+KM_POR_GRADO = 2 * np.pi * RADIO_TIERRA_KM / 360
+COLOR_DESATENDIDA = "#fc8d59"      # NARANJA: más lejos que el umbral
+COLOR_MUY_DESATENDIDA = "#b2182b"  # BORDÓ: más del doble del umbral
+
+JS_CELDA_DESATENDIDA = folium.JsCode("""
+function(feature, layer) {
+    const p = feature.properties;
+    layer.setStyle({color: p.color, fillColor: p.color, weight: 1, fillOpacity: 0.5});
+    layer.bindTooltip(`<b>${p.afiliados} afiliados</b><br>${p.distancia} al consultorio más cercano<br><span style="color:gray;">${p.provincia}</span>`, {sticky: true});
+}
+""")
+
+
+class SuperficieCobertura:
+    """Grilla de celdas de ~celda_km x celda_km sobre la Argentina con los afiliados de cada una.
+    Las filas son franjas de latitud y el ancho en grados de cada fila se ajusta por el coseno
+    de su latitud, así las celdas miden lo mismo en km en todo el país. Solo se guardan las
+    celdas con afiliados; la distancia al consultorio más cercano de todas las celdas sale de
+    una única consulta al árbol."""
+
+    def __init__(self, lat, lon, provincia, lat_cons, lon_cons, celda_km=SUPERFICIE_CELDA_KM):
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        alto = celda_km / KM_POR_GRADO
+        fila = np.floor((lat - LAT_MIN) / alto).astype(np.int64)
+        ancho = alto / np.cos(np.radians(LAT_MIN + (fila + 0.5) * alto))
+        columna = np.floor((lon - LON_MIN) / ancho).astype(np.int64)
+        n_columnas = int((LON_MAX - LON_MIN) / alto) + 1 # Cota: ninguna fila tiene celdas más angostas que 'alto'
+        celdas, inversa, afiliados = np.unique(fila * n_columnas + columna, return_inverse=True, return_counts=True)
+
+        fila, columna = np.divmod(celdas, n_columnas)
+        sur = LAT_MIN + fila * alto
+        ancho = alto / np.cos(np.radians(sur + alto / 2))
+        oeste = LON_MIN + columna * ancho
+        lat_centro, lon_centro = sur + alto / 2, oeste + ancho / 2
+        if len(lat_cons) and len(celdas):
+            distancia, _ = IndiceGeodesico(lat_cons, lon_cons).mas_cercanos(lat_centro, lon_centro)
+        else:
+            distancia = np.full(len(celdas), np.inf)
+
+        # Provincia de cada celda: la de la mayoría de sus afiliados (una celda puede cruzar un límite).
+        # Los afiliados sin provincia (código -1) van a una columna extra y la celda queda vacía
+        n_prov = len(provincia.cat.categories)
+        codigos = provincia.cat.codes.to_numpy().astype(np.int64)
+        codigos[codigos < 0] = n_prov
+        por_provincia = np.bincount(inversa.ravel() * (n_prov + 1) + codigos, minlength=len(celdas) * (n_prov + 1))
+        mayoria = por_provincia.reshape(len(celdas), n_prov + 1).argmax(axis=1)
+        self.celdas = pd.DataFrame({
+            'PROVINCIA': pd.Categorical.from_codes(np.where(mayoria == n_prov, -1, mayoria), provincia.cat.categories),
+            'LATITUD': lat_centro, 'LONGITUD': lon_centro,
+            'sur': sur, 'oeste': oeste, 'norte': sur + alto, 'este': oeste + ancho,
+            'afiliados': afiliados.astype(np.int32),
+            'distancia_km': distancia.astype(np.float32),
+        })
+
+    @property
+    def nbytes(self):
+        return int(self.celdas.memory_usage().sum())
+
+    def desatendidas(self, umbral_km, prov="Todas"):
+        """Celdas con el consultorio más cercano a más de umbral_km, las de más afiliados primero."""
+        lejos = self.celdas['distancia_km'].to_numpy() > umbral_km
+        if prov != "Todas":
+            lejos &= mascara_igual(self.celdas['PROVINCIA'], prov)
+        return self.celdas[lejos].sort_values('afiliados', ascending=False, kind='stable')
 
-    # Métricas de Consultorios
-    st.sidebar.write(f"**Consultorios ({esp_sel if esp_sel != 'Todas' else 'Totales'})**")
-    # Usamos cons_base_f (que ya tiene los filtros de provincia/localidad/especialidad aplicados)
-    total_base_medicos = len(cons_base_f[cons_base_f['DESC_TIPO_EFECTOR'] != 'FARMACIA'])
-    st.sidebar.write(f"Total Base Filtrada: {formato_miles(total_base_medicos)}")
-    st.sidebar.write(f"En Mapa: {formato_miles(len(cons_médicos))}")
-    st.sidebar.info(f"Éxito Geo: {formato_porcentaje(len(cons_médicos), total_base_medicos)}")
 
-    
+@st.cache_resource
+def cache_superficies():
+    return CacheLRU(CACHE_SUPERFICIES_MB * 2**20)
+
+
+def superficie_cobertura(afi_geo_all, cons_geo_all, esp):
+    """Superficie de cobertura de una especialidad (consultorios, no farmacias). Una vez por carga de datos y especialidad."""
+    def calcular():
+        medicos = ~cons_geo_all['es_farmacia'].to_numpy()
+        if esp != "Todas":
+            medicos &= mascara_igual(cons_geo_all['ESPECIALIDAD'], esp)
+        superficie = SuperficieCobertura(afi_geo_all['LATITUD'].to_numpy(), afi_geo_all['LONGITUD'].to_numpy(), afi_geo_all['PROVINCIA'],
+                                         cons_geo_all['LATITUD'].to_numpy()[medicos], cons_geo_all['LONGITUD'].to_numpy()[medicos])
+        return superficie, superficie.nbytes
+
+    return cache_superficies().obtener_o_calcular((afi_geo_all.attrs.get('version_datos'), esp), calcular)
+
+
+def capa_desatendidas(celdas, umbral_km):
+    """Las celdas desatendidas como un único GeoJson de polígonos, con su tooltip."""
+    oeste, este = np.round(celdas['oeste'].to_numpy(), 5).tolist(), np.round(celdas['este'].to_numpy(), 5).tolist()
+    sur, norte = np.round(celdas['sur'].to_numpy(), 5).tolist(), np.round(celdas['norte'].to_numpy(), 5).tolist()
+    propiedades = pd.DataFrame({
+        'provincia': celdas['PROVINCIA'].astype(str).to_numpy(),
+        'afiliados': formato_miles_serie(celdas['afiliados']).to_numpy(),
+        'distancia': (numeros_es(celdas['distancia_km'], 1) + " km").where(np.isfinite(celdas['distancia_km']), "sin consultorios").to_numpy(),
+        'color': np.where(celdas['distancia_km'].to_numpy() > 2 * umbral_km, COLOR_MUY_DESATENDIDA, COLOR_DESATENDIDA),
+    })
+    return folium.GeoJson(
+        {
+            "type": "FeatureCollection",
+            "features": [
+                {"type": "Feature", "properties": props,
+                 "geometry": {"type": "Polygon", "coordinates": [[[o, s], [e, s], [e, n], [o, n], [o, s]]]}}
+                for o, e, s, n, props in zip(oeste, este, sur, norte, propiedades.to_dict('records'))
+            ],
+        },
+        name="Zonas desatendidas",
+        on_each_feature=JS_CELDA_DESATENDIDA,
+    )
 
-    # Métrica de Distancia Promedio (basada en el filtro aplicado)
 
-    if not data_filtrada.empty:
+def lista_desatendidas(celdas):
+    # Lo que se descarga: centro de la celda y números sin formato, para cruzar con otras capas
+    return pd.DataFrame({
+        'Provincia': celdas['PROVINCIA'],
+        'Latitud centro': celdas['LATITUD'].round(5),
+        'Longitud centro': celdas['LONGITUD'].round(5),
+        'Afiliados': celdas['afiliados'],
+        'Distancia consultorio más cercano (Km)': celdas['distancia_km'].round(1),
+    })
+
+
+# --- TESELAS PRE-RENDERIZADAS ---
+
+TESELA_PX = 256
+TESELAS_BLOQUE_PX = 2 # Lado en píxeles de cada celda de densidad dentro de la tesela
+TESELAS_CONTEO_SATURA = 4096 # Conteo por celda que ya lleva el color más intenso
+
+# Escala logarítmica fija (no depende de los datos): si una tesela no cambió de conteos, su PNG
+# tampoco, y al regenerar se puede saltear
+RAMPAS_TESELAS = {
+    "afiliados": ((255, 255, 178), (253, 141, 60), (189, 0, 38)),
+    "consultorios": ((222, 235, 247), (107, 174, 214), (8, 48, 107)),
+}
+
+
+def tabla_colores(colores):
+    # 256 colores RGBA interpolando la rampa; el nivel 0 (sin datos) es transparente
+    niveles = np.linspace(0, 1, 256)
+    tramos = np.linspace(0, 1, len(colores))
+    rgb = [np.interp(niveles, tramos, [c[k] for c in colores]) for k in range(3)]
+    tabla = np.column_stack(rgb + [np.interp(niveles, [0, 1], [120, 230])]).astype(np.uint8)
+    tabla[0] = 0
+    return tabla
+
+
+def niveles_teselas(lat, lon, zoom):
+    """Genera ((x, y), niveles) por cada tesela con datos en el zoom. 'niveles' es una matriz
+    uint8 de celdas de TESELAS_BLOQUE_PX píxeles: 0 sin datos, 255 desde TESELAS_CONTEO_SATURA."""
+    por_lado = TESELA_PX // TESELAS_BLOQUE_PX
+    gx, gy = celdas_mercator(lat, lon, zoom, TESELAS_BLOQUE_PX)
+    tesela = ((gx // por_lado) << 32) | (gy // por_lado)
+    dentro = (gy % por_lado) * por_lado + gx % por_lado
+    orden = np.argsort(tesela, kind='stable')
+    tesela, dentro = tesela[orden], dentro[orden]
+    inicios = np.flatnonzero(np.r_[True, tesela[1:] != tesela[:-1]])
+    for i, j in zip(inicios, np.r_[inicios[1:], len(tesela)]):
+        conteo = np.bincount(dentro[i:j], minlength=por_lado * por_lado).reshape(por_lado, por_lado)
+        niveles = np.ceil(np.log1p(conteo) / np.log1p(TESELAS_CONTEO_SATURA) * 255)
+        yield (int(tesela[i] >> 32), int(tesela[i] & 0xFFFFFFFF)), np.minimum(niveles, 255).astype(np.uint8)
+
+
+def generar_teselas(capa, lat, lon, version):
+    """Escribe las teselas z/x/y.png de una capa en TESELAS_DIR/capa. Es incremental: guarda un
+    hash de los niveles de cada tesela en indice.json y solo reescribe las que cambiaron (y borra
+    las que quedaron vacías). Si el índice ya es de esta versión de los datos no hace nada."""
+    carpeta = TESELAS_DIR / capa
+    ruta_indice = carpeta / "indice.json"
+    anterior = json.loads(ruta_indice.read_text(encoding="utf-8")) if ruta_indice.exists() else {}
+    if anterior.get("version") == version:
+        return {"escritas": 0, "sin_cambios": len(anterior["teselas"]), "borradas": 0}
+
+    colores = tabla_colores(RAMPAS_TESELAS[capa])
+    hashes_previos = anterior.get("teselas", {})
+    hashes, escritas = {}, 0
+    for zoom in range(TESELAS_ZOOM_MIN, TESELAS_ZOOM_MAX + 1):
+        for (x, y), niveles in niveles_teselas(lat, lon, zoom):
+            clave = f"{zoom}/{x}/{y}"
+            hashes[clave] = hashlib.blake2b(niveles.tobytes(), digest_size=8).hexdigest()
+            if hashes_previos.get(clave) == hashes[clave]:
+                continue
+            rgba = colores[niveles].repeat(TESELAS_BLOQUE_PX, axis=0).repeat(TESELAS_BLOQUE_PX, axis=1)
+            ruta = carpeta / str(zoom) / str(x) / f"{y}.png"
+            ruta.parent.mkdir(parents=True, exist_ok=True)
+            tmp = ruta.with_name(f"{ruta.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            Image.fromarray(rgba, "RGBA").save(tmp, format="PNG")
+            os.replace(tmp, ruta)
+            escritas += 1
+
+    borradas = set(hashes_previos) - set(hashes)
+    for clave in borradas:
+        (carpeta / f"{clave}.png").unlink(missing_ok=True)
+    carpeta.mkdir(parents=True, exist_ok=True)
+    tmp = ruta_indice.with_name(f"indice.json.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_text(json.dumps({"version": version, "teselas": hashes}), encoding="utf-8")
+    os.replace(tmp, ruta_indice)
+    return {"escritas": escritas, "sin_cambios": len(hashes) - escritas, "borradas": len(borradas)}
+
+
+@st.cache_resource(max_entries=2)
+def teselas_densidad(version, _afi_geo_all, _cons_geo_all):
+    """Genera (o actualiza) las teselas en segundo plano, una vez por versión de los datos.
+    Mientras tanto la vista de teselas muestra lo que haya de la carga anterior."""
+    estado = {"version": version, "listas": False, "capas": {}, "segundos": None, "error": None}
+    medicos = ~_cons_geo_all['es_farmacia'].to_numpy()
+    puntos = {
+        "afiliados": (_afi_geo_all['LATITUD'].to_numpy(), _afi_geo_all['LONGITUD'].to_numpy()),
+        "consultorios": (_cons_geo_all['LATITUD'].to_numpy()[medicos], _cons_geo_all['LONGITUD'].to_numpy()[medicos]),
+    }
+
+    def generar():
+        try:
+            inicio = time.perf_counter()
+            # Un proceso por vez: el que espera encuentra el índice ya en esta versión y no escribe nada
+            with lock_carga(esperar=True, nombre="teselas"):
+                for capa in TESELAS_CAPAS:
+                    estado["capas"][capa] = generar_teselas(capa, *puntos[capa], version)
+            estado["segundos"] = round(time.perf_counter() - inicio, 1)
+            estado["listas"] = True
+        except Exception as e:
+            estado["error"] = str(e)
+
+    threading.Thread(target=generar, name="teselas-densidad", daemon=True).start()
+    return estado
+
+
+def capas_teselas(version):
+    """TileLayers de las capas de teselas. El parámetro de versión en la URL evita que el
+    navegador muestre teselas cacheadas de una carga anterior."""
+    return [
+        folium.TileLayer(
+            tiles=f"{TESELAS_URL}/{capa}/{{z}}/{{x}}/{{y}}.png?v={version}",
+            attr="Datos propios",
+            name=f"Densidad de {capa}",
+            overlay=True,
+            control=True,
+            show=capa == "afiliados",
+            min_zoom=TESELAS_ZOOM_MIN,
+            max_native_zoom=TESELAS_ZOOM_MAX,
+        )
+        for capa in TESELAS_CAPAS
+    ]
+
+
+# --- EXPORTACIONES ---
+
+# Se generan recién al hacer click en descargar, por lotes directo a disco, y quedan guardadas
+# por clave de filtro y versión de los datos, en una carpeta por fecha de carga. Las carpetas de
+# cargas anteriores se borran cuando nadie las usó en EXPORTACIONES_GRACIA_SEG: otras sesiones
+# (otra provincia, otro proceso que todavía no tomó la carga nueva) pueden estar usándolas
+EXPORTACIONES_DIR = SNAPSHOT_DIR / "exportaciones"
+EXPORTACIONES_GRACIA_SEG = 60 * 60
+EXPORTACION_FILAS_POR_LOTE = 200_000
+EXCEL_MAX_FILAS = 1_048_575 # Tope de filas de una hoja, sin contar el encabezado
+
+FORMATOS_EXPORTACION = {
+    "CSV": (".csv", "text/csv"),
+    "CSV comprimido (zip)": (".zip", "application/zip"),
+    "Parquet": (".parquet", "application/vnd.apache.parquet"),
+    "Excel": (".xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+}
+
+
+def lotes_de_filas(df):
+    for inicio in range(0, max(len(df), 1), EXPORTACION_FILAS_POR_LOTE):
+        yield df.iloc[inicio:inicio + EXPORTACION_FILAS_POR_LOTE]
+
+
+def escribir_exportacion(df, ruta, formato, nombre):
+    """Escribe df en 'ruta' de a EXPORTACION_FILAS_POR_LOTE filas: nunca se arma el archivo
+    entero (ni el texto del CSV) en memoria."""
+    if formato == "CSV":
+        with open(ruta, "w", encoding="utf-8-sig", newline="") as f:
+            for i, lote in enumerate(lotes_de_filas(df)):
+                lote.to_csv(f, index=False, header=i == 0)
+    elif formato == "CSV comprimido (zip)":
+        with zipfile.ZipFile(ruta, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            with zf.open(f"{nombre}.csv", "w", force_zip64=True) as crudo, io.TextIOWrapper(crudo, encoding="utf-8-sig", newline="") as f:
+                for i, lote in enumerate(lotes_de_filas(df)):
+                    lote.to_csv(f, index=False, header=i == 0)
+    elif formato == "Parquet":
+        escritor = None
+        try:
+            for lote in lotes_de_filas(df):
+                tabla = pa.Table.from_pandas(lote, preserve_index=False)
+                escritor = escritor or pq.ParquetWriter(ruta, tabla.schema, compression="zstd")
+                escritor.write_table(tabla)
+        finally:
+            if escritor is not None:
+                escritor.close()
+    elif formato == "Excel":
+        if len(df) > EXCEL_MAX_FILAS:
+            raise ValueError(f"{formato_miles(len(df))} filas no entran en una hoja de Excel; use CSV o Parquet")
+        from openpyxl import Workbook
+        libro = Workbook(write_only=True) # Escribe las filas a disco a medida que llegan
+        hoja = libro.create_sheet(nombre[:31])
+        hoja.append([str(c) for c in df.columns])
+        for lote in lotes_de_filas(df):
+            for fila in lote.astype(object).where(lote.notna(), None).itertuples(index=False, name=None):
+                hoja.append(fila)
+        libro.save(ruta)
+    else:
+        raise ValueError(f"Formato de exportación desconocido: {formato}")
+
+
+def exportar(nombre, clave, formato, obtener_df):
+    """Bytes del archivo de exportación 'nombre' para 'clave' (filtros y lo que lo defina) en
+    'formato'. Si ya se generó para esta versión de los datos se lee del disco; si no, se
+    escribe con obtener_df(). Pensada para el data= (callable) de st.download_button."""
+    version, *resto = clave
+    cargado_en = cargado_en_version(version)
+    carpeta = EXPORTACIONES_DIR / (f"{cargado_en:%Y-%m-%dT%H-%M-%S}" if cargado_en else "sin_version")
+    extension = FORMATOS_EXPORTACION[formato][0]
+    # La versión completa va en el nombre: con carga por provincia comparten carpeta versiones distintas
+    ruta = carpeta / f"{nombre}_{hashlib.blake2b(repr((version, resto)).encode(), digest_size=8).hexdigest()}{extension}"
+    try:
+        datos = ruta.read_bytes()
+        os.utime(carpeta) # En uso: que nadie la borre por vieja
+        return datos
+    except FileNotFoundError:
+        pass
+    if cargado_en:
+        borrar_exportaciones_viejas(cargado_en)
+    carpeta.mkdir(parents=True, exist_ok=True)
+    tmp = ruta.with_name(f"{ruta.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        escribir_exportacion(obtener_df(), tmp, formato, nombre)
+        os.replace(tmp, ruta)
+    finally:
+        tmp.unlink(missing_ok=True)
+    return ruta.read_bytes()
+
+
+def borrar_exportaciones_viejas(cargado_en):
+    # Solo carpetas de cargas anteriores a 'cargado_en' y sin uso en el período de gracia
+    # (escribir o leer un archivo actualiza la fecha de la carpeta)
+    if not EXPORTACIONES_DIR.exists():
+        return
+    limite = time.time() - EXPORTACIONES_GRACIA_SEG
+    for carpeta in EXPORTACIONES_DIR.iterdir():
+        try:
+            de_antes = datetime.strptime(carpeta.name, "%Y-%m-%dT%H-%M-%S") < cargado_en
+        except ValueError:
+            de_antes = True # Nombres de antes de agrupar por fecha de carga
+        try:
+            if de_antes and carpeta.stat().st_mtime < limite:
+                shutil.rmtree(carpeta, ignore_errors=True)
+        except FileNotFoundError:
+            pass # La borró otro proceso
+
+
+def boton_exportacion(label, nombre, clave, obtener_df, key):
+    """Selector de formato y botón de descarga. El archivo se genera solo al hacer click."""
+    formato = st.selectbox("Formato", list(FORMATOS_EXPORTACION), key=f"{key}_formato", label_visibility="collapsed")
+    extension, mime = FORMATOS_EXPORTACION[formato]
+    return st.download_button(
+        label=label,
+        data=lambda: exportar(nombre, clave, formato, obtener_df),
+        file_name=f"{nombre}{extension}",
+        mime=mime,
+        key=key,
+    )
 
-        dist_prom_filtrada = data_filtrada['dist_media'].mean()
 
-        st.sidebar.metric("Distancia Promedio", f"{formato_es(dist_prom_filtrada)} km")
+# --- 3. INTERFAZ Y FILTROS ---
 
-    
-    st.sidebar.markdown("---")
+def reiniciar_filtros():
+    registrar_interaccion("reiniciar_filtros")
+    st.session_state['provincia'] = "Todas"
+    st.session_state['especialidad'] = "Todas"
+    st.session_state['localidad'] = "Todas"
+    if 'distancia' in st.session_state:
+        # Esto resetea el slider si le pones key='distancia'
+        del st.session_state['distancia']
 
-    # Métricas de Farmacias
+TIPOS_DE_VISTA = ["Marcadores (Localidades)", "Heatmap (Distribución de Afiliados)", "Detalle según zoom (área visible)", "Densidad nacional (teselas)"]
 
-    st.sidebar.write(f"**Farmacias**")
-    # Filtramos la base original para contar solo farmacias en la zona elegida
-    total_base_farmacias = len(cons_base_f[cons_base_f['DESC_TIPO_EFECTOR'] == 'FARMACIA'])
-    st.sidebar.write(f"Total Base Filtrada: {formato_miles(total_base_farmacias)}")
-    st.sidebar.write(f"En Mapa: {formato_miles(len(farmacias_f))}")
-    st.sidebar.info(f"Éxito Geo: {formato_porcentaje(len(farmacias_f), total_base_farmacias)}")
 
+def registrar_interaccion(nombre):
+    # on_change de los widgets: con qué interacción se mide el rerun que sigue
+    st.session_state.interaccion = nombre
 
-    
-# --- MAPA CON ZOOM DINÁMICO ---
+
+@st.fragment
+def acceso_staff():
+    # Escribir la clave o equivocarse solo vuelve a correr este fragmento; al entrar hace falta
+    # un rerun completo para que aparezca el panel de staff
+    with st.expander("🔑 Acceso Staff"):
+        password = st.text_input("Contraseña", type="password", autocomplete="one-time-code")
+        if st.button("Iniciar sesión"):
+            if password == CLAVE_DESARROLLADOR:
+                st.session_state.es_dev = True
+                registrar_interaccion("acceso_staff")
+                st.rerun()
+            else:
+                st.error("Clave incorrecta")
+
+
+@st.fragment
+def seccion_mapa(datos, cubo, filtros, data_filtrada, perfil):
+    """Mapa con su selector de vista. Cambiar la vista o mover el mapa solo rearma esto."""
+    perfil = perfil_fragmento(perfil, "mapa")
+    afi_base, df_cons_raw, afi_geo_all, cons_geo_all = datos
+    prov_sel, loc_sel, esp_sel, dist_range = filtros
+    # Las teselas son de todo el país por afiliado: con carga por provincia no hay con qué armarlas
+    tipos = [tipo for tipo in TIPOS_DE_VISTA if not (CARGA_POR_PROVINCIA and tipo == "Densidad nacional (teselas)")]
+    tipo_mapa = st.radio("Tipo de Vista", tipos, key="tipo_mapa", horizontal=True,
+                         on_change=registrar_interaccion, args=("tipo_mapa",))
+    ver_desatendidas = st.checkbox(f"Zonas desatendidas (grilla de {SUPERFICIE_CELDA_KM} km)", key="ver_desatendidas",
+                                   on_change=registrar_interaccion, args=("zonas_desatendidas",))
+    if ver_desatendidas and cubo.con_afiliados:
+        umbral = st.slider("Consultorio más cercano a más de (Km)", 5, 200, SUPERFICIE_UMBRAL_KM, step=5, key="umbral_desatendidas",
+                           on_change=registrar_interaccion, args=("zonas_desatendidas",))
+
+    # --- MAPA CON ZOOM DINÁMICO ---
     if not data_filtrada.empty:
         centro = [data_filtrada['lat_ref'].mean(), data_filtrada['lon_ref'].mean()]
         zoom = 4 if prov_sel == "Todas" else 7
@@ -560,51 +2848,118 @@ try:
         centro, zoom = [-38.4161, -63.6167], 4
 
     m = folium.Map(location=centro, zoom_start=zoom, tiles="cartodbpositron")
+    # Solo las vistas que dependen del área visible piden zoom y bounds; las demás no devuelven nada,
+    # así mover el mapa no vuelve a correr el fragmento (con None st_folium devuelve todo)
+    capa_dinamica, objetos_devueltos = None, []
 
     if tipo_mapa == "Marcadores (Localidades)":
-        for _, row in data_filtrada.iterrows():
-
-            # Definimos qué mostrar en la distancia y en el ratio si no hay afiliados
-            distancia_label = "-" if row['cant_afiliados'] == 0 else f"{formato_es(row['dist_media'])} km"
-
-            # Construcción del Tooltip con HTML y CSS para recuperar el diseño anterior
-            tooltip_txt = f"""
-                <div style="font-family: Arial; width: 220px;">
-                    <h4 style="margin-bottom:5px; color:#1f77b4;">{row['LOCALIDAD']}</h4>
-                    <p style="font-size:12px; color:gray; margin-top:0;">{row['PROVINCIA']}</p>
-                    <hr style="margin:5px 0;">
-                    <b>Afiliados:</b> {formato_miles(row['cant_afiliados'])}<br>
-                    <b>Farmacias:</b> {formato_miles(row['cant_farmacias'])}<br>
-                    <b>Consultorios:</b> {formato_miles(row['cant_consultorios'])}<br>
-                    <b>Cons./Afiliados:</b> {formato_es(row['cons_por_afi']) if pd.notna(row['cons_por_afi']) else "-"}<br>
-                    <b>Dist. Media:</b> {distancia_label}
-                </div>
-            """
-            
-            if row['cant_afiliados'] == 0:
-                color = "#95a5a6" # GRIS: Solo consultorios (capacidad ociosa)
-            elif row['cant_consultorios'] == 0:
-                color = "#d62728" # ROJO: Afiliados sin consultorio local
-            else:
-                color = "#1f77b4" # AZUL: Localidad con ambos servicios
-                
-            
-            folium.CircleMarker(
-                location=[row['lat_ref'], row['lon_ref']],
-                radius=min(25, 5 + (row['cant_afiliados'] / 100)),
-                tooltip=folium.Tooltip(tooltip_txt), # Usamos el HTML aquí
-                color=color, 
-                fill=True, 
-                fill_opacity=0.6
-            ).add_to(m)
+        capa_marcadores(data_filtrada).add_to(m)
+    elif tipo_mapa == "Densidad nacional (teselas)":
+        # Imágenes ya generadas: no se manda ningún dato, el navegador pide las teselas que ve
+        estado_teselas = teselas_densidad(afi_geo_all.attrs.get('version_datos'), afi_geo_all, cons_geo_all)
+        for capa in capas_teselas(afi_geo_all.attrs.get('version_datos')):
+            capa.add_to(m)
+        folium.LayerControl(collapsed=False).add_to(m)
+        if not estado_teselas["listas"]:
+            st.caption("Generando las teselas de esta carga de datos; mientras tanto se ven las de la carga anterior (si las hay).")
+        st.caption("Esta vista muestra todo el país y no aplica los filtros.")
     else:
-        # Heatmap (Sigue igual)
-        heat_data = [[row['lat_ref'], row['lon_ref'], row['cant_afiliados']] for _, row in data_filtrada.iterrows()]
-        HeatMap(heat_data, radius=15, blur=10).add_to(m)
+        # Estas vistas dependen del zoom y del área visible que devolvió st_folium en el rerun anterior
+        # (si el mapa se volvió a montar, esos valores son del mapa viejo y se arranca del inicial).
+        # Van como capa dinámica de st_folium, así al moverse se cambia la capa sin recargar el mapa
+        vista = (tuple(centro), zoom, tipo_mapa)
+        estado_mapa = (st.session_state.get('mapa_dinamico') or {}) if st.session_state.get('vista_mapa') == vista else {}
+        st.session_state.vista_mapa = vista
+        zoom_actual = estado_mapa.get('zoom') or zoom
+        caja = caja_con_margen(estado_mapa.get('bounds'))
+        objetos_devueltos = ["zoom", "bounds"]
+        inicio = time.perf_counter()
+
+        if tipo_mapa == "Heatmap (Distribución de Afiliados)":
+            # Heatmap por afiliado: celdas de la grilla del zoom actual, no un punto por localidad
+            piramide = piramide_calor(cubo, afi_geo_all, data_filtrada, (prov_sel, loc_sel, esp_sel, tuple(dist_range)))
+            nivel, heat_data = piramide.puntos(zoom_actual, caja)
+            m.add_js_link("leaflet_heat", HeatMap.default_js[0][1]) # La capa dinámica no trae su JS
+            capa_dinamica = folium.FeatureGroup(name="Afiliados")
+            HeatMap(heat_data, radius=15, blur=10).add_to(capa_dinamica)
+            elementos = {"celdas": len(heat_data), "zoom_grilla": nivel}
+            if not cubo.con_afiliados:
+                st.caption("Con la carga por provincia el heatmap necesita los afiliados de una provincia: elíjala en el filtro.")
+        else:
+            # Lejos, provincias; más cerca, localidades; y de cerca, además cada consultorio
+            capa_dinamica = folium.FeatureGroup(name="Detalle")
+            if zoom_actual < ZOOM_LOCALIDADES:
+                marcas = en_viewport(resumen_provincias(data_filtrada), caja)
+            else:
+                marcas = en_viewport(data_filtrada, caja)
+            capa_marcadores(marcas).add_to(capa_dinamica)
+            elementos = {"marcas": len(marcas), "nivel": "provincias" if zoom_actual < ZOOM_LOCALIDADES else "localidades"}
+            if zoom_actual >= ZOOM_CONSULTORIOS and caja is not None:
+                filas = consultorios_en_caja(cons_geo_all, caja, prov_sel, loc_sel, esp_sel)
+                capa_consultorios(cons_geo_all, filas).add_to(capa_dinamica)
+                elementos["consultorios"] = len(filas)
+
+        st.session_state.detalle_mapa = {
+            "zoom": zoom_actual, "area": None if caja is None else [round(v, 4) for v in caja],
+            **elementos, "ms": round((time.perf_counter() - inicio) * 1000, 2),
+        }
 
-    st_folium(m, width="100%", height=550, key="mapa_dinamico")
+    # Zonas desatendidas: celdas de la superficie de cobertura de la especialidad (no la localidad ni el rango de distancia)
+    if ver_desatendidas and cubo.con_afiliados:
+        superficie = superficie_cobertura(afi_geo_all, cons_geo_all, esp_sel)
+        celdas = superficie.desatendidas(umbral, prov_sel)
+        capa_desatendidas(celdas.head(SUPERFICIE_MAX_CELDAS_MAPA), umbral).add_to(m)
+        perfil.marcar("zonas_desatendidas", len(celdas))
+
+    perfil.marcar("mapa", len(data_filtrada))
+    st_folium(m, width="100%", height=550, key="mapa_dinamico", feature_group_to_add=capa_dinamica, returned_objects=objetos_devueltos,
+              on_change=lambda: registrar_interaccion("mover_mapa"))
+    perfil.marcar("st_folium")
+
+    if ver_desatendidas and not cubo.con_afiliados:
+        st.caption("Con la carga por provincia las zonas desatendidas necesitan los afiliados de una provincia: elíjala en el filtro.")
+    elif ver_desatendidas:
+        en_mapa = "" if len(celdas) <= SUPERFICIE_MAX_CELDAS_MAPA else f" (en el mapa, las {formato_miles(SUPERFICIE_MAX_CELDAS_MAPA)} con más afiliados)"
+        st.caption(
+            f"{formato_miles(len(celdas))} celdas de {SUPERFICIE_CELDA_KM} km con {formato_miles(celdas['afiliados'].sum())} afiliados "
+            f"a más de {umbral} km del consultorio más cercano ({esp_sel if esp_sel != 'Todas' else 'cualquier especialidad'}){en_mapa}. "
+            f"Se mide desde el centro de cada celda; no aplica el filtro de localidad ni el de distancia."
+        )
+        boton_exportacion(
+            "📥 Descargar zonas desatendidas",
+            f"zonas_desatendidas_{prov_sel.lower()}",
+            (afi_geo_all.attrs.get('version_datos'), prov_sel, esp_sel, umbral),
+            lambda: lista_desatendidas(celdas),
+            key="btn_descarga_desatendidas",
+        )
+    cerrar_perfil_fragmento(perfil)
+
+
+def tabla_formateada(data_filtrada):
+    """Tabla de localidades como texto, tal como se muestra y se descarga (la descarga usa
+    este mismo frame). Los números se formatean por columna, el "-" evita que Streamlit muestre "None"."""
+    tabla_display = data_filtrada[['LOCALIDAD', 'PROVINCIA', 'cant_afiliados', 'cant_farmacias', 'cant_consultorios', 'dist_media', 'cons_por_afi']]
+    cons_por_afi = tabla_display['cons_por_afi']
+    return pd.DataFrame({
+        'Localidad': tabla_display['LOCALIDAD'],
+        'Provincia': tabla_display['PROVINCIA'],
+        # Afiliados, Farmacias y Consultorios a entero con punto de miles
+        'Afiliados': formato_miles_serie(tabla_display['cant_afiliados']),
+        'Farmacias': formato_miles_serie(tabla_display['cant_farmacias']),
+        'Consultorios': formato_miles_serie(tabla_display['cant_consultorios']),
+        # Distancia Media con coma decimal
+        'Dist. Media (Km)': numeros_es(tabla_display['dist_media'], 1),
+        'Cons./Afiliados': formato_es_serie(cons_por_afi).where(np.isfinite(cons_por_afi.to_numpy(dtype=np.float64, na_value=np.nan)), "-"),
+    })
+
+
+@st.fragment
+def seccion_tabla(datos, filtros, df_styled, perfil):
+    """Tabla de localidades y su descarga. Elegir el formato no vuelve a correr el resto."""
+    perfil = perfil_fragmento(perfil, "tabla")
+    afi_geo_all = datos[2]
+    prov_sel, loc_sel, esp_sel, dist_range = filtros
 
-    
     # --- TABLA DE DATOS ---
 
     st.markdown("---")
@@ -612,103 +2967,505 @@ try:
     st.subheader(f"📋 Detalle de Localidades ({prov_sel})", anchor=False)
 
 
-    # Preparación de la tabla
+    # 4. Mostramos la tabla (ya procesada como texto para evitar el "None")
+    st.dataframe(df_styled, use_container_width=True)
+
+    # --- DESCARGA ---
+    # Usamos la misma lógica para que el archivo sea consistente con la tabla
+    boton_exportacion(
+        "📥 Descargar tabla",
+        f"reporte_cobertura_{prov_sel.lower()}",
+        (afi_geo_all.attrs.get('version_datos'), prov_sel, loc_sel, esp_sel, tuple(dist_range)),
+        lambda: df_styled,
+        key="btn_descarga_tabla",
+    )
+    perfil.marcar("tabla", len(df_styled))
+    cerrar_perfil_fragmento(perfil)
+
+
+@st.fragment
+def panel_staff(datos, cubo, data_filtrada, perfil):
+    """Panel de desarrolladores. Sus botones y descargas solo vuelven a correr el panel."""
+    perfil = perfil_fragmento(perfil, "panel_staff")
+    afi_base, df_cons_raw, afi_geo_all, cons_geo_all = datos
+    tipo_mapa = st.session_state.get('tipo_mapa')
+
+    st.markdown("---")
+    st.subheader("🛠️ Descargas de Auditoría (Registros no localizados)")
+    st.info("Estos archivos contienen los registros originales que no pudieron ser ubicados en el mapa por errores de coordenadas o país. Las coordenadas salen con la precisión que se guarda en memoria (unas 7 cifras).")
+
+    col1, col2 = st.columns(2)
+
+    version_datos = afi_geo_all.attrs.get('version_datos')
+
+    # 1. Afiliados no encontrados
+    # Comparamos la base total vs los que sí entraron al mapa (la base original mantiene el formato)
+    afi_no_encontrados = ~afi_base['AFI_ID'].isin(afi_geo_all['AFI_ID'].unique()).to_numpy()
+
+    with col1:
+        st.write(f"**Afiliados no localizados:** {formato_miles(int(afi_no_encontrados.sum()))}")
+        boton_exportacion(
+            "📥 Descargar Afiliados No Localizados",
+            "afiliados_no_localizados",
+            (version_datos,),
+            lambda: registros_originales(afi_base[afi_no_encontrados]),
+            key="btn_dev_afi",
+        )
+
+    # 2. Consultorios no encontrados
+    # Comparamos por índice para ser precisos con los originales
+    cons_no_encontrados = ~df_cons_raw.index.isin(cons_geo_all.index)
+
+    with col2:
+        st.write(f"**Consultorios no localizados:** {formato_miles(int(cons_no_encontrados.sum()))}")
+        boton_exportacion(
+            "📥 Descargar Consultorios No Localizados",
+            "consultorios_no_localizados",
+            (version_datos,),
+            lambda: registros_originales(df_cons_raw[cons_no_encontrados]),
+            key="btn_dev_cons",
+        )
+
+    # 3. Memoria asignada por rerun
+    st.subheader("📏 Memoria asignada por rerun", anchor=False)
+    st.checkbox("Medir asignaciones en cada rerun (tracemalloc, hace todo más lento)", key="medir_asignaciones")
+    if 'asignaciones_rerun' in st.session_state:
+        st.caption("Último rerun de esta sesión (mientras mide, también cuenta lo que hagan otras sesiones):")
+        st.json(st.session_state.asignaciones_rerun)
+
+    # 4. Caché de árboles por especialidad
+    st.subheader("🌳 Caché de árboles por especialidad", anchor=False)
+    st.json(cache_kdtree().estado())
+    st.caption("Grillas del heatmap por filtro:")
+    st.json(cache_piramides().estado())
+    st.caption("Resultados por filtro (localidades, métricas y tabla formateada):")
+    st.json(cache_resultados().estado())
+    st.caption(f"Superficies de cobertura (grilla de {SUPERFICIE_CELDA_KM} km) por especialidad:")
+    st.json(cache_superficies().estado())
+
+    # Matriz afiliados x especialidades
+    estado_matriz = matriz_distancias(afi_geo_all.attrs.get('version_datos'), afi_geo_all, cons_geo_all)
+    if estado_matriz["error"]:
+        st.error(f"Matriz de distancias: {estado_matriz['error']}")
+    elif estado_matriz["matriz"] is None:
+        st.caption("Matriz de distancias: calculando (mientras tanto se usa la caché de árboles)." if matriz_activa() else "Matriz de distancias: desactivada.")
+    else:
+        filas, columnas = estado_matriz["matriz"].shape
+        st.caption(
+            f"Matriz de distancias ({MATRIZ_DISTANCIAS}): {formato_miles(filas)} afiliados × {formato_miles(columnas)} especialidades, "
+            f"{formato_es(estado_matriz['matriz'].nbytes / 2**20)} MB, calculada en {formato_es(estado_matriz['segundos'])} s"
+        )
+
+    # Cubo de cobertura
+    st.caption(
+        f"Cubo de cobertura: {formato_miles(cubo.n)} localidades × {formato_miles(len(cubo.especialidades))} especialidades "
+        f"({formato_miles(cubo.especialidades_preparadas)} con distancias agregadas), {formato_es(cubo.nbytes / 2**20)} MB"
+    )
+
+    # Teselas de densidad
+    estado_teselas = None if CARGA_POR_PROVINCIA else teselas_densidad(afi_geo_all.attrs.get('version_datos'), afi_geo_all, cons_geo_all)
+    if estado_teselas is None:
+        st.caption("Teselas de densidad: desactivadas con la carga por provincia.")
+    elif estado_teselas["error"]:
+        st.error(f"Teselas de densidad: {estado_teselas['error']}")
+    elif not estado_teselas["listas"]:
+        st.caption("Teselas de densidad: generando en segundo plano.")
+    else:
+        st.caption(f"Teselas de densidad (zoom {TESELAS_ZOOM_MIN} a {TESELAS_ZOOM_MAX}), generadas en {formato_es(estado_teselas['segundos'])} s:")
+        st.json(estado_teselas["capas"])
+
+    # 5. Snapshot local
+    st.subheader("💾 Snapshot local", anchor=False)
+    if CARGA_POR_PROVINCIA:
+        estado = particiones()
+        nombres = sorted(unquote(ruta.name.removesuffix(".json")) for ruta in PARTICIONES_DIR.glob("*.json"))
+        manifiestos = {nombre: leer_manifiesto_particion(nombre) for nombre in nombres}
+        guardadas = pd.DataFrame([
+            {"partición": "Totales y consultorios" if nombre == PARTICION_NACIONAL else nombre,
+             "cargada": m['cargado_en'], "filas": sum(m['filas'].values()), "segundos_base": m['segundos_base'],
+             "actualizando": nombre in estado["actualizando"], "error": estado["errores"].get(nombre)}
+            for nombre, m in manifiestos.items() if m is not None
+        ])
+        st.caption(f"Carga por provincia: {formato_miles(len(guardadas))} particiones guardadas · Vencen cada {SNAPSHOT_TTL_SEG // 60} min")
+        st.dataframe(guardadas, hide_index=True)
+        st.caption("En memoria (provincias ya procesadas):")
+        st.json(cache_particiones().estado())
+        prov_actual = st.session_state.get('provincia', "Todas")
+        if st.button("🔄 Actualizar ahora (totales y provincia elegida)", key="btn_dev_particiones"):
+            arrancadas = actualizar_particiones([] if prov_actual == "Todas" else [prov_actual])
+            if arrancadas:
+                st.success(f"{arrancadas} actualizaciones iniciadas en segundo plano.")
+            else:
+                st.info("Ya hay una actualización en curso.")
+    else:
+        manifiesto = leer_manifiesto()
+        if manifiesto:
+            st.caption(
+                f"Última carga: **{manifiesto['cargado_en']}** ({manifiesto['tipo']}) · "
+                f"Última completa: {manifiesto['ultima_completa']} (se repite cada {RECARGA_COMPLETA_SEG // 3600} h) · "
+                f"Cambios: {formato_miles(manifiesto['cambios_afiliados'])} afiliados, "
+                f"{formato_miles(manifiesto['cambios_consultorios'])} consultorios · "
+                f"Bajas: {formato_miles(manifiesto.get('bajas_afiliados', 0))} afiliados, "
+                f"{formato_miles(manifiesto.get('bajas_consultorios', 0))} consultorios "
+                f"en {formato_es(manifiesto.get('segundos_base', 0))} s · "
+                f"Vence cada {SNAPSHOT_TTL_SEG // 60} min"
+            )
+        puntero = leer_puntero_almacen()
+        if puntero:
+            propia, mapeada = _leer_status_kb("RssAnon"), _leer_status_kb("RssFile")
+            memoria = "" if propia is None else f" · Este proceso (pid {os.getpid()}): {formato_es(propia / 1024)} MB propios y {formato_es(mapeada / 1024)} MB de archivos mapeados"
+            st.caption(
+                f"Almacén compartido: versión **{puntero['version']}** ({formato_es(puntero['mb'])} MB, publicada {puntero['publicado_en']})"
+                + ("" if afi_base.attrs.get('almacen') else " · este proceso todavía usa una copia propia") + memoria
+            )
+        col_delta, col_completa = st.columns(2)
+        with col_delta:
+            refrescar = st.button("🔄 Actualizar ahora (solo cambios)", key="btn_dev_delta")
+        with col_completa:
+            recargar = st.button("♻️ Recarga completa", key="btn_dev_completa")
+        if refrescar or recargar:
+            if actualizar_en_segundo_plano(completa=recargar, forzar=True):
+                st.success("Actualización iniciada en segundo plano.")
+            else:
+                st.info("Ya hay una actualización en curso.")
+
+    # 6. Memoria de la carga
+    st.subheader("🧮 Memoria de la carga de afiliados", anchor=False)
+    st.caption("Trae los afiliados dos veces (camino anterior y en lotes) y mide el pico de RSS de cada uno.")
+    if st.button("Medir memoria", key="btn_dev_memoria"):
+        with st.spinner("Cargando afiliados con ambos caminos..."):
+            st.session_state.memoria_carga = comparar_memoria_carga()
+    if 'memoria_carga' in st.session_state:
+        st.json(st.session_state.memoria_carga)
+
+    # 7. Representación en memoria
+    st.subheader("📦 Representación en memoria", anchor=False)
+    st.caption("Compara memoria y tiempo de los filtros de igualdad: esquema compacto (categorías, float32) contra strings y float64.")
+    if st.button("Comparar representación", key="btn_dev_representacion"):
+        st.session_state.representacion = comparar_representacion(
+            {"afi_base": afi_base, "df_cons_raw": df_cons_raw, "afi_geo_all": afi_geo_all, "cons_geo_all": cons_geo_all},
+            prov=afi_geo_all['PROVINCIA'].value_counts().index[0],
+            esp=cons_geo_all['ESPECIALIDAD'].value_counts().index[0],
+        )
+    if 'representacion' in st.session_state:
+        st.json(st.session_state.representacion)
+
+    # 8. Construcción del mapa (la comparación con el bucle anterior está en benchmarks/bench.py)
+    if 'detalle_mapa' in st.session_state and tipo_mapa != "Marcadores (Localidades)":
+        st.subheader("🗺️ Construcción del mapa", anchor=False)
+        st.caption("Último armado de la capa del área visible (zoom, área con margen, elementos enviados y tiempo):")
+        st.json(st.session_state.detalle_mapa)
+
+    # 9. Paridad de la consulta de afiliados (correlacionada vs. por conjuntos)
+    st.subheader("🧪 Paridad de la consulta de afiliados", anchor=False)
+    st.caption(f"Variante en uso: **{MODO_EXTRACCION_AFILIADOS}**. La comparación corre ambas consultas contra la base, puede tardar varios minutos.")
+    if st.button("Comparar consultas", key="btn_dev_paridad"):
+        with st.spinner("Ejecutando ambas consultas..."):
+            st.session_state.paridad_afiliados = comparar_consultas_afiliados()
+    if 'paridad_afiliados' in st.session_state:
+        st.json(st.session_state.paridad_afiliados)
+
+    # 10. Tiempos por etapa
+    st.subheader("⏱️ Tiempos por etapa", anchor=False)
+    st.caption("Tiempo, filas y diferencia de RSS de cada etapa. La memoria es la del proceso entero: con otras sesiones activas es orientativa.")
+    registro = perfiles()
+    if registro["carga"]:
+        st.write(f"**Última carga de datos** ({registro['carga']['fecha']}, {formato_es(registro['carga']['segundos'])} s):")
+        st.dataframe(pd.DataFrame(registro["carga"]["etapas"]), hide_index=True)
+    if 'perfil_rerun' in st.session_state:
+        anterior = st.session_state.perfil_rerun
+        st.write(f"**Rerun anterior de esta sesión** ({anterior['tipo']}, {anterior['interaccion']}: {formato_es(anterior['segundos'] * 1000)} ms):")
+        st.dataframe(pd.DataFrame(st.session_state.perfil_rerun["etapas"]), hide_index=True)
+    por_interaccion, por_etapa = resumen_reruns()
+    if por_interaccion is not None:
+        st.write(f"**Últimos reruns de todas las sesiones** (hasta {PERFILES_RERUN_GUARDADOS}), por interacción y por etapa:")
+        st.dataframe(por_interaccion)
+        st.dataframe(por_etapa)
+    col_json, col_prom = st.columns(2)
+    with col_json:
+        st.download_button("📥 Exportar JSON", perfiles_json, file_name="perfiles_cobertura.json", mime="application/json", key="btn_dev_perfil_json")
+    with col_prom:
+        st.download_button("📥 Exportar Prometheus", perfiles_prometheus, file_name="cobertura.prom", mime="text/plain", key="btn_dev_perfil_prom")
+    perfil.marcar("panel_staff")
+    cerrar_perfil_fragmento(perfil)
+
+
+def main():
+    # Configuración de la página
+    st.set_page_config(page_title="Tablero de Cobertura Geográfica", layout="wide")
+
+    # Medición de memoria asignada durante el rerun (se activa desde el panel de staff)
+    if st.session_state.get('medir_asignaciones') and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    perfil = Perfil("rerun", interaccion=st.session_state.pop('interaccion', "otra"))
+
+    st.title("📍 Tablero de Gestión de Cobertura Sanitaria", anchor=False)
+
+    # --- SECCIÓN DE AYUDA / MANUAL ---
+    with st.expander("❓ ¿Cómo usar este tablero y qué significan las métricas?"):
+        st.subheader("📖 Guía de Usuario", anchor=False)
+
+        st.markdown("""
+        Este tablero permite analizar la relación geográfica entre nuestros **afiliados** y los **consultorios** disponibles.
+
+        * **Filtros:** Utilice el panel izquierdo para segmentar por provincia o ajustar el rango de distancia. 
+        * **Tipos de Vista:** 
+            * **Marcadores:** Muestra puntos exactos. El tamaño del círculo depende de la cantidad de afiliados. Los puntos rojos indican localidades que tienen afiliados pero **0 consultorios** localizados y los puntos grises
+            representan localidades que tienen consultorios pero ningún afiliado encontrado.
+            * **Heatmap:** Muestra la densidad de afiliados por domicilio (no por localidad). Las zonas rojas son las de mayor concentración; al acercar el zoom se ve el detalle dentro de cada ciudad.
+            * **Detalle según zoom:** Lejos muestra una marca por provincia, al acercarse las localidades y desde cerca también cada consultorio y farmacia. Solo se dibuja lo que está en el área visible.
+        """)
+
+        st.subheader("📊 Glosario de Métricas", anchor=False)
+
+        st.markdown("""
+        * **Éxito Geo:** Porcentaje de registros que tenían coordenadas válidas dentro de Argentina y pudieron ser mapeados.
+        * **Distancia Media:** Es el promedio de kilómetros que deben recorrer los afiliados para llegar al consultorio más cercano (en línea recta sobre la superficie terrestre).
+        * **Consultorios a ≤ 10 km:** Cuántos consultorios tiene en promedio cada afiliado dentro de ese radio, y qué porcentaje no tiene ninguno.
+        * **Cons./Afiliados:** Indica cuántos consultorios hay disponibles por cada afiliado en esa localidad.
+        """)
+
+    try:
 
-    tabla_display = data_filtrada[['LOCALIDAD', 'PROVINCIA', 'cant_afiliados', 'cant_farmacias', 'cant_consultorios', 'dist_media', 'cons_por_afi']].copy()
+        if CARGA_POR_PROVINCIA:
+            # Totales del país y consultorios; los afiliados de cada provincia se traen al elegirla
+            with st.spinner("Cargando los totales del país..."):
+                nacional = datos_nacionales(particion_al_dia(PARTICION_NACIONAL, traer_nacional)['cargado_en'])
+            datos = nacional["datos"]
+        else:
+            datos = datos_actuales()
+        if datos is None:
+            # Primer arranque sin snapshot: la carga desde la base corre en segundo plano
+            compartidos = datos_compartidos()
+            if compartidos["error"]:
+                st.error(f"Error en la base de datos: {compartidos['error']}")
+            else:
+                st.info("⏳ Cargando los datos por primera vez desde la base. El tablero aparece solo cuando termine.")
+            time.sleep(3)
+            st.rerun()
+        # Cada rerun trabaja de punta a punta con el dataset que tomó acá, aunque en el medio se reemplace
+        afi_base, df_cons_raw, afi_geo_all, cons_geo_all = datos
+        perfil.marcar("datos", len(afi_geo_all))
 
-    # 2. Renombramos columnas
-    tabla_display.columns = ['Localidad', 'Provincia', 'Afiliados', 'Farmacias', 'Consultorios', 'Dist. Media (Km)', 'Cons./Afiliados']
 
-    # 3. Formateamos las columnas numéricas fijas
-    # Afiliados, Farmacias y Consultorios a entero con punto de miles
-    # Distancia Media con coma decimal
 
-    df_styled = tabla_display.copy()
+        # --- SIDEBAR: FILTROS ---
 
-    # Aplicamos el formato manualmente a las columnas conflictivas para que Streamlit no use "None"
-    df_styled['Afiliados'] = df_styled['Afiliados'].apply(lambda x: f"{int(x):,}".replace(",", "."))
-    df_styled['Farmacias'] = df_styled['Farmacias'].apply(lambda x: f"{int(x):,}".replace(",", "."))
-    df_styled['Consultorios'] = df_styled['Consultorios'].apply(lambda x: f"{int(x):,}".replace(",", "."))
-    df_styled['Dist. Media (Km)'] = df_styled['Dist. Media (Km)'].apply(
-    lambda x: "-" if pd.isna(x) else f"{x:,.1f}".replace(",", "X").replace(".", ",").replace("X", ".")
-)
 
-    # LA CLAVE: Forzamos el guion en la columna Afiliados/Cons. antes de pasar al dataframe
-   # df_styled['Afiliados/Cons.'] = df_styled['Afiliados/Cons.'].apply(
-   # lambda x: "-" if (pd.isna(x) or np.isinf(x)) else f"{x:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
-   # )
+        # Inyectamos el CSS específico para el contenedor 'boton-reset'
+        st.markdown("""
+            <style>
+            div[data-testid="stVerticalBlock"] > div:has(div#boton-reset) button {
+                padding: 0px !important;
+                height: 32px !important;
+                width: 32px !important;
+                min-width: 32px !important;
+                border-radius: 5px;
+                line-height: 32px;
+            }
+            </style>
+        """, unsafe_allow_html=True)
 
-    df_styled['Cons./Afiliados'] = df_styled['Cons./Afiliados'].apply(lambda x: "-" if (pd.isna(x) or np.isinf(x)) else formato_es(x))
-    
-    
-    # 4. Mostramos la tabla (ya procesada como texto para evitar el "None")
-    st.dataframe(df_styled, use_container_width=True)
+        # Creamos dos columnas en el sidebar: 
+        # La primera (col_titulo) para el texto, la segunda (col_btn) muy estrecha para el botón.
+        col_titulo, col_btn = st.sidebar.columns([0.8, 0.2], vertical_alignment="center")
 
-    # --- DESCARGA ---
-    # Usamos la misma lógica para que el CSV sea consistente
-    csv = df_styled.to_csv(index=False).encode('utf-8-sig')
-    st.download_button(
-    label="📥 Descargar tabla como CSV",
-    data=csv,
-    file_name=f'reporte_cobertura_{prov_sel.lower()}.csv',
-    mime='text/csv',
-    )
+        with col_titulo:
+            st.header("🔍 Filtros")
 
-    # --- PANEL SOLO PARA DESARROLLADORES ---
-    if st.session_state.es_dev:
-        st.markdown("---")
-        st.subheader("🛠️ Descargas de Auditoría (Registros no localizados)")
-        st.info("Estos archivos contienen los registros originales que no pudieron ser ubicados en el mapa por errores de coordenadas o país.")
-        
-        col1, col2 = st.columns(2)
-
-        # 1. Afiliados no encontrados
-        # Comparamos la base total vs los que sí entraron al mapa
-        ids_en_mapa = afi_geo_all['AFI_ID'].unique()
-        # Usamos df_afi_raw (retornado por tu función) para mantener el formato original
-        afi_no_encontrados = afi_base[~afi_base['AFI_ID'].isin(ids_en_mapa)]
-
-        with col1:
-            st.write(f"**Afiliados no localizados:** {formato_miles(len(afi_no_encontrados))}")
-            btn_afi = st.download_button(
-                label="📥 Descargar Afiliados No Localizados",
-                data=afi_no_encontrados.to_csv(index=False).encode('utf-8-sig'),
-                file_name="afiliados_no_localizados.csv",
-                mime="text/csv",
-                key="btn_dev_afi"
-            )
+        with col_btn:
+            # Agregamos un margen superior pequeño para alinear el botón con el texto del header 
+            st.markdown('<div id="boton-reset">', unsafe_allow_html=True)
+            st.button("🔄", on_click=reiniciar_filtros, help="Reiniciar todos los filtros")
+            st.markdown('</div>', unsafe_allow_html=True)
 
-        # 2. Consultorios no encontrados
-        # Comparamos por índice para ser precisos con los originales
-        cons_en_mapa_idx = cons_geo_all.index
-        cons_no_encontrados = df_cons_raw[~df_cons_raw.index.isin(cons_en_mapa_idx)]
-
-        with col2:
-            st.write(f"**Consultorios no localizados:** {formato_miles(len(cons_no_encontrados))}")
-            btn_cons = st.download_button(
-                label="📥 Descargar Consultorios No Localizados",
-                data=cons_no_encontrados.to_csv(index=False).encode('utf-8-sig'),
-                file_name="consultorios_no_localizados.csv",
-                mime="text/csv",
-                key="btn_dev_cons"
-            )
 
-except Exception as e:
+        # --- SISTEMA DE ACCESO ---
+        st.sidebar.markdown("---")
+        # Inicializamos el estado si no existe
+        if 'es_dev' not in st.session_state:
+            st.session_state.es_dev = False
+
+        if not st.session_state.es_dev:
+            with st.sidebar:
+                acceso_staff()
+        else:
+            st.sidebar.success("🔓 Modo Desarrollador Activo")
+            if st.sidebar.button("Cerrar Sesión"):
+                st.session_state.es_dev = False
+                st.rerun()
+
+        # Frescura de los datos que se están mostrando
+        if CARGA_POR_PROVINCIA:
+            estado = particiones()
+            actualizando, error = bool(estado["actualizando"]), next(iter(estado["errores"].values()), None)
+        else:
+            compartidos = datos_compartidos()
+            actualizando, error = compartidos["actualizando"], compartidos["error"]
+        st.sidebar.caption(f"🕒 Datos al {texto_frescura(afi_geo_all.attrs.get('version_datos'))}")
+        if actualizando:
+            st.sidebar.caption("🔄 Actualizando en segundo plano; los datos nuevos se ven en la próxima interacción.")
+        elif error:
+            st.sidebar.warning(f"No se pudo actualizar desde la base, se muestran los datos anteriores: {error}")
+
+        # Filtro de Provincia
+        # Resumen por localidad y especialidad, armado una vez por carga de datos
+        if CARGA_POR_PROVINCIA:
+            cubo = nacional["cubo"]
+        else:
+            cubo = cubo_cobertura(afi_geo_all.attrs.get('version_datos'), afi_base, df_cons_raw, afi_geo_all, cons_geo_all)
+        list_prov = ["Todas"] + cubo.provincias()
+        perfil.marcar("cubo", cubo.n)
+
+        prov_sel = st.sidebar.selectbox("Seleccionar Provincia", list_prov, key='provincia', on_change=registrar_interaccion, args=("provincia",))
+        if CARGA_POR_PROVINCIA and prov_sel != "Todas":
+            # La provincia se trae de la base la primera vez que alguien la elige; después sale del disco o de memoria
+            with st.spinner(f"Cargando los afiliados de {prov_sel}..."):
+                datos, cubo = particion_provincia(prov_sel, nacional)
+            afi_base, df_cons_raw, afi_geo_all, cons_geo_all = datos
+            st.sidebar.caption(f"🕒 Afiliados de {prov_sel} al {texto_frescura(afi_geo_all.attrs.get('version_datos'))}")
+            perfil.marcar("particion", len(afi_geo_all))
+
+        # Filtro de Localidad (en cascada)
+        loc_sel = "Todas"
+        if prov_sel != "Todas":
+            # Solo mostramos localidades que pertenecen a la provincia elegida
+            list_loc = ["Todas"] + cubo.localidades_de(prov_sel)
+            loc_sel = st.sidebar.selectbox("Seleccionar Localidad", list_loc, key='localidad', on_change=registrar_interaccion, args=("localidad",))
+        else:
+            st.sidebar.warning("Seleccione una provincia para filtrar por localidad.")
+
+
+        # Filtro de Especialidad
+        list_esp = ["Todas"] + sorted(df_cons_raw['ESPECIALIDAD'].unique().tolist())
+        esp_sel = st.sidebar.selectbox("Seleccionar Especialidad", list_esp, key='especialidad', on_change=registrar_interaccion, args=("especialidad",))
+        # Contamos una vez por cambio de especialidad (no en cada rerun) para saber qué precalentar
+        if esp_sel != "Todas" and st.session_state.get('ultima_especialidad') != esp_sel:
+            registrar_uso_especialidad(esp_sel)
+        st.session_state.ultima_especialidad = esp_sel
+        # Arrancan en segundo plano una sola vez por carga de datos
+        matriz_distancias(afi_geo_all.attrs.get('version_datos'), afi_geo_all, cons_geo_all)
+        precalentar_kdtree(afi_geo_all.attrs.get('version_datos'), afi_geo_all, cons_geo_all)
+        if not CARGA_POR_PROVINCIA:
+            teselas_densidad(afi_geo_all.attrs.get('version_datos'), afi_geo_all, cons_geo_all)
+
+        # --- Usamos el máximo de la distancia media por localidad para que el slider sea coherente y redondeamos al entero superior ---
+        max_val = cubo.distancia_media_maxima()
+
+        if pd.isna(max_val): 
+            max_dist_data = 100 
+        else:
+            max_dist_data = int(math.ceil(max_val)) # Ejemplo: 268.14 -> 269
 
-      st.error(f"Error en la aplicación: {e}")
+        dist_range = st.sidebar.slider(
+            "Rango de Distancia Promedio (Km)",
+            0,                  # Mínimo entero
+            max_dist_data,      # Máximo entero redondeado
+            (0, max_dist_data), # Selección inicial
+            step=1,             # Saltos de 1 en 1 km
+            key='distancia',    # MANTENER ESTO para que funcione el botón reset
+            on_change=registrar_interaccion, args=("distancia",),
+        )
 
 
+        # --- APLICAR FILTROS ---
+        # Los filtros eligen filas (provincia/localidad) y una columna (especialidad) del cubo.
+        # La primera vez que se pide una especialidad en esta carga se agregan sus distancias
+        # (de la matriz o de la caché de árboles); después es solo sumar.
+        cubo.preparar_especialidad(esp_sel, lambda: distancias_para_cubo(afi_geo_all, cons_geo_all, esp_sel))
+        # El resultado (localidades, métricas y tabla formateada) queda en una caché compartida por filtro
+        data_filtrada, metricas, df_styled = resultado_filtro(cubo, afi_geo_all.attrs.get('version_datos'), (prov_sel, loc_sel, esp_sel, dist_range))
+        perfil.marcar("filtros", len(data_filtrada))
 
 
+        # --- SIDEBAR: MÉTRICAS RECALCULADAS ---
 
+        st.sidebar.markdown("---")
+
+        # Título dinámico según el nivel de filtro
+        titulo_stats = prov_sel if loc_sel == "Todas" else f"{loc_sel}, {prov_sel}"
+        st.sidebar.subheader(f"📊 Estadísticas: {titulo_stats}")
 
 
 
+        # Métricas de Afiliados
+        st.sidebar.write("**Afiliados**")
+        total_base_afiliados = metricas["base_afiliados"]
+        st.sidebar.write(f"Total Base Filtrada: {formato_miles(total_base_afiliados)}")
+        st.sidebar.write(f"En Mapa: {formato_miles(metricas['afiliados_en_mapa'])}")
+        st.sidebar.info(f"Éxito Geo: {formato_porcentaje(metricas['afiliados_en_mapa'], total_base_afiliados)}")
 
 
 
+        st.sidebar.markdown("---")
 
 
 
+        # Métricas de Consultorios
+        st.sidebar.write(f"**Consultorios ({esp_sel if esp_sel != 'Todas' else 'Totales'})**")
+        # Base original con los filtros de provincia/localidad/especialidad aplicados
+        total_base_medicos = metricas["base_medicos"]
+        st.sidebar.write(f"Total Base Filtrada: {formato_miles(total_base_medicos)}")
+        st.sidebar.write(f"En Mapa: {formato_miles(metricas['medicos_en_mapa'])}")
+        st.sidebar.info(f"Éxito Geo: {formato_porcentaje(metricas['medicos_en_mapa'], total_base_medicos)}")
+
+
+
+        # Métrica de Distancia Promedio (basada en el filtro aplicado)
+
+        if not data_filtrada.empty and cubo.con_afiliados:
+
+            st.sidebar.metric("Distancia Promedio", f"{formato_es(metricas['dist_promedio'])} km")
+
+        # Densidad de cobertura: consultorios a menos de COBERTURA_RADIO_KM de cada afiliado del filtro
+        if not cubo.con_afiliados:
+            st.sidebar.caption("Distancias y consultorios cercanos: elija una provincia (carga por provincia).")
+        elif metricas["afiliados_en_mapa"]:
+            st.sidebar.write(f"Consultorios a ≤ {COBERTURA_RADIO_KM} km: {formato_es(metricas['radio_suma'] / metricas['afiliados_en_mapa'])} por afiliado")
+            st.sidebar.info(f"Afiliados sin consultorio a ≤ {COBERTURA_RADIO_KM} km: {formato_porcentaje(metricas['radio_cero'], metricas['afiliados_en_mapa'])}")
+
+
+        st.sidebar.markdown("---")
+
+        # Métricas de Farmacias
+
+        st.sidebar.write(f"**Farmacias**")
+        # Filtramos la base original para contar solo farmacias en la zona elegida
+        total_base_farmacias = metricas["base_farmacias"]
+        st.sidebar.write(f"Total Base Filtrada: {formato_miles(total_base_farmacias)}")
+        st.sidebar.write(f"En Mapa: {formato_miles(metricas['farmacias_en_mapa'])}")
+        st.sidebar.info(f"Éxito Geo: {formato_porcentaje(metricas['farmacias_en_mapa'], total_base_farmacias)}")
+
+
+
+        perfil.marcar("metricas")
+
+        # Mapa, tabla y panel de staff son fragmentos: lo que se toca adentro de cada uno (tipo de
+        # vista, zoom, formato de descarga, botones del panel) vuelve a correr solo ese fragmento
+        filtros = (prov_sel, loc_sel, esp_sel, dist_range)
+        seccion_mapa(datos, cubo, filtros, data_filtrada, perfil)
+        seccion_tabla(datos, filtros, df_styled, perfil)
+
+        # --- PANEL SOLO PARA DESARROLLADORES ---
+        if st.session_state.es_dev:
+            panel_staff(datos, cubo, data_filtrada, perfil)
+
+    except Exception as e:
+
+          st.error(f"Error en la aplicación: {e}")
+
+    if tracemalloc.is_tracing():
+        asignado, pico = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        st.session_state.asignaciones_rerun = {
+            "asignado_al_final_mb": round(asignado / 2**20, 2),
+            "pico_mb": round(pico / 2**20, 2),
+        }
+    if perfil.etapas:
+        st.session_state.perfil_rerun = registrar_perfil(perfil)
 
 
+# Streamlit corre este archivo como __main__. Importado (por ejemplo desde benchmarks/) solo
+# define funciones y constantes, sin dibujar nada
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+"""Mide las etapas pesadas del tablero con datos sintéticos (ver datos_sinteticos.py) y una base
+SQLite local en lugar de Oracle, para comparar cambios de rendimiento sin depender de PROD.
+
+    python benchmarks/bench.py --afiliados 1000000 --repeticiones 3
+
+Cada corrida agrega una línea a benchmarks/resultados.jsonl (fecha, commit, escala, semilla,
+versiones de las librerías y tiempos por etapa) y muestra la diferencia con la corrida
+anterior de la misma escala y semilla.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+from datetime import datetime
+from pathlib import Path
+
+import folium
+import numpy as np
+import pandas as pd
+import scipy
+import streamlit.logger
+
+# Fuera de 'streamlit run' las cachés avisan en cada llamada que no hay contexto de sesión
+streamlit.logger.set_log_level(logging.ERROR)
+warnings.filterwarnings("ignore", message="CartoDB tiles") # Mismo mapa base que la app
+
+RAIZ = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(RAIZ))
+import app  # noqa: E402
+import datos_sinteticos  # noqa: E402
+
+RESULTADOS = Path(__file__).resolve().parent / "resultados.jsonl"
+
+# Sin la matriz en disco: las especialidades van por la caché de árboles y no queda un hilo
+# escribiendo en snapshot/ mientras se mide. La matriz se mide aparte, en memoria.
+app.MATRIZ_DISTANCIAS = None
+
+
+def medir(funcion, repeticiones):
+    """Corre 'funcion' varias veces y devuelve (mejor, mediana) en segundos y el último resultado."""
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        resultado = funcion()
+        tiempos.append(time.perf_counter() - inicio)
+    return {"mejor_s": round(min(tiempos), 4), "mediana_s": round(statistics.median(tiempos), 4)}, resultado
+
+
+def commit_actual():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=RAIZ, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def vaciar_cache_kdtree():
+    cache = app.cache_kdtree()
+    with cache.lock:
+        cache.entradas.clear()
+        cache.bytes = 0
+
+
+def capa_marcadores_bucle(m, data_filtrada):
+    """Cómo se armaba el mapa antes de capa_marcadores: un CircleMarker con su tooltip HTML por
+    localidad. Queda acá solo para medir contra la versión actual."""
+    for _, row in data_filtrada.iterrows():
+        distancia_label = "-" if row['cant_afiliados'] == 0 else f"{app.formato_es(row['dist_media'])} km"
+        tooltip_txt = f"""
+            <div style="font-family: Arial; width: 220px;">
+                <h4 style="margin-bottom:5px; color:#1f77b4;">{row['LOCALIDAD']}</h4>
+                <p style="font-size:12px; color:gray; margin-top:0;">{row['PROVINCIA']}</p>
+                <hr style="margin:5px 0;">
+                <b>Afiliados:</b> {app.formato_miles(row['cant_afiliados'])}<br>
+                <b>Farmacias:</b> {app.formato_miles(row['cant_farmacias'])}<br>
+                <b>Consultorios:</b> {app.formato_miles(row['cant_consultorios'])}<br>
+                <b>Cons./Afiliados:</b> {app.formato_es(row['cons_por_afi']) if pd.notna(row['cons_por_afi']) else "-"}<br>
+                <b>Dist. Media:</b> {distancia_label}
+            </div>
+        """
+        if row['cant_afiliados'] == 0:
+            color = app.COLOR_SOLO_CONSULTORIOS
+        elif row['cant_consultorios'] == 0:
+            color = app.COLOR_SIN_CONSULTORIO
+        else:
+            color = app.COLOR_AMBOS
+        folium.CircleMarker(
+            location=[row['lat_ref'], row['lon_ref']],
+            radius=min(25, 5 + (row['cant_afiliados'] / 100)),
+            tooltip=folium.Tooltip(tooltip_txt),
+            color=color,
+            fill=True,
+            fill_opacity=0.6
+        ).add_to(m)
+
+
+def tabla_formateada_por_celda(data_filtrada):
+    """Cómo se formateaba la tabla de localidades antes de app.tabla_formateada: un apply con
+    un format por celda. Queda acá solo para medir contra la versión por columna."""
+    df = data_filtrada[['LOCALIDAD', 'PROVINCIA', 'cant_afiliados', 'cant_farmacias', 'cant_consultorios', 'dist_media', 'cons_por_afi']].copy()
+    df.columns = ['Localidad', 'Provincia', 'Afiliados', 'Farmacias', 'Consultorios', 'Dist. Media (Km)', 'Cons./Afiliados']
+    for columna in ['Afiliados', 'Farmacias', 'Consultorios']:
+        df[columna] = df[columna].apply(lambda x: f"{int(x):,}".replace(",", "."))
+    df['Dist. Media (Km)'] = df['Dist. Media (Km)'].apply(
+        lambda x: "-" if pd.isna(x) else f"{x:,.1f}".replace(",", "X").replace(".", ",").replace("X", "."))
+    df['Cons./Afiliados'] = df['Cons./Afiliados'].apply(lambda x: "-" if (pd.isna(x) or np.isinf(x)) else app.formato_es(x))
+    return df
+
+
+def tooltips_por_celda(df):
+    # Textos del tooltip del mapa con formato_miles/formato_es fila por fila, como antes
+    return pd.DataFrame({'afiliados': df['cant_afiliados'].map(app.formato_miles),
+                         'cons_por_afi': df['cons_por_afi'].map(lambda x: app.formato_es(x) if pd.notna(x) else "-"),
+                         'distancia': df['dist_media'].map(app.formato_es)})
+
+
+def tooltips_por_columna(df):
+    return pd.DataFrame({'afiliados': app.formato_miles_serie(df['cant_afiliados']),
+                         'cons_por_afi': app.formato_es_serie(df['cons_por_afi']).where(df['cons_por_afi'].notna(), "-"),
+                         'distancia': app.formato_es_serie(df['dist_media'])})
+
+
+def combinaciones_filtro(cubo, cantidad):
+    """Filtros como los que arma la interfaz: nacional, cada provincia, algunas localidades y
+    especialidades, con y sin rango de distancia."""
+    maximo = cubo.distancia_media_maxima()
+    especialidades = [esp for esp in cubo.especialidades if esp != "Sin Dato"]
+    combinaciones = [("Todas", "Todas", "Todas", (0.0, maximo))]
+    for i, prov in enumerate(cubo.provincias()):
+        localidades = cubo.localidades_de(prov)
+        loc = localidades[i % len(localidades)] if i % 3 == 0 and localidades else "Todas"
+        esp = especialidades[i % len(especialidades)]
+        rango = (0.0, maximo) if i % 2 else (0.0, maximo / 4)
+        combinaciones.append((prov, loc, esp, rango))
+    return combinaciones[:cantidad]
+
+
+def correr(args):
+    etapas = {}
+    n_cons = args.consultorios or max(args.afiliados // 25, 100)
+
+    inicio = time.perf_counter()
+    df_afi = datos_sinteticos.generar_afiliados(args.afiliados, args.semilla)
+    df_cons = datos_sinteticos.generar_consultorios(n_cons, args.semilla)
+    ruta_db = args.sqlite or Path(tempfile.mkdtemp(prefix="bench_cobertura_")) / "cobertura.db"
+    datos_sinteticos.cargar_sqlite(ruta_db, df_afi, df_cons)
+    print(f"Datos: {len(df_afi):,} afiliados, {len(df_cons):,} consultorios ({time.perf_counter() - inicio:.1f} s, {ruta_db})")
+    del df_afi, df_cons
+
+    def cargar():
+        with datos_sinteticos.ConexionLocal(ruta_db) as conn:
+            return (app.leer_consulta_en_lotes(conn, "SELECT * FROM afiliados", filas_estimadas=args.afiliados),
+                    app.leer_consulta_en_lotes(conn, "SELECT * FROM consultorios", filas_estimadas=n_cons))
+
+    etapas["carga_lotes"], (afi_raw, cons_raw) = medir(cargar, args.repeticiones)
+    cons_raw = cons_raw[cons_raw['PAIS'].astype(str).str.upper() == 'ARGENTINA']
+    etapas["compactar"], (afi_c, cons_c) = medir(lambda: app.compactar_datos(afi_raw, cons_raw), args.repeticiones)
+    afi_c = afi_c.drop_duplicates(subset=['AFI_ID', 'CALLE', 'NUMERO'])
+    etapas["filtrar_geo"], (afi_geo, cons_geo) = medir(lambda: (app.filtrar_geo(afi_c), app.filtrar_geo(cons_c)), args.repeticiones)
+
+    medicos = cons_geo[~cons_geo['es_farmacia']]
+    etapas["kdtree_construccion"], indice = medir(
+        lambda: app.IndiceGeodesico(medicos['LATITUD'], medicos['LONGITUD']), args.repeticiones)
+    etapas["kdtree_consulta"], _ = medir(
+        lambda: app.distancia_mas_cercano(afi_geo['LATITUD'], afi_geo['LONGITUD'], indice), args.repeticiones)
+    etapas["procesar_datos"], (afi_base, cons_base, afi_geo_all, cons_geo_all) = medir(
+        lambda: app.procesar_datos(afi_raw, cons_raw, "bench"), args.repeticiones)
+    etapas["matriz_distancias"], _ = medir(
+        lambda: app.calcular_matriz_distancias(afi_geo_all, cons_geo_all), args.repeticiones)
+    medicos_geo = cons_geo_all[~cons_geo_all['es_farmacia']]
+    etapas["superficie_cobertura"], _ = medir(lambda: app.SuperficieCobertura(
+        afi_geo_all['LATITUD'].to_numpy(), afi_geo_all['LONGITUD'].to_numpy(), afi_geo_all['PROVINCIA'],
+        medicos_geo['LATITUD'].to_numpy(), medicos_geo['LONGITUD'].to_numpy()), args.repeticiones)
+
+    def armar_cubo():
+        vaciar_cache_kdtree() # Cada repetición arma los conteos en radio de cero
+        cubo = app.CuboCobertura(afi_base, cons_base, afi_geo_all, cons_geo_all)
+        cubo.preparar_especialidad("Todas", lambda: (
+            afi_geo_all['distancia_km'].to_numpy(),
+            app.conteos_en_radio(afi_geo_all, cons_geo_all, "Todas", app.COBERTURA_RADIO_KM),
+        ))
+        return cubo
+
+    etapas["cubo"], cubo = medir(armar_cubo, args.repeticiones)
+
+    # La primera pasada prepara cada especialidad (árbol + sumas); las siguientes miden solo el filtro
+    combinaciones = combinaciones_filtro(cubo, args.filtros)
+    inicio = time.perf_counter()
+    for _, _, esp, _ in combinaciones:
+        cubo.preparar_especialidad(esp, lambda: app.distancias_para_cubo(afi_geo_all, cons_geo_all, esp))
+    etapas["preparar_especialidades"] = {"mejor_s": round(time.perf_counter() - inicio, 4), "mediana_s": None}
+
+    def filtrar_todas():
+        return [cubo.consultar(prov, loc, esp, rango) for prov, loc, esp, rango in combinaciones]
+
+    etapas["filtros"], resultados = medir(filtrar_todas, args.repeticiones)
+    etapas["filtros"]["por_consulta_ms"] = round(etapas["filtros"]["mejor_s"] * 1000 / len(combinaciones), 3)
+
+    nacional, _ = resultados[0]
+    # Formato de números: por columna (el de la app) contra el format por celda de antes, con el mismo texto
+    etapas["formato_tabla"], tabla = medir(lambda: app.tabla_formateada(nacional), args.repeticiones)
+    etapas["formato_tabla_por_celda"], tabla_por_celda = medir(lambda: tabla_formateada_por_celda(nacional), args.repeticiones)
+    etapas["formato_tabla"]["igual_por_celda"] = tabla.astype(str).equals(tabla_por_celda.astype(str))
+    etapas["formato_tooltips"], textos = medir(lambda: tooltips_por_columna(nacional), args.repeticiones)
+    etapas["formato_tooltips_por_celda"], textos_por_celda = medir(lambda: tooltips_por_celda(nacional), args.repeticiones)
+    etapas["formato_tooltips"]["igual_por_celda"] = textos.astype(str).equals(textos_por_celda.astype(str))
+
+    def armar_mapa(con_geojson=True):
+        m = folium.Map(location=[-38.4, -63.6], zoom_start=4, tiles="cartodbpositron")
+        if con_geojson:
+            app.capa_marcadores(nacional).add_to(m)
+        else:
+            capa_marcadores_bucle(m, nacional)
+        return m.get_root().render()
+
+    etapas["mapa"], html = medir(armar_mapa, args.repeticiones)
+    etapas["mapa"]["html_mb"] = round(len(html) / 2**20, 2)
+    etapas["mapa_bucle"], html = medir(lambda: armar_mapa(con_geojson=False), args.repeticiones)
+    etapas["mapa_bucle"]["html_mb"] = round(len(html) / 2**20, 2)
+
+    return {
+        "fecha": datetime.now().isoformat(timespec='seconds'),
+        "commit": commit_actual(),
+        "escala": {"afiliados": args.afiliados, "consultorios": n_cons,
+                   "afiliados_en_mapa": len(afi_geo_all), "localidades": int(cubo.n)},
+        "semilla": args.semilla,
+        "repeticiones": args.repeticiones,
+        "entorno": {"python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+                    "scipy": scipy.__version__, "folium": folium.__version__, "cpus": os.cpu_count()},
+        "etapas": etapas,
+    }
+
+
+def corrida_anterior(resultado):
+    # La última con la misma escala pedida y semilla; con otra escala los tiempos no se comparan
+    if not RESULTADOS.exists():
+        return None
+    anterior = None
+    for linea in RESULTADOS.read_text(encoding="utf-8").splitlines():
+        previo = json.loads(linea)
+        if previo["semilla"] == resultado["semilla"] and \
+                (previo["escala"]["afiliados"], previo["escala"]["consultorios"]) == \
+                (resultado["escala"]["afiliados"], resultado["escala"]["consultorios"]):
+            anterior = previo
+    return anterior
+
+
+def mostrar(resultado, anterior):
+    if anterior:
+        print(f"Comparado con {anterior['fecha']} (commit {anterior['commit']})")
+    print(f"{'etapa':<26}{'mejor (s)':>12}{'mediana (s)':>13}{'anterior (s)':>14}{'cambio':>9}")
+    for nombre, tiempos in resultado["etapas"].items():
+        previo = (anterior or {}).get("etapas", {}).get(nombre, {}).get("mejor_s")
+        cambio = f"{(tiempos['mejor_s'] / previo - 1) * 100:+.0f}%" if previo else ""
+        mediana = "" if tiempos["mediana_s"] is None else f"{tiempos['mediana_s']:.4f}"
+        print(f"{nombre:<26}{tiempos['mejor_s']:>12.4f}{mediana:>13}{'' if previo is None else f'{previo:.4f}':>14}{cambio:>9}")
+    for nombre, tiempos in resultado["etapas"].items():
+        if tiempos.get("igual_por_celda") is False:
+            print(f"OJO: {nombre} no da el mismo texto que el formato por celda")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--afiliados", type=int, default=200_000)
+    parser.add_argument("--consultorios", type=int, default=None, help="por defecto, 1 cada 25 afiliados")
+    parser.add_argument("--semilla", type=int, default=0)
+    parser.add_argument("--repeticiones", type=int, default=3)
+    parser.add_argument("--filtros", type=int, default=25, help="combinaciones de filtro a medir")
+    parser.add_argument("--sqlite", type=Path, help="base SQLite a usar (se pisa); por defecto, una temporal")
+    parser.add_argument("--no-guardar", action="store_true", help="no agregar la corrida a resultados.jsonl")
+    args = parser.parse_args()
+
+    resultado = correr(args)
+    mostrar(resultado, corrida_anterior(resultado))
+    if not args.no_guardar:
+        with RESULTADOS.open("a", encoding="utf-8") as f:
+            f.write(json.dumps(resultado, ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    main()
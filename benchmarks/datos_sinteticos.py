@@ -0,0 +1,343 @@
+"""Datos sintéticos de afiliados y consultorios con las mismas columnas que devuelven
+QUERY_AFILIADOS y QUERY_CONSULTORIOS, y una base SQLite local que hace de Oracle para medir
+sin acceso a PROD.
+
+    python benchmarks/datos_sinteticos.py --afiliados 1000000 --sqlite /tmp/cobertura.db
+    python benchmarks/datos_sinteticos.py --afiliados 200000 --snapshot snapshot/
+
+Con --snapshot escribe además el snapshot local del tablero (parquet + manifest), así la app
+arranca con estos datos sin ir a la base.
+"""
+import argparse
+import sqlite3
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import oracledb
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import app  # noqa: E402
+
+# Columnas en el orden de las consultas (ya en mayúsculas, como las deja la carga) y su tipo en Oracle
+ESQUEMA_AFILIADOS = {
+    'CODIGO': 'VARCHAR2', 'APELLIDOS': 'VARCHAR2', 'NOMBRES': 'VARCHAR2', 'AFI_ID': 'NUMBER',
+    'DOMIAFI_ID': 'NUMBER', 'CALLE': 'VARCHAR2', 'NUMERO': 'VARCHAR2', 'PISO': 'VARCHAR2',
+    'DEPARTAMENTO': 'VARCHAR2', 'CODIGOPOST': 'VARCHAR2', 'LOCALIDAD': 'VARCHAR2', 'PROVINCIA': 'VARCHAR2',
+    'PAIS': 'VARCHAR2', 'LATITUD': 'NUMBER', 'LONGITUD': 'NUMBER',
+}
+ESQUEMA_CONSULTORIOS = {
+    'PRES_EFE_CODIGO': 'VARCHAR2', 'SECUENCIA': 'NUMBER', 'USERNAME': 'VARCHAR2', 'NOMBRE': 'VARCHAR2',
+    'DOMICONS_ID': 'NUMBER', 'CALLE': 'VARCHAR2', 'NUMERO': 'VARCHAR2', 'PISO': 'VARCHAR2', 'DPTO': 'VARCHAR2',
+    'CODIGO_POSTAL': 'VARCHAR2', 'BARRIO': 'VARCHAR2', 'LOCALIDAD': 'VARCHAR2', 'PROVINCIA': 'VARCHAR2',
+    'PAIS': 'VARCHAR2', 'LATITUD': 'NUMBER', 'LONGITUD': 'NUMBER', 'OBSERVACIONES': 'VARCHAR2',
+    'COD_ESP': 'VARCHAR2', 'ESPECIALIDAD': 'VARCHAR2', 'AGRUPACION_PRESTADOR': 'VARCHAR2',
+    'DESC_AGRUP_PRESTADOR': 'VARCHAR2', 'CLASE_EFECTOR': 'VARCHAR2', 'DESC_CLASE_EFECTOR': 'VARCHAR2',
+    'AGRUPACION_EFECTOR': 'VARCHAR2', 'DESC_AGRUPACION_EFECTOR': 'VARCHAR2', 'TIPO_EFECTOR': 'VARCHAR2',
+    'DESC_TIPO_EFECTOR': 'VARCHAR2', 'CATEGORIA_EFECTOR': 'VARCHAR2', 'DESC_CATEGORIA_EFECTOR': 'VARCHAR2',
+    'ESTADOPREST': 'VARCHAR2', 'ESTADOCONS': 'VARCHAR2', 'ESTADOEFECTOR': 'VARCHAR2',
+}
+
+# (localidad, provincia, lat, lon, habitantes en miles, radio urbano en km). Los afiliados se
+# reparten según habitantes y se concentran alrededor del centro de cada ciudad
+CIUDADES = [
+    ("CAPITAL FEDERAL", "CIUDAD AUTONOMA DE BUENOS AIRES", -34.61, -58.38, 3000, 8),
+    ("LA MATANZA", "BUENOS AIRES", -34.77, -58.63, 1800, 10),
+    ("LA PLATA", "BUENOS AIRES", -34.92, -57.95, 800, 8),
+    ("MAR DEL PLATA", "BUENOS AIRES", -38.00, -57.56, 650, 7),
+    ("QUILMES", "BUENOS AIRES", -34.72, -58.25, 600, 5),
+    ("LOMAS DE ZAMORA", "BUENOS AIRES", -34.76, -58.40, 600, 5),
+    ("MERLO", "BUENOS AIRES", -34.66, -58.73, 530, 6),
+    ("MORENO", "BUENOS AIRES", -34.65, -58.79, 450, 7),
+    ("BAHIA BLANCA", "BUENOS AIRES", -38.72, -62.27, 300, 6),
+    ("TANDIL", "BUENOS AIRES", -37.32, -59.13, 130, 4),
+    ("PERGAMINO", "BUENOS AIRES", -33.89, -60.57, 100, 3),
+    ("JUNIN", "BUENOS AIRES", -34.59, -60.95, 95, 3),
+    ("OLAVARRIA", "BUENOS AIRES", -36.89, -60.32, 90, 3),
+    ("CORDOBA", "CORDOBA", -31.42, -64.18, 1400, 10),
+    ("RIO CUARTO", "CORDOBA", -33.13, -64.35, 160, 4),
+    ("VILLA MARIA", "CORDOBA", -32.41, -63.24, 80, 3),
+    ("ROSARIO", "SANTA FE", -32.95, -60.65, 1250, 9),
+    ("SANTA FE", "SANTA FE", -31.63, -60.70, 400, 6),
+    ("RAFAELA", "SANTA FE", -31.25, -61.49, 100, 3),
+    ("MENDOZA", "MENDOZA", -32.89, -68.84, 1000, 10),
+    ("SAN RAFAEL", "MENDOZA", -34.62, -68.33, 120, 4),
+    ("SAN MIGUEL DE TUCUMAN", "TUCUMAN", -26.81, -65.22, 800, 8),
+    ("SALTA", "SALTA", -24.78, -65.41, 620, 7),
+    ("PARANA", "ENTRE RIOS", -31.73, -60.53, 250, 5),
+    ("CONCORDIA", "ENTRE RIOS", -31.39, -58.02, 150, 4),
+    ("POSADAS", "MISIONES", -27.37, -55.90, 350, 6),
+    ("RESISTENCIA", "CHACO", -27.45, -58.99, 390, 6),
+    ("CORRIENTES", "CORRIENTES", -27.47, -58.83, 350, 5),
+    ("SANTIAGO DEL ESTERO", "SANTIAGO DEL ESTERO", -27.78, -64.26, 270, 5),
+    ("SAN JUAN", "SAN JUAN", -31.54, -68.54, 470, 6),
+    ("SAN SALVADOR DE JUJUY", "JUJUY", -24.19, -65.30, 260, 5),
+    ("VIEDMA", "RIO NEGRO", -40.81, -63.00, 55, 3),
+    ("SAN CARLOS DE BARILOCHE", "RIO NEGRO", -41.13, -71.31, 110, 4),
+    ("GENERAL ROCA", "RIO NEGRO", -39.03, -67.58, 90, 3),
+    ("NEUQUEN", "NEUQUEN", -38.95, -68.06, 300, 6),
+    ("FORMOSA", "FORMOSA", -26.18, -58.18, 230, 5),
+    ("COMODORO RIVADAVIA", "CHUBUT", -45.86, -67.48, 180, 5),
+    ("TRELEW", "CHUBUT", -43.25, -65.31, 100, 3),
+    ("SAN LUIS", "SAN LUIS", -33.30, -66.34, 200, 4),
+    ("SAN FERNANDO DEL VALLE DE CATAMARCA", "CATAMARCA", -28.47, -65.78, 160, 4),
+    ("LA RIOJA", "LA RIOJA", -29.41, -66.86, 180, 4),
+    ("SANTA ROSA", "LA PAMPA", -36.62, -64.29, 110, 3),
+    ("RIO GALLEGOS", "SANTA CRUZ", -51.62, -69.22, 95, 3),
+    ("USHUAIA", "TIERRA DEL FUEGO", -54.80, -68.30, 80, 3),
+    ("RIO GRANDE", "TIERRA DEL FUEGO", -53.79, -67.70, 90, 3),
+]
+
+# (especialidad, peso relativo entre consultorios que no son farmacia)
+ESPECIALIDADES = [
+    ("CLINICA MEDICA", 14), ("MEDICINA GENERAL Y FAMILIAR", 8), ("PEDIATRIA", 10),
+    ("GINECOLOGIA Y OBSTETRICIA", 8), ("ODONTOLOGIA", 9), ("CARDIOLOGIA", 5),
+    ("TRAUMATOLOGIA Y ORTOPEDIA", 5), ("OFTALMOLOGIA", 4), ("DERMATOLOGIA", 3),
+    ("OTORRINOLARINGOLOGIA", 3), ("PSICOLOGIA", 5), ("PSIQUIATRIA", 2), ("NEUROLOGIA", 2),
+    ("UROLOGIA", 2), ("GASTROENTEROLOGIA", 2), ("ENDOCRINOLOGIA", 2), ("NEUMONOLOGIA", 1),
+    ("NEFROLOGIA", 1), ("REUMATOLOGIA", 1), ("ONCOLOGIA", 1), ("KINESIOLOGIA", 4),
+    ("NUTRICION", 2), ("CIRUGIA GENERAL", 2), ("Sin Dato", 4),
+]
+TIPOS_EFECTOR = [("FARMACIA", 25), ("CONSULTORIO", 50), ("CLINICA", 10), ("CENTRO MEDICO", 10), ("LABORATORIO", 5)]
+
+APELLIDOS = np.array(["GONZALEZ", "RODRIGUEZ", "GOMEZ", "FERNANDEZ", "LOPEZ", "DIAZ", "MARTINEZ", "PEREZ",
+                      "GARCIA", "SANCHEZ", "ROMERO", "SOSA", "TORRES", "ALVAREZ", "RUIZ", "RAMIREZ",
+                      "FLORES", "BENITEZ", "ACOSTA", "MEDINA", "HERRERA", "SUAREZ", "AGUIRRE", "GIMENEZ"])
+NOMBRES = np.array(["MARIA", "JUAN", "CARLOS", "ANA", "JOSE", "LAURA", "LUIS", "SOFIA", "JORGE", "LUCIA",
+                    "MIGUEL", "VALENTINA", "DIEGO", "CAMILA", "PABLO", "MARTINA", "SERGIO", "FLORENCIA"])
+CALLES = np.array(["SAN MARTIN", "BELGRANO", "RIVADAVIA", "SARMIENTO", "MITRE", "MORENO", "ALSINA",
+                   "9 DE JULIO", "25 DE MAYO", "ITALIA", "ESPAÑA", "LAVALLE", "URQUIZA", "PELLEGRINI"])
+
+KM_POR_GRADO = 111.32
+
+
+def _pesos(pares):
+    pesos = np.array([p for _, p in pares], dtype=np.float64)
+    return np.array([v for v, _ in pares]), pesos / pesos.sum()
+
+
+def _alrededor_de_ciudades(rng, n, concentracion):
+    """Índice de ciudad y coordenadas para n puntos: mitad pegados al centro y mitad en todo
+    el radio urbano ('concentracion' achica ambos), y un 3 % rural a ~40 km."""
+    habitantes = np.array([c[4] for c in CIUDADES], dtype=np.float64)
+    ciudad = rng.choice(len(CIUDADES), size=n, p=habitantes / habitantes.sum())
+    lat0 = np.array([c[2] for c in CIUDADES])[ciudad]
+    lon0 = np.array([c[3] for c in CIUDADES])[ciudad]
+    radio = np.array([c[5] for c in CIUDADES], dtype=np.float64)[ciudad] * concentracion
+    radio = np.where(rng.random(n) < 0.5, radio / 3, radio)
+    rural = rng.random(n) < 0.03
+    radio[rural] = 40
+    lat = lat0 + rng.normal(0, 1, n) * radio / KM_POR_GRADO
+    lon = lon0 + rng.normal(0, 1, n) * radio / (KM_POR_GRADO * np.cos(np.radians(lat0)))
+    return ciudad, lat, lon, rural
+
+
+def _ensuciar_coordenadas(rng, lat, lon, pais):
+    # Lo que filtrar_geo tiene que descartar: sin coordenadas, en (0, 0), invertidas y del exterior
+    n = len(lat)
+    sorteo = rng.random(n)
+    lat[sorteo < 0.04] = np.nan
+    cero = (sorteo >= 0.04) & (sorteo < 0.05)
+    lat[cero], lon[cero] = 0.0, 0.0
+    invertidas = (sorteo >= 0.05) & (sorteo < 0.055)
+    lat[invertidas], lon[invertidas] = lon[invertidas].copy(), lat[invertidas].copy()
+    exterior = (sorteo >= 0.055) & (sorteo < 0.06)
+    lat[exterior], lon[exterior] = -34.90, -56.16 # Montevideo: dentro del rectángulo, pero no es Argentina
+    pais[exterior] = "URUGUAY"
+
+
+def generar_afiliados(n, semilla=0):
+    """n afiliados (filas de domicilio) con el esquema de QUERY_AFILIADOS. Un 2 % repite
+    domicilio (para la deduplicación) y un 6 % tiene coordenadas inválidas."""
+    rng = np.random.default_rng(semilla)
+    ciudad, lat, lon, rural = _alrededor_de_ciudades(rng, n, concentracion=1.0)
+    localidad = np.array([c[0] for c in CIUDADES], dtype=object)[ciudad]
+    localidad[rural] = localidad[rural] + " - ZONA RURAL"
+    pais = np.full(n, "ARGENTINA", dtype=object)
+    _ensuciar_coordenadas(rng, lat, lon, pais)
+
+    afi_id = np.arange(1, n + 1)
+    repetidos = rng.random(n) < 0.02
+    afi_id[repetidos] = np.maximum(afi_id[repetidos] - 1, 1)
+    df = pd.DataFrame({
+        'CODIGO': pd.Series(afi_id).map("{:08d}".format).to_numpy(),
+        'APELLIDOS': rng.choice(APELLIDOS, n) + " " + rng.choice(APELLIDOS, n),
+        'NOMBRES': rng.choice(NOMBRES, n),
+        'AFI_ID': afi_id,
+        'DOMIAFI_ID': afi_id * 10 + 1,
+        'CALLE': rng.choice(CALLES, n),
+        'NUMERO': rng.integers(1, 6000, n).astype(str),
+        'PISO': np.where(rng.random(n) < 0.2, rng.integers(1, 15, n).astype(str), None),
+        'DEPARTAMENTO': np.where(rng.random(n) < 0.2, rng.choice(list("ABCDEF"), n), None),
+        'CODIGOPOST': rng.integers(1000, 9500, n).astype(str),
+        'LOCALIDAD': localidad,
+        'PROVINCIA': np.array([c[1] for c in CIUDADES], dtype=object)[ciudad],
+        'PAIS': pais,
+        'LATITUD': lat.round(6),
+        'LONGITUD': lon.round(6),
+    })
+    # Los repetidos copian el domicilio del afiliado anterior: mismo AFI_ID, CALLE y NUMERO
+    origen = np.flatnonzero(repetidos) - 1
+    origen = origen[origen >= 0]
+    destino = origen + 1
+    df.loc[destino, ['CALLE', 'NUMERO', 'DOMIAFI_ID']] = df.loc[origen, ['CALLE', 'NUMERO', 'DOMIAFI_ID']].to_numpy()
+    return df[list(ESQUEMA_AFILIADOS)]
+
+
+def generar_consultorios(n, semilla=0):
+    """n consultorios con el esquema de QUERY_CONSULTORIOS, más concentrados que los afiliados
+    en el centro de cada ciudad. Un 25 % son farmacias."""
+    rng = np.random.default_rng(semilla + 1)
+    ciudad, lat, lon, rural = _alrededor_de_ciudades(rng, n, concentracion=0.6)
+    pais = np.full(n, "ARGENTINA", dtype=object)
+    _ensuciar_coordenadas(rng, lat, lon, pais)
+    localidad = np.array([c[0] for c in CIUDADES], dtype=object)[ciudad]
+    localidad[rural] = localidad[rural] + " - ZONA RURAL"
+
+    tipos, p_tipos = _pesos(TIPOS_EFECTOR)
+    especialidades, p_esp = _pesos(ESPECIALIDADES)
+    tipo = rng.choice(tipos, n, p=p_tipos)
+    especialidad = np.where(tipo == "FARMACIA", "Sin Dato", rng.choice(especialidades, n, p=p_esp))
+    cod_esp = pd.Series(especialidad).map({e: f"{i:03d}" for i, (e, _) in enumerate(ESPECIALIDADES)}).to_numpy()
+    efector = np.arange(n) // 2 + 1000 # Dos consultorios por efector
+    return pd.DataFrame({
+        'PRES_EFE_CODIGO': efector.astype(str),
+        'SECUENCIA': np.arange(n) % 2 + 1,
+        'USERNAME': None,
+        'NOMBRE': np.where(tipo == "FARMACIA", "FARMACIA " + rng.choice(APELLIDOS, n),
+                           "DR/A. " + rng.choice(NOMBRES, n) + " " + rng.choice(APELLIDOS, n)),
+        'DOMICONS_ID': np.arange(1, n + 1),
+        'CALLE': rng.choice(CALLES, n),
+        'NUMERO': rng.integers(1, 6000, n).astype(str),
+        'PISO': None,
+        'DPTO': None,
+        'CODIGO_POSTAL': rng.integers(1000, 9500, n).astype(str),
+        'BARRIO': None,
+        'LOCALIDAD': localidad,
+        'PROVINCIA': np.array([c[1] for c in CIUDADES], dtype=object)[ciudad],
+        'PAIS': pais,
+        'LATITUD': lat.round(6),
+        'LONGITUD': lon.round(6),
+        'OBSERVACIONES': None,
+        'COD_ESP': cod_esp,
+        'ESPECIALIDAD': especialidad,
+        'AGRUPACION_PRESTADOR': "01",
+        'DESC_AGRUP_PRESTADOR': "PRESTADORES DIRECTOS",
+        'CLASE_EFECTOR': np.where(tipo == "FARMACIA", "F", "P"),
+        'DESC_CLASE_EFECTOR': np.where(tipo == "FARMACIA", "FARMACIAS", "PROFESIONALES"),
+        'AGRUPACION_EFECTOR': "01",
+        'DESC_AGRUPACION_EFECTOR': "GENERAL",
+        'TIPO_EFECTOR': pd.Series(tipo).map({t: f"T{i}" for i, (t, _) in enumerate(TIPOS_EFECTOR)}).to_numpy(),
+        'DESC_TIPO_EFECTOR': tipo,
+        'CATEGORIA_EFECTOR': "A",
+        'DESC_CATEGORIA_EFECTOR': "CATEGORIA A",
+        'ESTADOPREST': "A",
+        'ESTADOCONS': "A",
+        'ESTADOEFECTOR': "A",
+    })[list(ESQUEMA_CONSULTORIOS)]
+
+
+# --- BASE LOCAL EN LUGAR DE ORACLE ---
+
+def cargar_sqlite(ruta, df_afi, df_cons):
+    """Crea (o pisa) las tablas afiliados y consultorios en la base SQLite 'ruta'."""
+    with sqlite3.connect(ruta) as conn:
+        for tabla, df, esquema in [("afiliados", df_afi, ESQUEMA_AFILIADOS), ("consultorios", df_cons, ESQUEMA_CONSULTORIOS)]:
+            tipos = {col: ("REAL" if tipo == "NUMBER" else "TEXT") for col, tipo in esquema.items()}
+            df.to_sql(tabla, conn, if_exists="replace", index=False, dtype=tipos, chunksize=50_000)
+
+
+class CursorLocal:
+    """Lo que la carga usa de un cursor de oracledb (arraysize, prefetchrows, description con
+    DB_TYPE_NUMBER, fetchmany y uso con 'with'), sobre un cursor de sqlite3."""
+
+    TIPOS = {col: tipo for esquema in (ESQUEMA_AFILIADOS, ESQUEMA_CONSULTORIOS) for col, tipo in esquema.items()}
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.arraysize = 100
+        self.prefetchrows = 2
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._cursor.close()
+
+    def execute(self, query, params=None):
+        self._cursor.execute(query, params or {})
+        return self
+
+    @property
+    def description(self):
+        return [
+            (nombre, oracledb.DB_TYPE_NUMBER if self.TIPOS.get(nombre.upper()) == "NUMBER" else oracledb.DB_TYPE_VARCHAR,
+             None, None, None, None, True)
+            for nombre, *_ in self._cursor.description
+        ]
+
+    def fetchmany(self, size=None):
+        return self._cursor.fetchmany(size or self.arraysize)
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+
+class ConexionLocal:
+    """Conexión a la base SQLite que se pasa a leer_consulta / leer_consulta_en_lotes."""
+
+    def __init__(self, ruta):
+        self._conn = sqlite3.connect(ruta, check_same_thread=False)
+
+    def cursor(self):
+        return CursorLocal(self._conn.cursor())
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def escribir_snapshot(destino, df_afi, df_cons):
+    """Escribe los datos como snapshot local del tablero (mismo formato que actualizar_snapshot)."""
+    app.SNAPSHOT_DIR = Path(destino)
+    df_afi, df_cons = app.normalizar_lote(df_afi.copy()), app.normalizar_lote(df_cons.copy())
+    ahora = datetime.now().isoformat(timespec='seconds')
+    app.guardar_snapshot(df_afi, df_cons, {
+        'cargado_en': ahora, 'formato': app.FORMATO_SNAPSHOT, 'scn': 0, 'tipo': "completa",
+        'ultima_completa': ahora, 'modo_extraccion': app.MODO_EXTRACCION_AFILIADOS,
+        'filas_afiliados': len(df_afi), 'filas_consultorios': len(df_cons),
+        'cambios_afiliados': len(df_afi), 'cambios_consultorios': len(df_cons), 'segundos_base': 0.0,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--afiliados", type=int, default=200_000)
+    parser.add_argument("--consultorios", type=int, default=None, help="por defecto, 1 cada 25 afiliados")
+    parser.add_argument("--semilla", type=int, default=0)
+    parser.add_argument("--sqlite", type=Path, help="base SQLite a crear con las tablas afiliados y consultorios")
+    parser.add_argument("--snapshot", type=Path, help="carpeta donde escribir el snapshot local del tablero")
+    args = parser.parse_args()
+
+    inicio = time.perf_counter()
+    df_afi = generar_afiliados(args.afiliados, args.semilla)
+    df_cons = generar_consultorios(args.consultorios or max(args.afiliados // 25, 100), args.semilla)
+    print(f"Generados {len(df_afi):,} afiliados y {len(df_cons):,} consultorios en {time.perf_counter() - inicio:.1f} s")
+    if args.sqlite:
+        cargar_sqlite(args.sqlite, df_afi, df_cons)
+        print(f"Base SQLite: {args.sqlite}")
+    if args.snapshot:
+        escribir_snapshot(args.snapshot, df_afi, df_cons)
+        print(f"Snapshot: {args.snapshot}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""Reporte de cobertura sin interfaz: la tabla de localidades del tablero para cada provincia y
+especialidad, para correr de noche desde el programador de tareas.
+
+    python reporte_cobertura.py --salida reportes --formato parquet
+    python reporte_cobertura.py --actualizar --procesos 8 --formato csv
+
+Usa app.py como librería (carga, distancias y cubo de cobertura, los mismos cálculos que la
+interfaz). Las distancias de cada especialidad se calculan en un pool de procesos; los arrays que
+necesitan (coordenadas de afiliados y consultorios y la localidad de cada afiliado) se copian
+una sola vez a memoria compartida y cada proceso los lee desde ahí, sin copiarlos.
+
+La salida queda en <salida>/<versión de los datos>/, como dataset particionado estilo Hive:
+    localidades/PROVINCIA=<provincia>/ESPECIALIDAD=<especialidad>/part-0.<formato>
+    metricas.<formato>   una fila por provincia (y "Todas") × especialidad, con los totales del sidebar
+"""
+import argparse
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+import app
+
+COLUMNAS_REPORTE = ['LOCALIDAD', 'PROVINCIA', 'cant_afiliados', 'cant_farmacias', 'cant_consultorios',
+                    'dist_media', 'cons_por_afi', 'lat_ref', 'lon_ref']
+
+
+class ArraysCompartidos:
+    """Arrays numpy copiados a bloques de memoria compartida. 'especificacion' (nombre del
+    bloque, forma y tipo de cada uno) es lo único que viaja a los procesos del pool."""
+
+    def __init__(self, arrays):
+        self._bloques = []
+        self.especificacion = {}
+        for nombre, arr in arrays.items():
+            arr = np.ascontiguousarray(arr)
+            bloque = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+            np.ndarray(arr.shape, dtype=arr.dtype, buffer=bloque.buf)[...] = arr
+            self._bloques.append(bloque)
+            self.especificacion[nombre] = (bloque.name, arr.shape, arr.dtype.str)
+
+    def liberar(self):
+        for bloque in self._bloques:
+            bloque.close()
+            bloque.unlink()
+
+
+# Estado de cada proceso del pool: vistas de solo lectura sobre la memoria compartida
+_COMPARTIDOS = {}
+_BLOQUES = []
+
+
+def _abrir_compartidos(especificacion, n_localidades):
+    app.KDTREE_HILOS = 1 # Un hilo por proceso: el paralelismo lo pone el pool
+    for nombre, (bloque, forma, tipo) in especificacion.items():
+        abierto = shared_memory.SharedMemory(name=bloque) # Lo borra el proceso principal al terminar
+        _BLOQUES.append(abierto)
+        arr = np.ndarray(forma, dtype=np.dtype(tipo), buffer=abierto.buf)
+        arr.flags.writeable = False
+        _COMPARTIDOS[nombre] = arr
+    _COMPARTIDOS["n_localidades"] = n_localidades
+
+
+def _agregar_especialidad(j):
+    """Sumas por localidad (agregar_por_localidad) de la especialidad j del cubo (0 = Todas)."""
+    a = _COMPARTIDOS
+    medicos = np.ones(len(a["cons_esp"]), dtype=bool) if j == 0 else a["cons_esp"] == j
+    distancias, en_radio = app.cobertura_puntos(a["afi_lat"], a["afi_lon"], a["cons_lat"][medicos], a["cons_lon"][medicos])
+    if distancias is None:
+        distancias = a["dist_general"] # Como en el tablero: sin consultorios se mantiene la distancia general
+    return app.agregar_por_localidad(a["fila_afi"], a["n_localidades"], distancias, en_radio)
+
+
+def calcular_especialidades(cubo, afi_geo_all, cons_geo_all, procesos):
+    """Prepara todas las especialidades del cubo repartiéndolas en 'procesos' procesos."""
+    medicos = ~cons_geo_all['es_farmacia'].to_numpy()
+    compartidos = ArraysCompartidos({
+        "afi_lat": afi_geo_all['LATITUD'].to_numpy(),
+        "afi_lon": afi_geo_all['LONGITUD'].to_numpy(),
+        "fila_afi": cubo.fila_afiliados,
+        "dist_general": afi_geo_all['distancia_km'].to_numpy(),
+        "cons_lat": cons_geo_all['LATITUD'].to_numpy()[medicos],
+        "cons_lon": cons_geo_all['LONGITUD'].to_numpy()[medicos],
+        # Mismos índices que cubo.especialidades: código de la categoría + 1
+        "cons_esp": cons_geo_all['ESPECIALIDAD'].cat.codes.to_numpy()[medicos].astype(np.int32) + 1,
+    })
+    try:
+        with ProcessPoolExecutor(max_workers=procesos, initializer=_abrir_compartidos,
+                                 initargs=(compartidos.especificacion, cubo.n)) as pool:
+            pendientes = {pool.submit(_agregar_especialidad, j): esp for esp, j in cubo.especialidades.items()}
+            for hechas, futuro in enumerate(as_completed(pendientes), start=1):
+                cubo.agregar_especialidad(pendientes[futuro], futuro.result())
+                print(f"  {hechas}/{len(pendientes)} {pendientes[futuro]}", flush=True)
+    finally:
+        compartidos.liberar()
+
+
+def armar_reporte(cubo):
+    """(localidades, metricas): la tabla de la interfaz para cada especialidad (las provincias
+    son particiones de la nacional) y las métricas del sidebar de cada provincia × especialidad."""
+    sin_rango = (0, np.inf)
+    provincias = ["Todas"] + cubo.provincias()
+    tablas, metricas = [], []
+    for esp in cubo.especialidades:
+        tabla, _ = cubo.consultar("Todas", "Todas", esp, sin_rango)
+        tablas.append(tabla[COLUMNAS_REPORTE].assign(ESPECIALIDAD=esp))
+        for prov in provincias:
+            _, totales = cubo.consultar(prov, "Todas", esp, sin_rango)
+            metricas.append({"PROVINCIA": prov, "ESPECIALIDAD": esp, **totales})
+    localidades = pd.concat(tablas, ignore_index=True)
+    localidades[['LOCALIDAD', 'PROVINCIA']] = localidades[['LOCALIDAD', 'PROVINCIA']].astype(str)
+    return localidades, pd.DataFrame(metricas)
+
+
+def escribir_reporte(localidades, metricas, destino, formato):
+    # Se arma en una carpeta temporal y se cambia de una vez: nadie lee un reporte a medias
+    tmp = destino.with_name(f"{destino.name}.{os.getpid()}.tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    ds.write_dataset(
+        pa.Table.from_pandas(localidades, preserve_index=False), tmp / "localidades", format=formato,
+        partitioning=['PROVINCIA', 'ESPECIALIDAD'], partitioning_flavor="hive",
+        basename_template=f"part-{{i}}.{formato}",
+    )
+    if formato == "parquet":
+        metricas.to_parquet(tmp / "metricas.parquet", index=False)
+    else:
+        metricas.to_csv(tmp / "metricas.csv", index=False)
+    shutil.rmtree(destino, ignore_errors=True)
+    os.replace(tmp, destino)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--salida", type=Path, default=Path("reportes"))
+    parser.add_argument("--formato", choices=["parquet", "csv"], default="parquet")
+    parser.add_argument("--procesos", type=int, default=os.cpu_count())
+    parser.add_argument("--actualizar", action="store_true", help="traer antes lo nuevo de la base")
+    parser.add_argument("--completa", action="store_true", help="con --actualizar, recarga completa en vez del delta")
+    args = parser.parse_args()
+
+    inicio = time.perf_counter()
+    afi_base, df_cons_raw, afi_geo_all, cons_geo_all = app.cargar_datos(args.actualizar, args.completa)
+    version = afi_geo_all.attrs['version_datos']
+    print(f"Datos al {version}: {len(afi_geo_all):,} afiliados y {len(cons_geo_all):,} consultorios en el mapa "
+          f"({time.perf_counter() - inicio:.1f} s)", flush=True)
+
+    cubo = app.CuboCobertura(afi_base, df_cons_raw, afi_geo_all, cons_geo_all)
+    print(f"Distancias de {len(cubo.especialidades)} especialidades en {args.procesos} procesos:", flush=True)
+    calcular_especialidades(cubo, afi_geo_all, cons_geo_all, args.procesos)
+
+    localidades, metricas = armar_reporte(cubo)
+    destino = args.salida / str(version).replace(":", "-")
+    args.salida.mkdir(parents=True, exist_ok=True)
+    escribir_reporte(localidades, metricas, destino, args.formato)
+    print(f"Reporte: {destino} ({len(localidades):,} filas, {len(metricas):,} combinaciones) "
+          f"en {time.perf_counter() - inicio:.1f} s")
+
+
+if __name__ == "__main__":
+    main()